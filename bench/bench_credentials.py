@@ -0,0 +1,77 @@
+"""Login throughput against the indexed credential store.
+
+Usage: python bench/bench_credentials.py [--accounts 1000000] [--logins 20000]
+
+Seeds a throwaway credential store with N accounts (sharing one
+precomputed hash so seeding stays fast) and reports:
+
+  * lookups/s   - email -> hash lookups, the part that used to scan credentials.txt
+  * logins/s    - lookup plus check_password_hash, i.e. a full /login
+  * legacy scan - the old credentials.txt linear scan, for comparison
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mysite"))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+import flask_app  # noqa: E402
+
+
+def legacy_find_credentials(path, email_to_find):
+    """The pre-index lookup: read the whole file and try every separator"""
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        text = f.read()
+    for line in text.splitlines():
+        parsed = flask_app.parse_credentials_line(line)
+        if parsed and parsed[0].lower() == email_to_find.lower():
+            return parsed[1]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=1000000)
+    parser.add_argument("--logins", type=int, default=20000)
+    parser.add_argument("--verifies", type=int, default=50)
+    parser.add_argument("--legacy-lookups", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = flask_app.CredentialStore(os.path.join(tmp, "bench.sqlite3"))
+        password_hash = flask_app.generate_password_hash("hunter2")
+        emails = [f"User{i}@Gmail.com" for i in range(args.accounts)]
+
+        start = time.perf_counter()
+        store.add_many((email, password_hash) for email in emails)
+        print(f"seeded {args.accounts} accounts in {time.perf_counter() - start:.1f}s")
+
+        sample = random.choices(emails, k=args.logins)
+        start = time.perf_counter()
+        for email in sample:
+            assert store.get_hash(email) is not None
+        elapsed = time.perf_counter() - start
+        print(f"lookups/s:      {args.logins / elapsed:>12.0f}")
+
+        start = time.perf_counter()
+        for email in sample[:args.verifies]:
+            assert flask_app.check_password_hash(store.get_hash(email), "hunter2")
+        elapsed = time.perf_counter() - start
+        print(f"logins/s:       {args.verifies / elapsed:>12.1f}  (dominated by password hashing)")
+
+        legacy_path = os.path.join(tmp, "credentials.txt")
+        with open(legacy_path, "w", encoding="utf-8") as f:
+            f.writelines(f"{email}:hunter2\n" for email in emails)
+        start = time.perf_counter()
+        for email in sample[:args.legacy_lookups]:
+            assert legacy_find_credentials(legacy_path, email) == "hunter2"
+        elapsed = time.perf_counter() - start
+        print(f"legacy scans/s: {args.legacy_lookups / elapsed:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
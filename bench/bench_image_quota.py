@@ -0,0 +1,116 @@
+"""Concurrency check for image quota reservations.
+
+Usage: python bench/bench_image_quota.py [--requests 20] [--tier free] [--fail-rate 0.3]
+
+Boots the app under gunicorn (several worker processes) against a local
+fake OpenRouter, then fires --requests parallel POST /image calls for a
+single user and waits for every accepted job. Checks that:
+
+  * no more images were accepted than the tier allows
+  * every upstream image call belongs to an accepted job (nothing wasted)
+  * the user's final count equals the images actually delivered, so
+    failed upstream calls (--fail-rate) were refunded
+
+Exits non-zero if any check fails.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MYSITE = os.path.join(HERE, "..", "mysite")
+sys.path.insert(0, HERE)
+
+import fake_openrouter  # noqa: E402
+from bench_streams import free_port, wait_for_port  # noqa: E402
+
+SERVER = "gunicorn --workers 4 --threads 8 --bind 127.0.0.1:{port} flask_app:app"
+
+
+async def wait_for_job(client, status_url, timeout):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        job = (await client.get(status_url)).json()
+        if job["status"] in ("done", "error"):
+            return job
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{status_url} did not finish in {timeout}s")
+
+
+async def drive(base_url, args):
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        account = {"gmail": "quota@gmail.com", "password": "bench"}
+        response = await client.post("/signup", data=account)
+        if response.status_code != 302:
+            raise RuntimeError(f"signup failed: HTTP {response.status_code}")
+        if args.tier != "free":
+            await client.post("/upgrade/process", json={"tier": args.tier})
+        limit = (await client.get("/user/profile")).json()["images_limit"]
+
+        responses = await asyncio.gather(*(
+            client.post("/image", json={"prompt": f"test {i}"}) for i in range(args.requests)
+        ))
+        accepted = [r.json() for r in responses if r.status_code == 202]
+        rejected = sum(1 for r in responses if r.status_code == 429)
+        jobs = await asyncio.gather(*(wait_for_job(client, job["status_url"], 120) for job in accepted))
+        profile = (await client.get("/user/profile")).json()
+    done = sum(1 for job in jobs if job["status"] == "done")
+    return limit, len(accepted), rejected, done, len(jobs) - done, profile["images_used"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--tier", default="free", help="free, premium or unlimited")
+    parser.add_argument("--fail-rate", type=float, default=0.3, help="fraction of upstream image calls that fail")
+    parser.add_argument("--ttft", type=float, default=1.0, help="seconds the fake upstream takes per image")
+    args = parser.parse_args()
+
+    config = fake_openrouter.FakeConfig(ttft=args.ttft, image_fail_rate=args.fail_rate)
+    upstream_port = fake_openrouter.start_in_thread(config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rate_limits = os.path.join(tmp, "rate_limits.json")
+        with open(rate_limits, "w") as f:
+            json.dump({}, f)  # measure the quota alone, not the rate limiter
+        env = dict(os.environ,
+                   OPENROUTER_API_KEY="bench",
+                   OPENROUTER_BASE_URL=f"http://127.0.0.1:{upstream_port}/api/v1",
+                   FLASK_SECRET_KEY="bench",
+                   DATABASE_PATH=os.path.join(tmp, "bench.sqlite3"),
+                   RATE_LIMIT_DATABASE=os.path.join(tmp, "ratelimits.sqlite3"),
+                   RATE_LIMITS_FILE=rate_limits,
+                   IMAGES_DIR=os.path.join(tmp, "images"),
+                   IMAGE_PROCESS_WORKERS="0")
+        port = free_port()
+        proc = subprocess.Popen(shlex.split(SERVER.format(port=port)), cwd=MYSITE, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            limit, accepted, rejected, done, failed, used = asyncio.run(drive(f"http://127.0.0.1:{port}", args))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print(f"tier {args.tier}: limit {limit}, {args.requests} parallel requests")
+    print(f"accepted {accepted}, rejected {rejected}; delivered {done}, failed upstream {failed}")
+    print(f"upstream image calls {config.image_requests}, final images_used {used}")
+    checks = {
+        "accepted within limit": accepted <= limit,
+        "no wasted upstream calls": config.image_requests == accepted,
+        "failures refunded": used == done,
+    }
+    for name, ok in checks.items():
+        print(f"{'ok' if ok else 'FAIL':<5} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Image post-processing cost over the stored user_images corpus.
+
+Usage: python bench/bench_images.py [--dir mysite/user_images] [--variants webp,avif] [--workers 4]
+
+For every PNG in --dir reports CPU time for:
+
+  * legacy   - the old inline path: Image.open for dimensions, then a second
+               decode inside create_thumbnail
+  * pipeline - image_pipeline.process_image: one decode, thumbnail plus
+               the compressed variants
+
+then the bytes saved by each variant against the stored PNGs, and the
+wall time for the whole corpus through a --workers process pool.
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "mysite"))
+
+from PIL import Image  # noqa: E402
+
+import image_pipeline  # noqa: E402
+
+
+def legacy_process(img_data):
+    """Dimensions and thumbnail the way image_gen() used to do them"""
+    width, height = Image.open(io.BytesIO(img_data)).size
+    img = Image.open(io.BytesIO(img_data))
+    if img.mode in ('RGBA', 'LA', 'P'):
+        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        img = rgb_img
+    img.thumbnail((150, 150), Image.Resampling.LANCZOS)
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=85, optimize=True)
+    return width, height, buffered.getvalue()
+
+
+def cpu_time(fn, *args):
+    start = time.process_time()
+    result = fn(*args)
+    return time.process_time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default=os.path.join(HERE, "..", "mysite", "user_images"))
+    parser.add_argument("--variants", default="webp,avif")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    variants = image_pipeline.supported_variants(args.variants.split(","))
+    paths = sorted(glob.glob(os.path.join(args.dir, "*.png")))
+    if not paths:
+        sys.exit(f"no PNGs in {args.dir}")
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(f.read())
+
+    legacy_cpu = 0.0
+    pipeline_cpu = 0.0
+    thumbnail_cpu = 0.0
+    variant_bytes = dict.fromkeys(variants, 0)
+    png_bytes = sum(len(img_data) for img_data in images)
+    for img_data in images:
+        elapsed, _ = cpu_time(legacy_process, img_data)
+        legacy_cpu += elapsed
+        elapsed, _ = cpu_time(image_pipeline.process_image, img_data, ())
+        thumbnail_cpu += elapsed
+        elapsed, processed = cpu_time(image_pipeline.process_image, img_data, variants)
+        pipeline_cpu += elapsed
+        for fmt, variant_data in processed["variants"].items():
+            variant_bytes[fmt] += len(variant_data)
+
+    n = len(images)
+    print(f"{n} images, {png_bytes / 1024 / 1024:.2f} MB of PNG")
+    print(f"{'stage':<28} {'cpu ms/image':>13}")
+    print(f"{'legacy (two decodes)':<28} {legacy_cpu / n * 1000:>13.1f}")
+    print(f"{'pipeline, thumbnail only':<28} {thumbnail_cpu / n * 1000:>13.1f}")
+    print(f"{'pipeline + ' + ','.join(variants):<28} {pipeline_cpu / n * 1000:>13.1f}")
+    print(f"{'variant':<8} {'MB':>8} {'saved':>8}")
+    for fmt, total in variant_bytes.items():
+        print(f"{fmt:<8} {total / 1024 / 1024:>8.2f} {100 * (1 - total / png_bytes):>7.1f}%")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(image_pipeline.process_image, images[:1], [variants]))  # warm up the workers
+        start = time.perf_counter()
+        list(pool.map(image_pipeline.process_image, images, [variants] * n))
+        print(f"pool of {args.workers}: {n} images in {time.perf_counter() - start:.2f}s wall")
+
+
+if __name__ == "__main__":
+    main()
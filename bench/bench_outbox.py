@@ -0,0 +1,135 @@
+"""Password reset mail through the outbox.
+
+Usage: python bench/bench_outbox.py [--accounts 100] [--concurrency 4] [--fail-rate 0.1] [--smtp-delay 0.05]
+
+Boots the app under gunicorn against a local fake SMTP server (aiosmtpd),
+signs up --accounts users and sends one POST /forgot per user,
+--concurrency at a time.
+Reports /forgot latency, how long the outbox took to drain, how many
+SMTP connections the deliveries used and how many temporary failures
+(--fail-rate) were retried. For comparison it also times the old
+per-request path, a fresh SMTP connection per message.
+"""
+import argparse
+import asyncio
+import os
+import shlex
+import smtplib
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from email.mime.text import MIMEText
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MYSITE = os.path.join(HERE, "..", "mysite")
+sys.path.insert(0, HERE)
+
+import fake_smtp  # noqa: E402
+from bench_streams import free_port, wait_for_port  # noqa: E402
+
+SERVER = "gunicorn --workers 2 --threads 8 --bind 127.0.0.1:{port} flask_app:app"
+
+
+async def drive(base_url, accounts, concurrency):
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        emails = [f"reset{i}@gmail.com" for i in range(accounts)]
+        await asyncio.gather(*(client.post("/signup", data={"gmail": email, "password": "bench"}) for email in emails))
+
+        slots = asyncio.Semaphore(concurrency)
+
+        async def forgot(email):
+            async with slots:
+                start = time.perf_counter()
+                response = await client.post("/forgot", data={"email": email})
+                if response.status_code != 200:
+                    raise RuntimeError(f"/forgot failed: HTTP {response.status_code}")
+                return time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(forgot(email) for email in emails))
+        return start, sorted(latencies)
+
+
+def wait_for_drain(database, timeout):
+    """Seconds until no message is queued or sending, and the final status counts"""
+    deadline = time.time() + timeout
+    conn = sqlite3.connect(database)
+    while True:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall())
+        if not counts.get("queued") and not counts.get("sending"):
+            return counts
+        if time.time() > deadline:
+            raise RuntimeError(f"outbox did not drain in {timeout}s: {counts}")
+        time.sleep(0.05)
+
+
+def per_request_smtp(port, messages):
+    """The old path: connect, send and quit for every message"""
+    timings = []
+    for i in range(messages):
+        start = time.perf_counter()
+        server = smtplib.SMTP("127.0.0.1", port, timeout=30)
+        msg = MIMEText("bench")
+        msg["From"], msg["To"], msg["Subject"] = "bench@gmail.com", f"direct{i}@gmail.com", "bench"
+        server.send_message(msg)
+        server.quit()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="fraction of messages the server rejects with a 451")
+    parser.add_argument("--smtp-delay", type=float, default=0.05, help="seconds the fake server takes per message")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    smtp_config = fake_smtp.FakeSMTPConfig(args.fail_rate, args.smtp_delay)
+    smtp_port = fake_smtp.start_in_thread(smtp_config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, "bench.sqlite3")
+        env = dict(os.environ,
+                   OPENROUTER_API_KEY="bench",
+                   FLASK_SECRET_KEY="bench",
+                   DATABASE_PATH=database,
+                   RATE_LIMIT_DATABASE=os.path.join(tmp, "ratelimits.sqlite3"),
+                   IMAGES_DIR=os.path.join(tmp, "images"),
+                   SMTP_HOST="127.0.0.1",
+                   SMTP_PORT=str(smtp_port),
+                   SMTP_STARTTLS="0",
+                   SMTP_EMAIL="bench@gmail.com",
+                   OUTBOX_BACKOFF_BASE="0.2")
+        port = free_port()
+        proc = subprocess.Popen(shlex.split(SERVER.format(port=port)), cwd=MYSITE, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            start, latencies = asyncio.run(drive(f"http://127.0.0.1:{port}", args.accounts, args.concurrency))
+            counts = wait_for_drain(database, args.timeout)
+            drained = time.perf_counter() - start
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    outbox_connections = smtp_config.connections
+    delivered = len(smtp_config.delivered)
+    smtp_config.fail_rate = 0
+    direct = per_request_smtp(smtp_port, min(args.accounts, 50))
+    print(f"{args.accounts} resets, fake SMTP {args.smtp_delay * 1000:.0f} ms/message, {args.fail_rate:.0%} temporary failures")
+    print(f"/forgot latency ms     p50 {statistics.median(latencies) * 1000:8.1f}   p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:8.1f}")
+    print(f"old per-request SMTP ms p50 {statistics.median(direct) * 1000:8.1f}   p99 {direct[int(len(direct) * 0.99) - 1] * 1000:8.1f}"
+          f"   (plain TCP; no TLS or login)")
+    print(f"outbox drained in {drained:.2f}s: delivered {delivered}, "
+          f"retried {smtp_config.rejected}, gave up {counts.get('failed', 0)}, SMTP connections {outbox_connections}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""Two app nodes behind one imaginary load balancer, with and without shared state.
+
+Usage: python bench/bench_shared_state.py [--requests 20] [--image-rounds 5] [--ops 2000] [--threads 8] [--node-b asgi]
+
+Boots a fake OpenRouter and a fake Redis (bench/fake_redis.py), then two
+nodes (gunicorn, or uvicorn for node B with --node-b asgi), each with
+its own SQLite files, as two machines would have. The nodes run once with no SHARED_STATE_URL and once pointed at the
+fake Redis. One user then:
+
+  * signs up on node A and signs in on node B
+  * upgrades on node A and reads the tier on node B
+  * sends --requests parallel POST /image, alternating nodes; the free
+    tier allows 2 images in total
+  * --image-rounds times, signs up a fresh user and fires 12 POST /image
+    at once at both nodes, checking that at most 2 are accepted and that
+    the fake OpenRouter saw exactly one image call per accepted job
+  * sends 10 chat messages, alternating nodes, under a 5 message burst
+  * starts a streamed reply on node A, drops it after the first frame and
+    resumes it on node B with Last-Event-ID, then checks the reply
+  * starts another on node A and stops it through node B
+
+Because HTTP requests rarely collide inside one transaction, a fresh
+interpreter also calls reserve_image_quota() from 12 threads released
+by one barrier, for --reserve-trials users, against the fake Redis: a
+reservation must be granted exactly when it is stored.
+
+Finally --ops atomic increments of one hot counter from --threads
+threads are timed on each backend, local file and Redis protocol.
+Exits non-zero if a check fails with shared state.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MYSITE = os.path.join(HERE, "..", "mysite")
+sys.path.insert(0, HERE)
+sys.path.insert(0, MYSITE)
+
+import fake_openrouter  # noqa: E402
+import fake_redis  # noqa: E402
+import shared_state  # noqa: E402
+from bench_streams import free_port, wait_for_port  # noqa: E402
+
+SERVERS = {
+    "wsgi": "gunicorn --workers 2 --threads 8 --bind 127.0.0.1:{port} flask_app:app",
+    "asgi": "uvicorn asgi:application --workers 1 --port {port} --log-level warning",
+}
+RATE_LIMITS = {"chat": {"free": {"rate": 0.001, "burst": 5}}}
+CHAT_MESSAGES = 10
+BURST_REQUESTS = 12
+
+
+def parse_frames(body):
+    """(last event id, reply text, done payload) of an SSE body"""
+    last_id, text, done = 0, "", None
+    for frame in body.split("\n\n"):
+        event_id, data = None, None
+        for line in frame.splitlines():
+            if line.startswith("id: "):
+                event_id = int(line[4:])
+            elif line.startswith("data: "):
+                data = json.loads(line[6:])
+        if data is None:
+            continue
+        last_id = event_id or last_id
+        if data.get("reset"):
+            text = data["chunk"]
+        elif data.get("done"):
+            done = data
+        else:
+            text += data.get("chunk", "")
+    return last_id, text, done
+
+
+def json_body(response):
+    """The JSON a response carries, or {} (a node that does not know the user may redirect)"""
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+
+async def wait_for_job(client, status_url):
+    while True:
+        job = json_body(await client.get(status_url))
+        if job.get("status", "error") in ("done", "error"):
+            return job
+        await asyncio.sleep(0.2)
+
+
+async def image_bursts(a, b, upstream, rounds):
+    """Worst accepted count and whether upstream calls matched accepted jobs, over rounds of fresh users"""
+    most, matched = 0, True
+    for i in range(rounds):
+        a.cookies.clear()
+        await a.post("/signup", data={"gmail": f"burst{i}@gmail.com", "password": "bench"})
+        b.cookies = httpx.Cookies(a.cookies)
+        clients = [a, b]
+        before = upstream.image_requests
+        responses = await asyncio.gather(*(
+            clients[j % 2].post("/image", json={"prompt": f"burst {i} {j}"}) for j in range(BURST_REQUESTS)
+        ))
+        accepted = [(clients[j % 2], json_body(r)) for j, r in enumerate(responses) if r.status_code == 202]
+        await asyncio.gather(*(wait_for_job(client, job["status_url"]) for client, job in accepted))
+        most = max(most, len(accepted))
+        matched = matched and upstream.image_requests - before == len(accepted)
+    return most, matched
+
+
+async def drive(urls, upstream, args):
+    a, b = (httpx.AsyncClient(base_url=url, timeout=60) for url in urls)
+    checks = {}
+    async with a, b:
+        account = {"gmail": "nodes@gmail.com", "password": "bench"}
+        await a.post("/signup", data=account)
+        response = await b.post("/login", data=account)
+        checks["sign in on the other node"] = response.status_code == 302 and "login" not in response.headers.get("location", "")
+        # Both nodes share the secret key, so node A's session cookie is good on node B either way
+        b.cookies = httpx.Cookies(a.cookies)
+
+        await a.post("/upgrade/process", json={"tier": "premium"})
+        checks["tier visible on the other node"] = json_body(await b.get("/user/profile")).get("tier") == "premium"
+        await a.post("/upgrade/process", json={"tier": "free"})
+
+        clients = [a, b]
+        responses = await asyncio.gather(*(
+            clients[i % 2].post("/image", json={"prompt": f"test {i}"}) for i in range(args.requests)
+        ))
+        # Each job is polled on the node that did not queue it
+        accepted = [(clients[(i + 1) % 2], json_body(r)) for i, r in enumerate(responses) if r.status_code == 202]
+        jobs = await asyncio.gather(*(wait_for_job(client, job["status_url"]) for client, job in accepted))
+        checks[f"images accepted across nodes ({len(accepted)}) within the free limit (2)"] = len(accepted) <= 2
+        checks["image jobs finished when polled on the other node"] = all(job.get("status") == "done" for job in jobs)
+
+        most, matched = await image_bursts(a, b, upstream, args.image_rounds)
+        checks[f"{BURST_REQUESTS} simultaneous images per user, {args.image_rounds} users: "
+               f"at most {most} accepted (limit 2)"] = most <= 2
+        checks["one upstream image call per accepted job"] = matched
+        a.cookies.clear()
+        await a.post("/login", data=account)
+        b.cookies = httpx.Cookies(a.cookies)
+
+        statuses = []
+        for i in range(CHAT_MESSAGES):
+            response = await clients[i % 2].post("/chat", json={"message": f"hello {i}"})
+            statuses.append(response.status_code)
+        allowed = statuses.count(200)
+        checks[f"chat messages allowed across nodes ({allowed}) within the burst (5)"] = allowed <= 5
+
+        sent = {f"hello {i}" for i, status in enumerate(statuses) if status == 200}
+        pages = [json_body(await client.get("/history", params={"limit": 100})) for client in clients]
+        histories = [[entry.get("content") for entry in page.get("messages", [])] for page in pages]
+        checks["chat history the same on both nodes"] = bool(sent) and histories[0] == histories[1] and sent <= set(histories[1])
+        active = json_body(await a.get("/sessions")).get("active_session")
+        synced = json_body(await b.get(f"/sessions/{active}/sync", params={"after": 0}))
+        checks["session synced from the other node"] = [entry.get("content") for entry in synced.get("messages", [])] == histories[0]
+
+        # The chat limit is spent; a fresh account streams
+        a.cookies.clear()
+        await a.post("/signup", data={"gmail": "stream@gmail.com", "password": "bench"})
+        b.cookies = httpx.Cookies(a.cookies)
+        async with a.stream("POST", "/chat", json={"message": "stream please", "stream": True}) as response:
+            generation_id = response.headers.get("x-generation-id")
+            first = ""
+            async for chunk in response.aiter_text():
+                first += chunk
+                if "\n\n" in first:
+                    break
+        last_id, text, _ = parse_frames(first.rsplit("\n\n", 1)[0])
+        resumed = await b.get(f"/chat/generations/{generation_id}/events", headers={"Last-Event-ID": str(last_id)})
+        _, rest, done = parse_frames(resumed.text) if resumed.status_code == 200 else (0, "", None)
+        reply = text + rest
+        checks["reply resumed on the other node"] = bool(
+            done and done.get("crc32") == zlib.crc32(reply.encode()) and len(reply.encode()) == done.get("length"))
+
+        async with a.stream("POST", "/chat", json={"message": "stream again", "stream": True}) as response:
+            generation_id = response.headers.get("x-generation-id")
+            started = time.perf_counter()
+            stop = None
+            body = ""
+            async for chunk in response.aiter_text():
+                body += chunk
+                if stop is None:
+                    stop = json_body(await b.post(f"/chat/generations/{generation_id}/cancel"))
+            ended = time.perf_counter() - started
+        _, _, done = parse_frames(body)
+        checks[f"reply stopped through the other node (stream ended after {ended:.2f}s)"] = bool(
+            stop and stop.get("success") and done and done.get("stopped"))
+    return checks
+
+
+def run_nodes(mode, upstream, upstream_port, redis_port, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        rate_limits = os.path.join(tmp, "rate_limits.json")
+        with open(rate_limits, "w") as f:
+            json.dump(RATE_LIMITS, f)
+        procs = []
+        urls = []
+        try:
+            for node, server in (("a", "wsgi"), ("b", args.node_b)):
+                env = dict(os.environ,
+                           OPENROUTER_API_KEY="bench",
+                           OPENROUTER_BASE_URL=f"http://127.0.0.1:{upstream_port}/api/v1",
+                           FLASK_SECRET_KEY="bench",
+                           DATABASE_PATH=os.path.join(tmp, f"{node}.sqlite3"),
+                           RATE_LIMIT_DATABASE=os.path.join(tmp, f"{node}-ratelimits.sqlite3"),
+                           RATE_LIMITS_FILE=rate_limits,
+                           IMAGES_DIR=os.path.join(tmp, "images"),
+                           METRICS_DIR=os.path.join(tmp, f"{node}-metrics"),
+                           IMAGE_PROCESS_WORKERS="0",
+                           RESPONSE_CACHE="0",
+                           LOG_LEVEL="WARNING")
+                env.pop("SHARED_STATE_URL", None)
+                if mode == "shared":
+                    env["SHARED_STATE_URL"] = f"redis://127.0.0.1:{redis_port}/0"
+                port = free_port()
+                procs.append(subprocess.Popen(shlex.split(SERVERS[server].format(port=port)), cwd=MYSITE, env=env,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                urls.append(f"http://127.0.0.1:{port}")
+                wait_for_port(port)
+            return asyncio.run(drive(urls, upstream, args))
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+
+RESERVE_PROBE = """
+import json, os, sys, threading
+sys.path.insert(0, os.getcwd())
+import flask_app
+trials, threads = int(sys.argv[1]), int(sys.argv[2])
+worst = {"granted": 0, "mismatched": 0}
+for trial in range(trials):
+    gmail = f"race{trial}@gmail.com"
+    flask_app.update_user(gmail, lambda user_data: None, default=flask_app.new_user_data(), atomic=True)
+    granted = []
+    barrier = threading.Barrier(threads)
+
+    def reserve():
+        barrier.wait()
+        reservation, _, _ = flask_app.reserve_image_quota(gmail)
+        if reservation:
+            granted.append(reservation)
+
+    workers = [threading.Thread(target=reserve) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stored = set(flask_app.load_user(gmail)["image_usage"]["reserved"])
+    worst["granted"] = max(worst["granted"], len(granted))
+    worst["mismatched"] += set(granted) != stored
+print(json.dumps(worst))
+"""
+
+
+def reserve_race(redis_port, trials):
+    """Most reservations granted to one free user, and trials where granted and stored differ"""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   OPENROUTER_API_KEY="bench",
+                   FLASK_SECRET_KEY="bench",
+                   DATABASE_PATH=os.path.join(tmp, "race.sqlite3"),
+                   RATE_LIMIT_DATABASE=os.path.join(tmp, "ratelimits.sqlite3"),
+                   IMAGES_DIR=os.path.join(tmp, "images"),
+                   METRICS_DIR=os.path.join(tmp, "metrics"),
+                   SHARED_STATE_URL=f"redis://127.0.0.1:{redis_port}/2",
+                   LOG_LEVEL="WARNING")
+        out = subprocess.run([sys.executable, "-c", RESERVE_PROBE, str(trials), str(BURST_REQUESTS)], cwd=MYSITE,
+                             env=env, check=True, capture_output=True, text=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    return result["granted"], result["mismatched"]
+
+
+def hot_counter(state, ops, threads):
+    """Seconds per atomic increment of one key (p50, p99) and the final count"""
+    key = "bench:counter"
+    state.update([key], lambda values: values.update({key: 0}))
+    timings = []
+    lock = threading.Lock()
+
+    def increment(values):
+        values[key] += 1
+
+    def work():
+        mine = []
+        for _ in range(ops // threads):
+            start = time.perf_counter()
+            state.update([key], increment)
+            mine.append(time.perf_counter() - start)
+        with lock:
+            timings.extend(mine)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return len(timings) / elapsed, timings[len(timings) // 2], timings[int(len(timings) * 0.99)], state.get(key)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20, help="parallel image requests")
+    parser.add_argument("--image-rounds", type=int, default=5, help="fresh users firing simultaneous images")
+    parser.add_argument("--reserve-trials", type=int, default=20, help="users racing reserve_image_quota()")
+    parser.add_argument("--ops", type=int, default=2000, help="increments of the hot counter per backend")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--node-b", choices=SERVERS, default="wsgi", help="server running node B")
+    args = parser.parse_args()
+
+    upstream = fake_openrouter.FakeConfig(ttft=0.2, tokens=200)
+    upstream_port = fake_openrouter.start_in_thread(upstream)
+    redis = fake_redis.FakeRedis()
+    redis_port = fake_redis.start_in_thread(redis)
+
+    failed = False
+    for mode in ("per-node", "shared"):
+        checks = run_nodes(mode, upstream, upstream_port, redis_port, args)
+        print(f"{mode}:")
+        for name, ok in checks.items():
+            print(f"  {'ok' if ok else 'FAIL':<5} {name}")
+        if mode == "shared":
+            failed = not all(checks.values())
+    granted, mismatched = reserve_race(redis_port, args.reserve_trials)
+    ok = granted <= 2 and not mismatched
+    failed = failed or not ok
+    print(f"reserve_image_quota() from {BURST_REQUESTS} threads, {args.reserve_trials} users:")
+    print(f"  {'ok' if ok else 'FAIL':<5} at most {granted} granted (limit 2), "
+          f"{mismatched} users with grants that were not stored")
+    print(f"fake Redis: {redis.commands} commands, {redis.exec_aborted} transactions retried after a conflict")
+
+    print(f"\nhot counter, {args.threads} threads:")
+    print(f"{'backend':<14} {'ops/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'count':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "local file": shared_state.open_state(f"file://{tmp}/state.sqlite3"),
+            "redis (fake)": shared_state.open_state(f"redis://127.0.0.1:{redis_port}/1"),
+        }
+        for name, state in backends.items():
+            rate, p50, p99, count = hot_counter(state, args.ops, args.threads)
+            ok = count == args.ops // args.threads * args.threads
+            failed = failed or not ok
+            print(f"{name:<14} {rate:>8.0f} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f} {count:>7}{'' if ok else '  LOST UPDATES'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Bytes and frames per streamed chat reply.
+
+Usage: python bench/bench_sse.py [--tokens 300] [--intervals 0,0.005,0.02,0.05] [--replies 20]
+
+First it encodes synthetic replies (--tokens deltas of a few bytes each,
+arriving every interval seconds) both the old way, one frame per delta
+plus a final frame repeating the whole reply, and with ReplyEncoder.
+It reports bytes, frames and how long coalescing held a delta back.
+Then it boots the app under gunicorn against the fake OpenRouter and
+counts what actually goes over the wire for --replies streamed replies.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MYSITE = os.path.join(HERE, "..", "mysite")
+sys.path.insert(0, HERE)
+sys.path.insert(0, MYSITE)
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+import fake_openrouter  # noqa: E402
+import flask_app  # noqa: E402
+from bench_streams import free_port, wait_for_port  # noqa: E402
+
+SERVER = "gunicorn --workers 1 --threads 8 --bind 127.0.0.1:{port} flask_app:app"
+
+
+def synthetic_deltas(tokens, rng):
+    return [rng.choice(["", " "]) + "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(1, 7)))
+            for _ in range(tokens)]
+
+
+def legacy_frames(deltas):
+    frames = [flask_app.sse_event({'chunk': delta, 'done': False}) for delta in deltas]
+    frames.append(flask_app.sse_event({'chunk': '', 'done': True, 'full_response': "".join(deltas)}))
+    return frames
+
+
+def encoded_frames(deltas, interval):
+    """ReplyEncoder fed at the given arrival times, with the heartbeat Upstream.stream would give it"""
+    encoder = flask_app.ReplyEncoder()
+    window = flask_app.SSE_COALESCE_SECONDS
+    frames = []
+    held = []  # arrival times of deltas not sent yet
+    delays = []
+
+    def sent(frame, now):
+        if frame:
+            frames.append(frame)
+            delays.extend(now - arrived for arrived in held)
+            held.clear()
+
+    for i, delta in enumerate(deltas):
+        now = i * interval
+        if i:
+            # Heartbeats fire every window seconds of silence since the previous delta
+            beat = (i - 1) * interval + window
+            while beat < now:
+                sent(encoder.tick(beat), beat)
+                beat += window
+        held.append(now)
+        sent(encoder.feed(delta, now), now)
+    end = (len(deltas) - 1) * interval
+    sent(encoder.done(), end)
+    return frames, delays
+
+
+def synthetic(args):
+    rng = random.Random(1)
+    deltas = synthetic_deltas(args.tokens, rng)
+    text_bytes = len("".join(deltas).encode())
+    print(f"synthetic reply: {args.tokens} deltas, {text_bytes} bytes of text")
+    print(f"{'interval':>9} {'encoding':<9} {'bytes':>8} {'frames':>7} {'bytes/text':>11} {'held p50 ms':>12} {'held max ms':>12}")
+    for interval in [float(i) for i in args.intervals.split(",")]:
+        frames = legacy_frames(deltas)
+        size = sum(len(frame.encode()) for frame in frames)
+        print(f"{interval * 1000:>7.0f}ms {'legacy':<9} {size:>8} {len(frames):>7} {size / text_bytes:>11.2f} "
+              f"{0:>12.1f} {0:>12.1f}")
+        frames, delays = encoded_frames(deltas, interval)
+        size = sum(len(frame.encode()) for frame in frames)
+        print(f"{interval * 1000:>7.0f}ms {'coalesced':<9} {size:>8} {len(frames):>7} {size / text_bytes:>11.2f} "
+              f"{statistics.median(delays) * 1000:>12.1f} {max(delays) * 1000:>12.1f}")
+
+
+async def stream_replies(base_url, replies):
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        account = {"gmail": "sse@gmail.com", "password": "bench"}
+        await client.post("/signup", data=account)
+        results = []
+        for i in range(replies):
+            start = time.perf_counter()
+            first = None
+            body = b""
+            async with client.stream("POST", "/chat", json={"message": f"reply {i}", "stream": True}) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"/chat failed: HTTP {response.status_code}")
+                async for chunk in response.aiter_raw():
+                    if first is None:
+                        first = time.perf_counter() - start
+                    body += chunk
+            frames = [frame for frame in body.split(b"\n\n") if frame]
+            done = json.loads(frames[-1].split(b"data: ", 1)[1])
+            if not done.get("done") or "error" in done:
+                raise RuntimeError(f"reply {i} ended badly: {frames[-1]!r}")
+            results.append((len(body), len(frames), first))
+        return results
+
+
+def live(args):
+    config = fake_openrouter.FakeConfig(0.1, args.tokens, args.live_interval)
+    upstream_port = fake_openrouter.start_in_thread(config)
+    with tempfile.TemporaryDirectory() as tmp:
+        rate_limits = os.path.join(tmp, "rate_limits.json")
+        with open(rate_limits, "w") as f:
+            json.dump({}, f)
+        env = dict(os.environ,
+                   OPENROUTER_API_KEY="bench",
+                   OPENROUTER_BASE_URL=f"http://127.0.0.1:{upstream_port}/api/v1",
+                   FLASK_SECRET_KEY="bench",
+                   DATABASE_PATH=os.path.join(tmp, "bench.sqlite3"),
+                   RATE_LIMITS_FILE=rate_limits,
+                   RATE_LIMIT_DATABASE=os.path.join(tmp, "ratelimits.sqlite3"),
+                   IMAGES_DIR=os.path.join(tmp, "images"),
+                   METRICS_DIR=os.path.join(tmp, "metrics"),
+                   RESPONSE_CACHE="0")
+        port = free_port()
+        proc = subprocess.Popen(shlex.split(SERVER.format(port=port)), cwd=MYSITE, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            results = asyncio.run(stream_replies(f"http://127.0.0.1:{port}", args.replies))
+        finally:
+            proc.terminate()
+            proc.wait()
+    sizes, frames, firsts = zip(*results)
+    print(f"live: {args.replies} replies of {args.tokens} fake tokens, one every {args.live_interval * 1000:.0f} ms")
+    print(f"  bytes/reply {statistics.median(sizes):.0f}   frames/reply {statistics.median(frames):.0f}   "
+          f"ttfb p50 {statistics.median(firsts) * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=300, help="deltas per reply")
+    parser.add_argument("--intervals", default="0,0.005,0.02,0.05", help="comma separated seconds between deltas")
+    parser.add_argument("--replies", type=int, default=20, help="replies streamed through the app; 0 skips this")
+    parser.add_argument("--live-interval", type=float, default=0.005, help="seconds between fake upstream tokens")
+    args = parser.parse_args()
+
+    synthetic(args)
+    if args.replies:
+        live(args)
+
+
+if __name__ == "__main__":
+    main()
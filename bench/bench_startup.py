@@ -0,0 +1,195 @@
+"""Worker start-up cost.
+
+Usage: python bench/bench_startup.py [--runs 10] [--workers 4] [--compare HEAD~1]
+
+Each run is a fresh interpreter that imports flask_app, then signs up
+and renders the chat page once. The first run fills the Jinja bytecode
+cache, and later runs load compiled templates from it. The runs report
+the import time, the first render time and which heavy modules the
+import loaded. Then gunicorn is booted with --workers workers, without
+--preload, so every worker imports the app after the fork. Boots
+are timed until --workers requests have been answered, then the RSS
+of the server's processes is measured.
+
+With --compare, the same measurements are made for mysite/ as of that
+git revision (extracted with git archive), side by side.
+"""
+import argparse
+import io
+import json
+import os
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from bench_streams import free_port  # noqa: E402
+
+HEAVY_MODULES = ("openai", "requests", "smtplib", "PIL")
+SERVER = "gunicorn --workers {workers} --bind 127.0.0.1:{port} flask_app:app"
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import flask_app
+imported = time.perf_counter() - start
+heavy = [name for name in %r if name in sys.modules]
+client = flask_app.app.test_client()
+client.post("/signup", data={"gmail": "startup@gmail.com", "password": "bench"})
+start = time.perf_counter()
+status = client.get("/main").status_code
+rendered = time.perf_counter() - start
+print(json.dumps({"import": imported, "render": rendered, "status": status, "heavy": heavy}))
+""" % (HEAVY_MODULES,)
+
+
+def extract(ref, target):
+    """mysite/ of a git revision, written under target"""
+    archive = subprocess.run(["git", "archive", "--format=tar", ref, "mysite"], cwd=REPO,
+                             check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target, filter="data")
+    return os.path.join(target, "mysite")
+
+
+def extract_working_tree(target):
+    """A copy of mysite/ as it is on disk, so no run touches the real one"""
+    target = os.path.join(target, "mysite")
+    shutil.copytree(os.path.join(REPO, "mysite"), target,
+                    ignore=shutil.ignore_patterns("__pycache__", "*.sqlite3*", "users.json", "user_images"))
+    return target
+
+
+def environment(tmp):
+    return dict(os.environ,
+                OPENROUTER_API_KEY="bench",
+                FLASK_SECRET_KEY="bench",
+                DATABASE_PATH=os.path.join(tmp, "bench.sqlite3"),
+                RATE_LIMIT_DATABASE=os.path.join(tmp, "ratelimits.sqlite3"),
+                IMAGES_DIR=os.path.join(tmp, "images"),
+                METRICS_DIR=os.path.join(tmp, "metrics"),
+                JINJA_CACHE_DIR=os.path.join(tmp, "jinja"),
+                LOG_LEVEL="WARNING")
+
+
+def probe(mysite, runs):
+    """Import and first-render timings of runs fresh interpreters"""
+    results = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = environment(tmp)
+            # One cache for every run, as the workers of one machine would share it
+            env["JINJA_CACHE_DIR"] = os.path.join(os.path.dirname(mysite), "jinja")
+            out = subprocess.run([sys.executable, "-c", PROBE], cwd=mysite, env=env,
+                                 check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        if result["status"] != 200:
+            raise RuntimeError(f"GET /main answered {result['status']}")
+        results.append(result)
+    return results
+
+
+def rss(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+def server_pids(root):
+    pids = [root]
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == root:
+                        pids.append(int(name))
+            except (OSError, IndexError, ValueError):
+                continue
+    return pids
+
+
+def boot(mysite, workers):
+    """Seconds until workers concurrent requests were answered, and the server's RSS then"""
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        start = time.perf_counter()
+        proc = subprocess.Popen(shlex.split(SERVER.format(workers=workers, port=port)), cwd=mysite,
+                                env=environment(tmp), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            def answered(_):
+                deadline = time.time() + 60
+                while time.time() < deadline:
+                    try:
+                        if httpx.get(f"http://127.0.0.1:{port}/login", timeout=30).status_code == 200:
+                            return
+                    except httpx.HTTPError:
+                        pass
+                    time.sleep(0.01)
+                raise RuntimeError("server did not answer")
+
+            with ThreadPoolExecutor(workers) as pool:
+                list(pool.map(answered, range(workers)))
+            ready = time.perf_counter() - start
+            time.sleep(1)  # let every worker finish booting before measuring memory
+            memory = rss(server_pids(proc.pid))
+        finally:
+            proc.terminate()
+            proc.wait()
+    return ready, memory
+
+
+def measure(label, mysite, args):
+    results = probe(mysite, args.runs)
+    ready, memory = boot(mysite, args.workers)
+    return {
+        "label": label,
+        "import_ms": statistics.median(r["import"] for r in results) * 1000,
+        "first_render_ms": results[0]["render"] * 1000,
+        "cached_render_ms": statistics.median(r["render"] for r in results[1:] or results) * 1000,
+        "heavy": results[0]["heavy"],
+        "boot_ms": ready * 1000,
+        "rss_mb": memory / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per tree")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--compare", help="git revision to measure as well, e.g. HEAD~1")
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.compare:
+            rows.append(measure(args.compare, extract(args.compare, os.path.join(tmp, "before")), args))
+        rows.append(measure("working tree", extract_working_tree(os.path.join(tmp, "after")), args))
+
+    print(f"{args.runs} fresh imports per tree; gunicorn with {args.workers} workers, no --preload")
+    print(f"{'tree':<14} {'import ms':>10} {'1st render':>11} {'cached':>8} {'boot ms':>8} {'RSS MB':>8}  heavy modules")
+    for row in rows:
+        print(f"{row['label']:<14} {row['import_ms']:>10.0f} {row['first_render_ms']:>11.1f} "
+              f"{row['cached_render_ms']:>8.1f} {row['boot_ms']:>8.0f} {row['rss_mb']:>8.0f}  "
+              f"{', '.join(row['heavy']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
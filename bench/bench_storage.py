@@ -0,0 +1,85 @@
+"""Per-request storage latency at growing user counts.
+
+Usage: python bench/bench_storage.py [--scales 100,1000,10000,100000] [--ops 2000] [--flush-interval 0.5]
+
+Seeds a throwaway database with N synthetic users and times the
+update_user read-modify-write that routes perform. The SQLite backend
+should report a flat p99 across scales; "cached" is SQLite behind the
+in-process user cache with write-behind flushing every --flush-interval
+seconds (the app writes through unless USER_FLUSH_INTERVAL is set), and
+the legacy users.json backend is measured alongside (up to --json-max
+users) for comparison.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mysite"))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+import flask_app  # noqa: E402
+
+
+def synthetic_user(i):
+    user_data = flask_app.new_user_data()
+    session_id = user_data["active_session"]
+    user_data["sessions"][session_id]["history"] = [
+        {"content": f"message {n} from user {i}", "sender": "user" if n % 2 == 0 else "bot", "time": "2025-01-01 00:00:00"}
+        for n in range(10)
+    ]
+    return user_data
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def toggle_theme(user_data):
+    user_data["theme"] = "light" if user_data["theme"] == "dark" else "dark"
+
+
+def run(backend, n_users, ops):
+    emails = [f"user{i}@gmail.com" for i in range(n_users)]
+    backend.save_all({gmail: synthetic_user(i) for i, gmail in enumerate(emails)})
+
+    samples = []
+    for _ in range(ops):
+        gmail = random.choice(emails)
+        start = time.perf_counter()
+        backend.update(gmail, toggle_theme)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), percentile(samples, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", default="100,1000,10000,100000")
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--json-max", type=int, default=10000)
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(f"{'backend':<8} {'users':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for n_users in [int(n) for n in args.scales.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = flask_app.SQLiteStorage(os.path.join(tmp, "bench.sqlite3"))
+            p50, p99 = run(backend, n_users, args.ops)
+            print(f"{'sqlite':<8} {n_users:>8} {p50:>9.3f} {p99:>9.3f}")
+            backend = flask_app.SQLiteStorage(os.path.join(tmp, "cached.sqlite3"), flask_app.USER_CACHE_ENTRIES,
+                                              flask_app.USER_CACHE_BYTES, args.flush_interval)
+            p50, p99 = run(backend, n_users, args.ops)
+            backend.flush()
+            print(f"{'cached':<8} {n_users:>8} {p50:>9.3f} {p99:>9.3f}")
+            if n_users <= args.json_max:
+                backend = flask_app.JSONFileStorage(os.path.join(tmp, "users.json"))
+                p50, p99 = run(backend, n_users, max(20, args.ops // 20))
+                print(f"{'json':<8} {n_users:>8} {p50:>9.3f} {p99:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Concurrent streaming /chat capacity: sync WSGI workers vs the ASGI path.
+
+Usage: python bench/bench_streams.py [--streams 200] [--ttft 0.5] [--tokens 50]
+
+Boots a local fake OpenRouter, then for each server command below opens
+--streams concurrent streaming /chat requests, one per bench account, and
+reports wall time, completed streams and time-to-first-byte. Server
+commands run from mysite/ with {port} substituted.
+"""
+import argparse
+import asyncio
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MYSITE = os.path.join(HERE, "..", "mysite")
+sys.path.insert(0, HERE)
+
+import fake_openrouter  # noqa: E402
+
+SERVERS = {
+    "wsgi": "gunicorn --workers 2 --threads 4 --bind 127.0.0.1:{port} flask_app:app",
+    "asgi": "uvicorn asgi:application --workers 1 --port {port} --log-level warning",
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+async def login(base_url, i, timeout):
+    """A separate account per stream, so no single history grows during the run"""
+    client = httpx.AsyncClient(base_url=base_url, timeout=timeout)
+    account = {"gmail": f"bench{i}@gmail.com", "password": "bench"}
+    response = await client.post("/signup", data=account)
+    if response.status_code != 302:
+        response = await client.post("/login", data=account)
+    if response.status_code != 302:
+        raise RuntimeError(f"could not log in {account['gmail']}: HTTP {response.status_code}")
+    return client
+
+
+async def one_stream(client, timings):
+    start = time.perf_counter()
+    first_byte = None
+    body = b""
+    async with client.stream("POST", "/chat", json={"message": "hi", "stream": True}) as response:
+        async for chunk in response.aiter_bytes():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            body += chunk
+    if b'"done": true' not in body:
+        raise RuntimeError(f"stream ended without a done frame: {body[-200:]!r}")
+    timings.append((first_byte, time.perf_counter() - start))
+
+
+async def drive(base_url, streams, timeout):
+    clients = await asyncio.gather(*(login(base_url, i, timeout) for i in range(streams)))
+    try:
+        timings = []
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one_stream(client, timings) for client in clients), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            print(f"first error: {errors[0]!r}")
+        return elapsed, timings, errors
+    finally:
+        await asyncio.gather(*(client.aclose() for client in clients))
+
+
+def run_server(name, command, env, args):
+    port = free_port()
+    proc = subprocess.Popen(shlex.split(command.format(port=port)), cwd=MYSITE, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        elapsed, timings, errors = asyncio.run(drive(f"http://127.0.0.1:{port}", args.streams, args.timeout))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    ttfb = sorted(t[0] for t in timings) or [0]
+    print(f"{name:<6} {args.streams:>8} {len(timings):>10} {len(errors):>7} {elapsed:>9.2f} "
+          f"{args.streams / elapsed:>10.1f} {statistics.median(ttfb):>9.2f} {ttfb[int(len(ttfb) * 0.99) - 1]:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--ttft", type=float, default=0.5)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--servers", default=",".join(SERVERS), help="comma separated: " + ", ".join(SERVERS))
+    args = parser.parse_args()
+
+    config = fake_openrouter.FakeConfig(args.ttft, args.tokens, args.token_interval)
+    upstream_port = fake_openrouter.start_in_thread(config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   OPENROUTER_API_KEY="bench",
+                   OPENROUTER_BASE_URL=f"http://127.0.0.1:{upstream_port}/api/v1",
+                   FLASK_SECRET_KEY="bench",
+                   DATABASE_PATH=os.path.join(tmp, "bench.sqlite3"))
+        print(f"{'server':<6} {'streams':>8} {'completed':>10} {'errors':>7} {'wall s':>9} "
+              f"{'streams/s':>10} {'ttfb p50':>9} {'ttfb p99':>9}")
+        for name in args.servers.split(","):
+            run_server(name, SERVERS[name], env, args)
+    print(f"peak concurrent upstream streams: {config.peak_streams}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""End-to-end benchmark of the web app, with a baseline to catch regressions.
+
+Usage: python bench/bench_suite.py [--scales 100,1000,10000] [--requests 200] [--concurrency 16]
+                                   [--scenarios login,chat,...] [--save-baseline]
+
+For each scale it seeds a throwaway database with that many users (each
+with --sessions chat sessions of --messages messages), boots the app
+under gunicorn against a local fake OpenRouter and a fake SMTP server,
+and runs every scenario below with --concurrency logged-in clients:
+
+  login          POST /login (password check and session cookie)
+  page_index     GET / (desktop page)
+  page_mobile    GET /?mobile=1 (mobile page)
+  history        GET /history
+  sessions_list  GET /sessions
+  sessions_switch, sessions_create, sessions_rename, sessions_delete
+                 POST /sessions/*
+  chat           POST /chat without streaming
+  chat_stream    POST /chat read to the done frame
+  image          POST /image and poll the job until it is done
+  forgot         POST /forgot (mail goes out through the outbox)
+
+and reports requests per second, p50/p99 latency and the peak RSS of the
+server (master, workers and image processes together) while the scenario
+ran. A request counts as an error when it gets an unexpected status or
+the AI service unavailable reply.
+
+Results are compared with --baseline (bench/baseline.json) when it
+exists: a scenario regresses when its throughput drops, or its p99 or
+peak RSS grows, by more than --tolerance (latency also needs to grow by
+more than --slack-ms), or when it has more errors than the baseline.
+Regressions are listed and the exit status is 1.
+--save-baseline writes this run as the new baseline instead. The numbers
+depend on the machine, so record the baseline where you compare.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MYSITE = os.path.join(HERE, "..", "mysite")
+sys.path.insert(0, HERE)
+sys.path.insert(0, MYSITE)
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+import fake_openrouter  # noqa: E402
+import fake_smtp  # noqa: E402
+import flask_app  # noqa: E402
+from bench_streams import free_port, wait_for_port  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+SERVERS = {
+    "wsgi": "gunicorn --workers {workers} --threads 8 --bind 127.0.0.1:{port} flask_app:app",
+    "asgi": "uvicorn asgi:application --workers {workers} --port {port} --log-level warning",
+}
+PASSWORD = "bench"
+UNAVAILABLE = "AI service unavailable"
+SEED_BATCH = 1000  # users written per transaction while seeding
+
+
+def seed(database, n_users, sessions, messages):
+    """n_users accounts on the unlimited tier (so image quota never interferes)"""
+    storage = flask_app.SQLiteStorage(database)
+    credentials = flask_app.CredentialStore(database)
+    password_hash = generate_password_hash(PASSWORD)  # hashing is slow on purpose; one hash serves everyone
+    for start in range(0, n_users, SEED_BATCH):
+        emails = [f"user{i}@gmail.com" for i in range(start, min(n_users, start + SEED_BATCH))]
+        credentials.add_many((email, password_hash) for email in emails)
+        storage.save_all({email: synthetic_user(sessions, messages) for email in emails})
+
+
+def synthetic_user(sessions, messages):
+    user_data = flask_app.new_user_data()
+    user_data["tier"] = "unlimited"
+    for n in range(1, sessions):
+        user_data["sessions"][f"seeded-{n}"] = {"name": f"Chat {n + 1}", "created": "2025-01-01 00:00:00"}
+    for chat_session in user_data["sessions"].values():
+        chat_session["history"] = [
+            {"content": f"seeded message {m} " + "lorem ipsum " * random.randint(1, 40),
+             "sender": "user" if m % 2 == 0 else "bot", "time": "2025-01-01 00:00:00"}
+            for m in range(messages)
+        ]
+    return user_data
+
+
+def process_tree_rss(root):
+    """Resident bytes of root and all of its descendants, from /proc"""
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    total = 0
+    pending = [root]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RSSSampler:
+    """Samples the server's RSS on a thread; take_peak() returns the peak since the previous call"""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = process_tree_rss(self.pid)
+            with self.lock:
+                self.peak = max(self.peak, rss)
+
+    def take_peak(self):
+        rss = process_tree_rss(self.pid)
+        with self.lock:
+            peak, self.peak = max(self.peak, rss), 0
+        return peak
+
+    def stop(self):
+        self.stopped.set()
+
+
+class User:
+    """One logged-in client and what it knows about its sessions"""
+
+    def __init__(self, client, gmail):
+        self.client = client
+        self.gmail = gmail
+        self.sessions = []
+        self.created = []
+        self.reset_emails = []
+
+
+def expect(response, status=200):
+    if response.status_code != status:
+        raise RuntimeError(f"{response.request.method} {response.request.url.path}: HTTP {response.status_code}")
+    return response
+
+
+async def log_in(user):
+    response = await user.client.post("/login", data={"gmail": user.gmail, "password": PASSWORD})
+    expect(response, 302)
+
+
+async def page_index(user, i):
+    expect(await user.client.get("/"))
+
+
+async def page_mobile(user, i):
+    expect(await user.client.get("/", params={"mobile": "1"}))
+
+
+async def history(user, i):
+    expect(await user.client.get("/history"))
+
+
+async def sessions_list(user, i):
+    expect(await user.client.get("/sessions"))
+
+
+async def sessions_switch(user, i):
+    expect(await user.client.post("/sessions/switch", json={"session_id": user.sessions[i % len(user.sessions)]}))
+
+
+async def sessions_create(user, i):
+    response = expect(await user.client.post("/sessions/create", json={"name": f"bench {i}"}))
+    user.created.append(response.json()["session_id"])
+
+
+async def sessions_rename(user, i):
+    expect(await user.client.post("/sessions/rename", json={"session_id": user.sessions[0], "name": f"renamed {i}"}))
+
+
+async def sessions_delete(user, i):
+    expect(await user.client.post("/sessions/delete", json={"session_id": user.created.pop()}))
+
+
+async def chat(user, i):
+    # A distinct message per request, so no reply comes from the response cache
+    response = expect(await user.client.post("/chat", json={"message": f"question {i} from {user.gmail}"}))
+    if response.json()["response"].startswith(UNAVAILABLE):
+        raise RuntimeError("chat: upstream unavailable")
+
+
+async def chat_stream(user, i):
+    body = b""
+    async with user.client.stream("POST", "/chat", json={"message": f"stream {i} from {user.gmail}",
+                                                         "stream": True}) as response:
+        expect(response)
+        async for chunk in response.aiter_bytes():
+            body += chunk
+    if b'"done": true' not in body or b'"error"' in body:
+        raise RuntimeError(f"chat_stream: bad ending {body[-200:]!r}")
+
+
+async def image(user, i, timeout=120):
+    job = expect(await user.client.post("/image", json={"prompt": f"picture {i}"}), 202).json()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = expect(await user.client.get(job["status_url"])).json()
+        if status["status"] == "done":
+            return
+        if status["status"] == "error":
+            raise RuntimeError(f"image job failed: {status}")
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"image job {job['job_id']} did not finish in {timeout}s")
+
+
+async def login(user, i):
+    await log_in(user)
+
+
+async def forgot(user, i):
+    # Reset mail changes the password once delivered, so it goes to accounts nobody logs in as
+    expect(await user.client.post("/forgot", data={"email": user.reset_emails[i % len(user.reset_emails)]}))
+
+
+SCENARIOS = {
+    "login": login,
+    "page_index": page_index,
+    "page_mobile": page_mobile,
+    "history": history,
+    "sessions_list": sessions_list,
+    "sessions_switch": sessions_switch,
+    "sessions_create": sessions_create,
+    "sessions_rename": sessions_rename,
+    "sessions_delete": sessions_delete,  # deletes what sessions_create made, so run after it
+    "chat": chat,
+    "chat_stream": chat_stream,
+    "image": image,
+    "forgot": forgot,
+}
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def summarize(latencies, errors, elapsed, rss):
+    latencies = sorted(latencies) or [0]
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": round((len(latencies) + errors) / elapsed, 2),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_rss_mb": round(rss / 2 ** 20, 1),
+    }
+
+
+async def timed(fn, *args):
+    start = time.perf_counter()
+    try:
+        await fn(*args)
+    except Exception as e:
+        return None, e
+    return time.perf_counter() - start, None
+
+
+async def run_scenario(fn, users, requests):
+    """requests calls of fn, worker w taking calls w, w + len(users), ... so the split is repeatable"""
+    latencies = []
+    errors = []
+
+    async def worker(w):
+        for i in range(w, requests, len(users)):
+            latency, error = await timed(fn, users[w], i)
+            if error is None:
+                latencies.append(latency)
+            else:
+                errors.append(error)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(len(users))))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def drive(base_url, args, n_users, sampler):
+    """Run the chosen scenarios and return {scenario: summary}"""
+    # The first half of the users log in; the second half receive the password resets
+    half = max(1, n_users // 2)
+    pool = random.sample(range(half), min(args.concurrency, half))
+    reset_emails = [f"user{i}@gmail.com" for i in range(half, n_users)] or ["nobody@gmail.com"]
+    # Idle connections are dropped before the server's keep-alive (gunicorn 2s, uvicorn 5s) can close them
+    # under a request, which the client would see as a disconnect
+    limits = httpx.Limits(keepalive_expiry=1)
+    users = [User(httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits), f"user{i}@gmail.com")
+             for i in pool]
+    results = {}
+    try:
+        for user in users:
+            await log_in(user)
+            listing = expect(await user.client.get("/sessions")).json()
+            user.sessions = [s["id"] for s in listing["sessions"]]
+            user.reset_emails = reset_emails
+        sampler.take_peak()
+        for name in args.scenarios.split(","):
+            requests = args.image_requests if name == "image" else args.requests
+            latencies, errors, elapsed = await run_scenario(SCENARIOS[name], users, requests)
+            if errors:
+                print(f"  {name}: {len(errors)} errors, first: {errors[0]!r}")
+            results[name] = summarize(latencies, len(errors), elapsed, sampler.take_peak())
+    finally:
+        await asyncio.gather(*(user.client.aclose() for user in users))
+    return results
+
+
+def run_scale(n_users, args, upstream_port, smtp_port):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, "bench.sqlite3")
+        start = time.perf_counter()
+        seed(database, n_users, args.sessions, args.messages)
+        print(f"seeded {n_users} users in {time.perf_counter() - start:.1f}s")
+
+        rate_limits = os.path.join(tmp, "rate_limits.json")
+        with open(rate_limits, "w") as f:
+            json.dump({}, f)  # the suite measures the app, not the limiter's 429s
+        env = dict(os.environ,
+                   OPENROUTER_API_KEY="bench",
+                   OPENROUTER_BASE_URL=f"http://127.0.0.1:{upstream_port}/api/v1",
+                   FLASK_SECRET_KEY="bench",
+                   DATABASE_PATH=database,
+                   RATE_LIMITS_FILE=rate_limits,
+                   RATE_LIMIT_DATABASE=os.path.join(tmp, "ratelimits.sqlite3"),
+                   IMAGES_DIR=os.path.join(tmp, "images"),
+                   METRICS_DIR=os.path.join(tmp, "metrics"),
+                   SMTP_HOST="127.0.0.1",
+                   SMTP_PORT=str(smtp_port),
+                   SMTP_STARTTLS="0",
+                   SMTP_EMAIL="bench@gmail.com",
+                   LOG_LEVEL="WARNING")
+        port = free_port()
+        command = SERVERS[args.server].format(workers=args.workers, port=port)
+        proc = subprocess.Popen(shlex.split(command), cwd=MYSITE, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        sampler = RSSSampler(proc.pid)
+        try:
+            wait_for_port(port)
+            return asyncio.run(drive(f"http://127.0.0.1:{port}", args, n_users, sampler))
+        finally:
+            sampler.stop()
+            proc.terminate()
+            proc.wait()
+
+
+def compare(results, baseline, args):
+    """Lines describing every scenario that got worse than the baseline"""
+    regressions = []
+    for key, current in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if current["rps"] < before["rps"] * (1 - args.tolerance):
+            regressions.append(f"{key}: throughput {before['rps']} -> {current['rps']} req/s")
+        if (current["p99_ms"] > before["p99_ms"] * (1 + args.tolerance)
+                and current["p99_ms"] - before["p99_ms"] > args.slack_ms):
+            regressions.append(f"{key}: p99 {before['p99_ms']} -> {current['p99_ms']} ms")
+        if current["peak_rss_mb"] > before["peak_rss_mb"] * (1 + args.tolerance):
+            regressions.append(f"{key}: peak RSS {before['peak_rss_mb']} -> {current['peak_rss_mb']} MB")
+        if current["errors"] > before["errors"]:
+            regressions.append(f"{key}: errors {before['errors']} -> {current['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", default="100,1000,10000", help="comma separated user counts")
+    parser.add_argument("--sessions", type=int, default=3, help="chat sessions per seeded user")
+    parser.add_argument("--messages", type=int, default=20, help="messages per seeded session")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--image-requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=16, help="logged-in clients")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--server", default="wsgi", choices=SERVERS)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--ttft", type=float, default=0.2, help="fake upstream seconds before the first token")
+    parser.add_argument("--tokens", type=int, default=50, help="fake upstream tokens per reply")
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--image-size", type=int, default=512, help="fake upstream image width and height")
+    parser.add_argument("--smtp-delay", type=float, default=0.02, help="fake SMTP seconds per message")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="write this run to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative change before a regression")
+    parser.add_argument("--slack-ms", type=float, default=5, help="p99 growth below this is never a regression")
+    args = parser.parse_args()
+
+    upstream = fake_openrouter.FakeConfig(args.ttft, args.tokens, args.token_interval, image_size=args.image_size)
+    upstream_port = fake_openrouter.start_in_thread(upstream)
+    smtp_port = fake_smtp.start_in_thread(fake_smtp.FakeSMTPConfig(delay=args.smtp_delay))
+
+    results = {}
+    for n_users in [int(n) for n in args.scales.split(",")]:
+        scale_results = run_scale(n_users, args, upstream_port, smtp_port)
+        print(f"{'users':>7} {'scenario':<16} {'requests':>8} {'errors':>6} {'req/s':>8} "
+              f"{'p50 ms':>9} {'p99 ms':>9} {'peak RSS MB':>12}")
+        for name, r in scale_results.items():
+            print(f"{n_users:>7} {name:<16} {r['requests']:>8} {r['errors']:>6} {r['rps']:>8.1f} "
+                  f"{r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['peak_rss_mb']:>12.1f}")
+            results[f"{n_users}/{name}"] = r
+
+    if args.save_baseline:
+        settings = {name: value for name, value in vars(args).items()
+                    if name not in ("baseline", "save_baseline", "tolerance", "slack_ms")}
+        with open(args.baseline, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline["results"], args)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        sys.exit(1)
+    print(f"no regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
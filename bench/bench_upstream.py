@@ -0,0 +1,101 @@
+"""Upstream resilience under injected faults.
+
+Usage: python bench/bench_upstream.py [--calls 200] [--concurrency 20] [--ttft 0.2]
+
+Runs streaming chat calls through mysite/upstream.py against the fake
+OpenRouter with faults switched on, once with a plain client (one
+attempt, no hedging, no circuit breaker) and once with the settings
+flask_app uses. For each scenario it reports completed calls, time to first token
+p50/p99 and how many requests reached each model.
+
+  flaky   - 30% of requests fail with a 503
+  down    - the primary model always fails, so its circuit should open
+  stalls  - 10% of requests stall 3s before their first token
+  drops   - 10% of streams are cut off halfway
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "mysite"))
+
+from openai import OpenAI  # noqa: E402
+
+import fake_openrouter  # noqa: E402
+from upstream import Upstream  # noqa: E402
+
+PRIMARY = "primary/model:free"
+FALLBACK = "fallback/model"
+
+SCENARIOS = {
+    "flaky": dict(fail_rate=0.3),
+    "down": dict(down_models=[PRIMARY]),
+    "stalls": dict(stall_rate=0.1, stall=3.0),
+    "drops": dict(drop_rate=0.1),
+}
+
+CLIENTS = {
+    "plain": dict(attempts=1, hedge_after=0, failure_threshold=float("inf")),
+    "resilient": dict(attempts=3, backoff_base=0.5, backoff_max=8.0, hedge_after=1.0,
+                      failure_threshold=5, reset_timeout=30),
+}
+
+
+def delta_text(chunk):
+    return chunk.choices[0].delta.content if chunk.choices else None
+
+
+def one_call(upstream, client):
+    start = time.perf_counter()
+    first = None
+    for _ in upstream.stream(lambda model: client.chat.completions.create(
+            model=model, messages=[{"role": "user", "content": "hi"}], stream=True, timeout=30), delta_text):
+        if first is None:
+            first = time.perf_counter() - start
+    return first
+
+
+def run(scenario, name, args):
+    config = fake_openrouter.FakeConfig(args.ttft, args.tokens, args.token_interval, **SCENARIOS[scenario])
+    port = fake_openrouter.start_in_thread(config)
+    client = OpenAI(api_key="bench", base_url=f"http://127.0.0.1:{port}/api/v1", max_retries=0)
+    upstream = Upstream([PRIMARY, FALLBACK], **CLIENTS[name])
+
+    def call(_):
+        try:
+            return one_call(upstream, client)
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(call, range(args.calls)))
+    ok = sorted(r for r in results if r is not None)
+    ttft = ok or [0]
+    print(f"{scenario:<7} {name:<10} {len(ok):>5}/{args.calls:<5} {statistics.median(ttft):>9.2f} "
+          f"{ttft[int(len(ttft) * 0.99) - 1]:>9.2f} {config.model_requests.get(PRIMARY, 0):>8} "
+          f"{config.model_requests.get(FALLBACK, 0):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ", ".join(SCENARIOS))
+    args = parser.parse_args()
+
+    print(f"{'fault':<7} {'client':<10} {'ok':>11} {'ttft p50':>9} {'ttft p99':>9} {'primary':>8} {'fallback':>9}")
+    for scenario in args.scenarios.split(","):
+        for name in CLIENTS:
+            run(scenario, name, args)
+
+
+if __name__ == "__main__":
+    main()
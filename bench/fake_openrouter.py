@@ -0,0 +1,220 @@
+"""Local stand-in for the OpenRouter chat completions API.
+
+Usage: python bench/fake_openrouter.py [--port 8081] [--ttft 0.5] [--tokens 50] [--token-interval 0.02]
+
+Speaks just enough HTTP/1.1 (keep-alive, chunked SSE) for the OpenAI
+client: POST /api/v1/chat/completions, streaming or not. Requests with
+"modalities": ["image"] get an --image-size pixel square PNG of random
+pixels back as a data URL (about 3 * size^2 bytes before base64),
+failing with a 500 for --image-fail-rate of them. Point the app at it with
+OPENROUTER_BASE_URL=http://127.0.0.1:<port>/api/v1.
+
+Faults for chat requests, to exercise the upstream resilience layer:
+
+  --fail-rate    fraction answered with a 503 after the usual ttft
+  --stall-rate   fraction that wait an extra --stall seconds before the first token
+  --drop-rate    fraction of streams cut off halfway through
+  --down-models  comma separated models that always get a 503
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+
+class FakeConfig:
+    def __init__(self, ttft=0.5, tokens=50, token_interval=0.02, image_fail_rate=0.0,
+                 fail_rate=0.0, stall_rate=0.0, stall=5.0, drop_rate=0.0, down_models=(), image_size=64):
+        self.ttft = ttft
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.image_fail_rate = image_fail_rate
+        self.fail_rate = fail_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.drop_rate = drop_rate
+        self.down_models = set(down_models)
+        self.image_size = image_size
+        self.image_url = None  # built on the first image request
+        self.requests = 0
+        self.image_requests = 0
+        self.model_requests = {}
+        self.active_streams = 0
+        self.peak_streams = 0
+
+
+def png_data_url(width=64, height=64):
+    """A PNG of random pixels, so it does not compress below width * height * 3 bytes; built without PIL"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rng = random.Random(width * height)
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+    png = (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+           + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+    return "data:image/png;base64," + base64.b64encode(png).decode()
+
+
+def completion_chunk(model, content, finish_reason=None):
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {"content": content} if content else {}, "finish_reason": finish_reason}],
+    }
+
+
+async def write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+async def write_chunk(writer, data):
+    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+    await writer.drain()
+
+
+async def image_completion(writer, payload, config):
+    config.image_requests += 1
+    if config.image_url is None:
+        config.image_url = png_data_url(config.image_size, config.image_size)
+    await asyncio.sleep(config.ttft)
+    if random.random() < config.image_fail_rate:
+        await write_response(writer, 500, {"error": {"message": "injected image failure"}})
+        return
+    await write_response(writer, 200, {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "fake"),
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {
+            "role": "assistant", "content": "", "images": [{"type": "image_url", "image_url": {"url": config.image_url}}],
+        }}],
+    })
+
+
+async def chat_completions(writer, payload, config):
+    if "image" in payload.get("modalities", []):
+        return await image_completion(writer, payload, config)
+    model = payload.get("model", "fake")
+    config.model_requests[model] = config.model_requests.get(model, 0) + 1
+    words = [f"tok{i} " for i in range(config.tokens)]
+    await asyncio.sleep(config.ttft)
+    if model in config.down_models or random.random() < config.fail_rate:
+        await write_response(writer, 503, {"error": {"message": "injected upstream failure", "code": 503}})
+        return
+    if random.random() < config.stall_rate:
+        await asyncio.sleep(config.stall)
+
+    if not payload.get("stream"):
+        await write_response(writer, 200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": "stop"}],
+        })
+        return
+
+    config.active_streams += 1
+    config.peak_streams = max(config.peak_streams, config.active_streams)
+    try:
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        drop_at = len(words) // 2 if random.random() < config.drop_rate else None
+        for i, word in enumerate(words):
+            if i == drop_at:
+                writer.transport.abort()
+                return
+            if i:
+                await asyncio.sleep(config.token_interval)
+            await write_chunk(writer, f"data: {json.dumps(completion_chunk(model, word))}\n\n".encode())
+        await write_chunk(writer, f"data: {json.dumps(completion_chunk(model, None, 'stop'))}\n\n".encode())
+        await write_chunk(writer, b"data: [DONE]\n\n")
+        await write_chunk(writer, b"")
+    finally:
+        config.active_streams -= 1
+
+
+async def handle_connection(reader, writer, config):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode().split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            config.requests += 1
+            if method == "POST" and path.endswith("/chat/completions"):
+                await chat_completions(writer, json.loads(body or b"{}"), config)
+            else:
+                await write_response(writer, 404, {"error": {"message": f"No route for {method} {path}"}})
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(config, host="127.0.0.1", port=0, ready=None):
+    server = await asyncio.start_server(lambda r, w: handle_connection(r, w, config), host, port, backlog=4096)
+    if ready is not None:
+        ready(server.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
+
+
+def start_in_thread(config, host="127.0.0.1", port=0):
+    """Run the fake server on a daemon thread and return its port"""
+    started = threading.Event()
+    bound = {}
+
+    def ready(actual_port):
+        bound["port"] = actual_port
+        started.set()
+
+    threading.Thread(target=lambda: asyncio.run(serve(config, host, port, ready)), daemon=True).start()
+    started.wait()
+    return bound["port"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per reply")
+    parser.add_argument("--token-interval", type=float, default=0.02, help="seconds between tokens")
+    parser.add_argument("--image-size", type=int, default=64, help="width and height of generated images")
+    parser.add_argument("--image-fail-rate", type=float, default=0.0, help="fraction of image requests that fail")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of chat requests answered with a 503")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of chat requests that stall")
+    parser.add_argument("--stall", type=float, default=5.0, help="extra seconds before the first token of a stall")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of streams cut off halfway")
+    parser.add_argument("--down-models", default="", help="comma separated models that always fail")
+    args = parser.parse_args()
+
+    config = FakeConfig(args.ttft, args.tokens, args.token_interval, args.image_fail_rate,
+                        args.fail_rate, args.stall_rate, args.stall, args.drop_rate,
+                        [model for model in args.down_models.split(",") if model], args.image_size)
+    print(f"fake OpenRouter on http://{args.host}:{args.port}/api/v1")
+    asyncio.run(serve(config, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
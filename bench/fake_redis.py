@@ -0,0 +1,296 @@
+"""Local stand-in for a Redis server, for the shared state layer.
+
+Usage: python bench/fake_redis.py [--port 6380]
+
+Speaks RESP2 with just the commands RedisState uses: PING, AUTH, SELECT,
+GET, MGET, SET (EX/PX/NX), DEL, WATCH, UNWATCH, MULTI, EXEC, DISCARD,
+RPUSH, LRANGE, LLEN, PEXPIRE, SCAN and FLUSHALL. Every command runs on
+one event loop, so each is atomic, and WATCH/EXEC aborts a transaction
+when a watched key was written (or expired) after WATCH, as Redis does.
+Point the app at it with SHARED_STATE_URL=redis://127.0.0.1:<port>/0.
+"""
+import argparse
+import asyncio
+import re
+import threading
+import time
+
+
+class FakeRedis:
+    def __init__(self):
+        self.dbs = {}  # db -> {key: [value (bytes or list of bytes), expires_at or None]}
+        self.versions = {}  # (db, key) -> writes so far, for WATCH
+        self.commands = 0
+        self.exec_aborted = 0
+
+    def keyspace(self, db):
+        return self.dbs.setdefault(db, {})
+
+    def lookup(self, db, key):
+        entry = self.keyspace(db).get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self.keyspace(db)[key]
+            self.touch(db, key)
+            return None
+        return entry
+
+    def touch(self, db, key):
+        self.versions[(db, key)] = self.versions.get((db, key), 0) + 1
+
+    def version(self, db, key):
+        self.lookup(db, key)  # an expiry counts as a write
+        return self.versions.get((db, key), 0)
+
+
+class Connection:
+    def __init__(self, server):
+        self.server = server
+        self.db = 0
+        self.watched = {}  # key -> version at WATCH
+        self.queued = None  # commands inside MULTI
+
+
+def glob_regex(pattern):
+    """Redis glob (*, ?, [...], backslash escapes) as a compiled regex"""
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            out.append(re.escape(pattern[i + 1]))
+            i += 1
+        elif c == "*":
+            out.append(".*")
+        elif c == "?":
+            out.append(".")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                out.append(re.escape(c))
+            else:
+                out.append("[" + pattern[i + 1:end].replace("\\", "\\\\") + "]")
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile("".join(out) + r"\Z", re.S)
+
+
+class ReplyError(Exception):
+    pass
+
+
+def run(conn, name, args):
+    """Execute one command; returns the reply value"""
+    server = conn.server
+    db = conn.db
+    keys = server.keyspace(db)
+
+    def value(key, kind=bytes):
+        entry = server.lookup(db, key)
+        if entry is None:
+            return None
+        if not isinstance(entry[0], kind):
+            raise ReplyError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return entry[0]
+
+    if name == "PING":
+        return "PONG"
+    if name == "AUTH":
+        return "OK"
+    if name == "SELECT":
+        conn.db = int(args[0])
+        return "OK"
+    if name == "GET":
+        return value(args[0].decode())
+    if name == "MGET":
+        return [value(key.decode()) for key in args]
+    if name == "SET":
+        key, data = args[0].decode(), args[1]
+        options = [arg.decode().upper() for arg in args[2:]]
+        expires = None
+        if "PX" in options:
+            expires = time.time() + int(options[options.index("PX") + 1]) / 1000
+        elif "EX" in options:
+            expires = time.time() + int(options[options.index("EX") + 1])
+        if "NX" in options and server.lookup(db, key) is not None:
+            return None
+        keys[key] = [data, expires]
+        server.touch(db, key)
+        return "OK"
+    if name == "DEL":
+        deleted = 0
+        for key in (arg.decode() for arg in args):
+            if server.lookup(db, key) is not None:
+                del keys[key]
+                server.touch(db, key)
+                deleted += 1
+        return deleted
+    if name == "RPUSH":
+        key = args[0].decode()
+        items = value(key, list)
+        if items is None:
+            items = []
+            keys[key] = [items, None]
+        items.extend(args[1:])
+        server.touch(db, key)
+        return len(items)
+    if name == "LRANGE":
+        items = value(args[0].decode(), list) or []
+        start, stop = int(args[1]), int(args[2])
+        stop = len(items) + stop if stop < 0 else stop
+        start = max(0, len(items) + start if start < 0 else start)
+        return items[start:stop + 1]
+    if name == "LLEN":
+        return len(value(args[0].decode(), list) or [])
+    if name == "PEXPIRE":
+        key = args[0].decode()
+        entry = server.lookup(db, key)
+        if entry is None:
+            return 0
+        entry[1] = time.time() + int(args[1]) / 1000
+        server.touch(db, key)
+        return 1
+    if name == "SCAN":
+        cursor = int(args[0])
+        options = {args[i].decode().upper(): args[i + 1].decode() for i in range(1, len(args) - 1, 2)}
+        count = int(options.get("COUNT", 10))
+        matches = glob_regex(options.get("MATCH", "*"))
+        names = sorted(keys)
+        page = names[cursor:cursor + count]
+        following = cursor + count if cursor + count < len(names) else 0
+        return [str(following).encode(),
+                [key.encode() for key in page if matches.match(key) and server.lookup(db, key) is not None]]
+    if name == "FLUSHALL":
+        for number, space in server.dbs.items():
+            for key in list(space):
+                server.touch(number, key)
+            space.clear()
+        return "OK"
+    raise ReplyError(f"ERR unknown command '{name}'")
+
+
+def dispatch(conn, command):
+    name = command[0].decode().upper()
+    args = command[1:]
+    conn.server.commands += 1
+    if name == "MULTI":
+        if conn.queued is not None:
+            raise ReplyError("ERR MULTI calls can not be nested")
+        conn.queued = []
+        return "OK"
+    if name == "DISCARD":
+        conn.queued = None
+        conn.watched = {}
+        return "OK"
+    if name == "EXEC":
+        if conn.queued is None:
+            raise ReplyError("ERR EXEC without MULTI")
+        queued, conn.queued = conn.queued, None
+        watched, conn.watched = conn.watched, {}
+        if any(conn.server.version(conn.db, key) != version for key, version in watched.items()):
+            conn.server.exec_aborted += 1
+            return None
+        replies = []
+        for queued_name, queued_args in queued:
+            try:
+                replies.append(run(conn, queued_name, queued_args))
+            except ReplyError as e:
+                replies.append(e)
+        return replies
+    if conn.queued is not None:
+        if name == "WATCH":
+            raise ReplyError("ERR WATCH inside MULTI is not allowed")
+        conn.queued.append((name, args))
+        return "QUEUED"
+    if name == "WATCH":
+        for key in (arg.decode() for arg in args):
+            conn.watched.setdefault(key, conn.server.version(conn.db, key))
+        return "OK"
+    if name == "UNWATCH":
+        conn.watched = {}
+        return "OK"
+    return run(conn, name, args)
+
+
+def encode(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, ReplyError):
+        return b"-" + str(reply).encode() + b"\r\n"
+    if isinstance(reply, str):
+        return b"+" + reply.encode() + b"\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.split()  # inline command, e.g. from telnet
+    command = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+async def handle_connection(reader, writer, server):
+    conn = Connection(server)
+    try:
+        while True:
+            command = await read_command(reader)
+            if command is None:
+                break
+            if not command:
+                continue
+            try:
+                reply = dispatch(conn, command)
+            except ReplyError as e:
+                reply = e
+            writer.write(encode(reply))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(server, host="127.0.0.1", port=0, ready=None):
+    listener = await asyncio.start_server(lambda r, w: handle_connection(r, w, server), host, port, backlog=4096)
+    if ready is not None:
+        ready(listener.sockets[0].getsockname()[1])
+    async with listener:
+        await listener.serve_forever()
+
+
+def start_in_thread(server, host="127.0.0.1", port=0):
+    """Run the fake server on a daemon thread and return its port"""
+    started = threading.Event()
+    bound = {}
+
+    def ready(actual_port):
+        bound["port"] = actual_port
+        started.set()
+
+    threading.Thread(target=lambda: asyncio.run(serve(server, host, port, ready)), daemon=True).start()
+    started.wait()
+    return bound["port"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    args = parser.parse_args()
+    print(f"fake Redis on redis://{args.host}:{args.port}/0")
+    asyncio.run(serve(FakeRedis(), args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
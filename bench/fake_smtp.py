@@ -0,0 +1,84 @@
+"""Local stand-in for the SMTP server, built on aiosmtpd.
+
+Usage: python bench/fake_smtp.py [--port 8025] [--fail-rate 0.0]
+
+Accepts every message without TLS or authentication and keeps count of
+connections and deliveries. --fail-rate of messages get a temporary
+451 instead, so the outbox has something to retry. Point the app at it
+with SMTP_HOST=127.0.0.1 SMTP_PORT=<port> SMTP_STARTTLS=0.
+"""
+import argparse
+import asyncio
+import random
+import socket
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+
+
+class FakeSMTPConfig:
+    def __init__(self, fail_rate=0.0, delay=0.0):
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.connections = 0
+        self.delivered = []  # (recipients, message bytes)
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+
+class Handler:
+    def __init__(self, config):
+        self.config = config
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        with self.config.lock:
+            self.config.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.config.delay:
+            await asyncio.sleep(self.config.delay)
+        with self.config.lock:
+            if random.random() < self.config.fail_rate:
+                self.config.rejected += 1
+                return "451 4.3.0 Injected temporary failure"
+            self.config.delivered.append((list(envelope.rcpt_tos), envelope.content))
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_in_thread(config, host="127.0.0.1", port=0):
+    """Run the fake server on its own thread and return its port"""
+    port = port or free_port()
+    Controller(Handler(config), hostname=host, port=port).start()
+    return port
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of messages answered with a 451")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds the server takes per message")
+    args = parser.parse_args()
+
+    config = FakeSMTPConfig(args.fail_rate, args.delay)
+    start_in_thread(config, args.host, args.port)
+    print(f"fake SMTP on {args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"connections {config.connections}, delivered {len(config.delivered)}, rejected {config.rejected}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
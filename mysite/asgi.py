@@ -0,0 +1,298 @@
+# Copyright (c) 2025 Hurairah
+# All Rights Reserved. Proprietary Software.
+# Legal matters handled by parent/guardian until age 18.
+# Governed by Pakistan law (Rawalpindi jurisdiction).
+"""ASGI entry point with an async /chat streaming path.
+
+Run from mysite/ with:  uvicorn asgi:application --workers 2
+
+Streaming POST /chat requests are served on the event loop through one
+pooled, keep-alive AsyncOpenAI client, so a slow completion costs a
+coroutine instead of a worker thread. They share the Flask app's
+chat_upstream failover, circuit breakers and hedging. Each reply is
+produced by a task of its own into a flask_app.Generation, so it is
+finished and stored even if the client disconnects, and a client that
+reconnects to /chat/generations/<id>/events is followed on the loop.
+Image job event streams are also followed on the loop. Every other
+request is handed to the regular Flask app.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+
+import flask_app
+import telemetry
+
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "1000"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "100"))
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "10"))  # threads for the non-streaming Flask routes
+
+IMAGE_JOB_EVENTS_RE = re.compile(r"/image/jobs/([0-9a-f]+)/events")
+GENERATION_EVENTS_RE = re.compile(r"/chat/generations/([0-9a-f]+)/events")
+
+flask_asgi = WSGIMiddleware(flask_app.app, workers=WSGI_THREADS)
+upstream = None
+
+
+def get_upstream():
+    """Shared async client; one bounded connection pool per worker process"""
+    global upstream
+    if upstream is None:
+        import httpx
+        from openai import AsyncOpenAI
+        upstream = AsyncOpenAI(
+            api_key=os.getenv("OPENROUTER_API_KEY"),
+            base_url=flask_app.OPENROUTER_BASE_URL,
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                    keepalive_expiry=30
+                ),
+                timeout=httpx.Timeout(60, connect=10, pool=30)
+            )
+        )
+    return upstream
+
+
+def session_user(scope):
+    """Read the logged-in gmail from Flask's signed session cookie"""
+    app = flask_app.app
+    cookies = SimpleCookie()
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            cookies.load(value.decode("latin-1"))
+    morsel = cookies.get(app.config["SESSION_COOKIE_NAME"])
+    serializer = app.session_interface.get_signing_serializer(app)
+    if morsel is None or serializer is None:
+        return None
+    try:
+        data = serializer.loads(morsel.value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get("gmail")
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+def replay_body(body, receive):
+    """receive() that hands the already-read body to the WSGI app"""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+    return replay
+
+
+async def send_json(send, status, payload, headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), *headers]})
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+
+def encode_headers(headers):
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+
+
+def start_turn(gmail, user_message):
+    user_data = flask_app.get_user_data_with_sessions(gmail)
+    session_id = user_data.get("active_session")
+    if not session_id or session_id not in user_data.get("sessions", {}):
+        return None
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    messages = flask_app.prepare_chat_turn(gmail, user_data, session_id, user_message, timestamp)
+    return session_id, messages, timestamp, flask_app.response_cache_key(user_data, messages)
+
+
+def observe_request(started, route, method, status):
+    telemetry.http_request_seconds.observe(time.perf_counter() - started, route=route, method=method, status=status)
+
+
+async def stream_chat(send, gmail, user_message):
+    started = time.perf_counter()
+    limit = await asyncio.to_thread(flask_app.check_rate_limit, "chat", gmail)
+    limit_headers = encode_headers(flask_app.rate_limit_headers(limit)) if limit else []
+    if limit and not limit["allowed"]:
+        observe_request(started, "/chat", "POST", 429)
+        return await send_json(send, 429, {"error": "Too many requests, please slow down.",
+                                           "retry_after": limit["retry_after"]}, limit_headers)
+
+    turn = await asyncio.to_thread(start_turn, gmail, user_message)
+    if turn is None:
+        observe_request(started, "/chat", "POST", 400)
+        return await send_json(send, 400, {"error": "No active session"})
+
+    observe_request(started, "/chat", "POST", 200)
+    with telemetry.sse_streams_active.track(route="/chat"):
+        await relay_reply(send, gmail, *turn, headers=limit_headers)
+
+
+async def relay_reply(send, gmail, session_id, messages, timestamp, cache_key, headers=()):
+    headers = [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"), *headers]
+    cached_reply = flask_app.response_cache.get(cache_key) if cache_key else None
+    if cached_reply is not None:
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        for frame in flask_app.replay_reply(cached_reply):
+            await send({"type": "http.response.body", "more_body": True, "body": frame.encode()})
+        await send({"type": "http.response.body", "body": b""})
+        await asyncio.to_thread(flask_app.append_message, gmail, session_id,
+                                {"content": cached_reply, "sender": "bot", "time": timestamp})
+        return
+
+    generation = flask_app.generations.start(gmail, session_id)
+    # The task holds the only strong reference the loop would not keep on its own
+    generation.task = asyncio.create_task(produce(generation, messages, timestamp, cache_key))
+    await send({"type": "http.response.start", "status": 200,
+                "headers": headers + [(b"x-generation-id", generation.id.encode())]})
+    await relay_generation(send, generation)
+
+
+async def produce(generation, messages, timestamp, cache_key):
+    """flask_app.run_generation for the event loop"""
+    try:
+        stream_response = flask_app.chat_upstream.astream(lambda model: get_upstream().chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            timeout=60
+        ), flask_app.delta_text, heartbeat=flask_app.SSE_COALESCE_SECONDS)
+        try:
+            async for content in stream_response:
+                if generation.cancelled:
+                    break
+                if content is None:
+                    generation.tick()
+                else:
+                    generation.feed(content)
+        finally:
+            await stream_response.aclose()
+        # Storing the reply blocks on the database, so it runs off the loop
+        await asyncio.to_thread(flask_app.finish_generation, generation, cache_key, timestamp)
+    except Exception as e:
+        await asyncio.to_thread(flask_app.fail_generation, generation, timestamp, e)
+
+
+async def relay_generation(send, generation, last_id=0):
+    """Send a generation's frames after last_id until it is finished; a client going away leaves it running"""
+    async for frames in generation.afollow(last_id):
+        await send({"type": "http.response.body", "more_body": True, "body": frames.encode()})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def stream_generation(send, gmail, generation_id, last_id):
+    generation = flask_app.generations.get(gmail, generation_id)
+    if generation is None:
+        return await send_json(send, 404, {"error": "Generation not found"})
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-generation-id", generation.id.encode()),
+    ]})
+    with telemetry.sse_streams_active.track(route="/chat/generations/<generation_id>/events"):
+        await relay_generation(send, generation, last_id)
+
+
+def last_event_id(scope):
+    """Last-Event-ID of a resuming client, from the header or ?last_event_id="""
+    value = dict(scope.get("headers", [])).get(b"last-event-id", b"").decode("latin-1")
+    if not value:
+        value = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("last_event_id", ["0"])[0]
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return 0
+
+
+async def stream_image_job(send, gmail, job_id):
+    jobs = await asyncio.to_thread(flask_app.get_image_queue)
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None or job["gmail"] != gmail:
+        return await send_json(send, 404, {"error": "Job not found"})
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+    ]})
+    last_status = None
+    deadline = time.time() + flask_app.IMAGE_JOB_TIMEOUT
+    with telemetry.sse_streams_active.track(route="/image/jobs/<job_id>/events"):
+        while True:
+            job = await asyncio.to_thread(jobs.get, job_id)
+            if job["status"] != last_status:
+                last_status = job["status"]
+                await send({"type": "http.response.body", "more_body": True,
+                            "body": flask_app.sse_event(flask_app.image_job_status(job)).encode()})
+            if last_status in ("done", "error") or time.time() > deadline:
+                break
+            await asyncio.sleep(flask_app.IMAGE_QUEUE_POLL)
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            telemetry.registry.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if upstream is not None:
+                await upstream.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/chat":
+        body = await read_body(receive)
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+        user_message = payload.get("message", "")
+        if payload.get("stream") and user_message and user_message != "__CLEAR__":
+            gmail = session_user(scope)
+            if gmail is None:
+                return await send_json(send, 401, {"error": "Unauthorized"})
+            return await stream_chat(send, gmail, user_message)
+        receive = replay_body(body, receive)
+
+    job_events = IMAGE_JOB_EVENTS_RE.fullmatch(scope.get("path", "")) if scope["type"] == "http" else None
+    if job_events and scope["method"] == "GET":
+        gmail = session_user(scope)
+        if gmail is None:
+            return await send_json(send, 401, {"error": "Unauthorized"})
+        return await stream_image_job(send, gmail, job_events.group(1))
+
+    generation_events = GENERATION_EVENTS_RE.fullmatch(scope.get("path", "")) if scope["type"] == "http" else None
+    if generation_events and scope["method"] == "GET":
+        gmail = session_user(scope)
+        if gmail is None:
+            return await send_json(send, 401, {"error": "Unauthorized"})
+        return await stream_generation(send, gmail, generation_events.group(1), last_event_id(scope))
+
+    await flask_asgi(scope, receive, send)
@@ -2,36 +2,90 @@
 # All Rights Reserved. Proprietary Software.
 # Legal matters handled by parent/guardian until age 18.
 # Governed by Pakistan law (Rawalpindi jurisdiction).
+import asyncio
 import re
 import uuid
-import traceback
-from flask import Flask, render_template, request, redirect, session, url_for, jsonify, Response, stream_with_context
-from openai import OpenAI
+from flask import Blueprint, Flask, current_app, render_template, request, redirect, session, url_for, jsonify, Response, stream_with_context, g
+from jinja2 import FileSystemBytecodeCache
 import json
+import logging
 import os
 import time
+import random
+import sqlite3
+import threading
+import click
+import secrets
+import atexit
+import functools
+import math
+import tempfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import base64
+import hashlib
+import zlib
+import queue
 from datetime import datetime, timedelta
-import requests
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from pathlib import Path
 from dotenv import load_dotenv
+from werkzeug.security import generate_password_hash, check_password_hash
 load_dotenv()
 from flask import send_from_directory
-from PIL import Image
-import io
+from upstream import Upstream, UpstreamUnavailable
+from shared_state import open_state
+import telemetry
 
+# openai, requests, smtplib and image_pipeline (Pillow) are imported where they are
+# first used, so booting a worker does not pay for them
 
-
-app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY")
+# Routes live on this blueprint; create_app() builds the app around it
+bp = Blueprint("main", __name__, cli_group=None)
+log = telemetry.configure_logging()
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 USERS_FILE = os.path.join(BASE_DIR, "users.json")
-IMAGES_DIR = os.path.join(BASE_DIR, "user_images")
-os.makedirs(IMAGES_DIR, exist_ok=True)
+CREDENTIALS_FILE = os.path.join(BASE_DIR, "credentials.txt")
+DATABASE_FILE = os.getenv("DATABASE_PATH", os.path.join(BASE_DIR, "database.sqlite3"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite | json
+# User documents, chat history, credentials, rate limits, image job status and streamed replies
+# shared by every node: redis://host:port/0 or file:///path.sqlite3 (see shared_state.py); unset =
+# each node keeps its own. Image files are still written to IMAGES_DIR, which every node must mount.
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL")
+SHARED_STATE_POLL = 0.05  # seconds between checks for frames of a reply streamed by another node
+HISTORY_LIMIT = 400  # messages kept per chat session
+MESSAGE_SEGMENT = 50  # messages per shared state value of a session's log
+HISTORY_PAGE_SIZE = 30  # messages per page sent to the browser
+SYNC_LIMIT = 100  # a client further behind than this is sent the newest page instead of a delta
+COMPACT_INTERVAL = int(os.getenv("COMPACT_INTERVAL", "60"))  # seconds between message log compactions
+USER_CACHE_ENTRIES = int(os.getenv("USER_CACHE_ENTRIES", "10000"))  # cached user documents; 0 disables the cache
+USER_CACHE_BYTES = int(os.getenv("USER_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Seconds update_user() writes may wait to be batched; 0 (write-through) lets every worker read
+# a write as soon as the request that made it returns
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "0"))
+RATE_LIMITS_FILE = os.getenv("RATE_LIMITS_FILE", os.path.join(BASE_DIR, "rate_limits.json"))  # per route and tier; see RateLimiter
+# Limiter state is tiny and disposable, so it lives in shared memory where available
+RATE_LIMIT_DATABASE = os.getenv("RATE_LIMIT_DATABASE", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "hurairahgpt-ratelimits.sqlite3"))
+IMAGES_DIR = os.getenv("IMAGES_DIR", os.path.join(BASE_DIR, "user_images"))
+THUMBS_DIR = os.path.join(IMAGES_DIR, "thumbs")  # content-addressed JPEG thumbnails
+IMAGE_CACHE_DIR = os.path.join(IMAGES_DIR, "cache")  # resized variants served for ?w=
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+IMAGE_WIDTHS = (160, 320, 640, 800, 1280)  # ?w= is rounded up to one of these
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR")  # compiled templates shared by workers; unset = a private temp dir
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # when set, /metrics wants "Authorization: Bearer <token>"
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"  # 0 for a plain local server such as aiosmtpd
+SMTP_IDLE_TIMEOUT = 60  # seconds an unused SMTP connection stays open
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "1"))  # sender threads per process, one SMTP connection each
+OUTBOX_BATCH = 20  # messages claimed and sent together over one connection
+OUTBOX_POLL = 1.0  # seconds between checks for mail queued by other processes
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))  # seconds before the first retry; doubles per attempt, jittered
+OUTBOX_BACKOFF_MAX = 600.0
+OUTBOX_SEND_TIMEOUT = 120  # a message marked sending for longer than this is assumed lost and requeued
+OUTBOX_RETENTION = 7 * 24 * 3600  # undeliverable messages are kept this long
+RESET_PASSWORD_TTL = 24 * 3600  # seconds a temporary password from /forgot can be used
 
 # User tiers and limits
 USER_TIERS = {
@@ -52,20 +106,69 @@ USER_TIERS = {
     }
 }
 
-# Initialize users.json if it doesn't exist
-if not os.path.exists(USERS_FILE):
-    with open(USERS_FILE, "w") as f:
-        json.dump({}, f)
-
 MOBILE_UA_RE = re.compile(r"android|iphone|ipad|ipod|blackberry|iemobile|windows phone|opera mini|mobile", re.I)
 
-client = OpenAI(
-    api_key=os.getenv("OPENROUTER_API_KEY"),
-    base_url=os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
-)
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+client = None
+
+
+def get_client():
+    """OpenRouter client, built on first use"""
+    global client
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(
+            api_key=os.getenv("OPENROUTER_API_KEY"),
+            base_url=OPENROUTER_BASE_URL,
+            max_retries=0  # chat_upstream does the retrying, across models
+        )
+    return client
 
 MODEL = "nvidia/nemotron-3-nano-30b-a3b:free"  # OpenRouter free model (text/chat)
 IMG_MODEL = "bytedance-seed/seedream-4.5"  # Updated image model
+# Tried in order when the model above fails or its circuit is open, e.g. CHAT_FALLBACK_MODELS=a/b:free,c/d
+CHAT_FALLBACK_MODELS = [m for m in os.getenv("CHAT_FALLBACK_MODELS", "").split(",") if m]
+IMG_FALLBACK_MODELS = [m for m in os.getenv("IMG_FALLBACK_MODELS", "").split(",") if m]
+UPSTREAM_ATTEMPTS = int(os.getenv("UPSTREAM_ATTEMPTS", "3"))  # requests per chat turn, hedges included
+UPSTREAM_BACKOFF_BASE = 0.5  # seconds; retries of a failed model wait up to base * 2**attempt, jittered
+UPSTREAM_BACKOFF_MAX = 8.0
+UPSTREAM_HEDGE_AFTER = float(os.getenv("UPSTREAM_HEDGE_AFTER", "4"))  # seconds without a first token before hedging; 0 = never
+BREAKER_FAILURES = 5  # failures in a row that open a model's circuit
+BREAKER_RESET = 30  # seconds an open circuit waits before letting a probe through
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))  # image job threads per web worker process
+IMAGE_QUEUE_POLL = 1.0  # seconds between checks for jobs queued by other processes
+IMAGE_JOB_TIMEOUT = 300  # a running job not heard from for this long is assumed lost and requeued
+IMAGE_JOB_HEARTBEAT = 30  # seconds between the running worker's "still alive" updates of its job
+IMAGE_JOB_RETENTION = 24 * 3600  # finished jobs are kept this long for status lookups
+IMAGE_RESERVATION_TTL = IMAGE_JOB_TIMEOUT * 2  # an unsettled quota reservation lapses after this
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))  # 0 = post-process in the job thread
+IMAGE_VARIANTS = tuple(fmt for fmt in os.getenv("IMAGE_VARIANTS", "webp").split(",") if fmt)  # webp, avif
+
+chat_upstream = Upstream([MODEL] + CHAT_FALLBACK_MODELS, UPSTREAM_ATTEMPTS, UPSTREAM_BACKOFF_BASE,
+                         UPSTREAM_BACKOFF_MAX, UPSTREAM_HEDGE_AFTER, BREAKER_FAILURES, BREAKER_RESET)
+image_upstream = Upstream([IMG_MODEL] + IMG_FALLBACK_MODELS, 2, UPSTREAM_BACKOFF_BASE,
+                          UPSTREAM_BACKOFF_MAX, 0, BREAKER_FAILURES, BREAKER_RESET)
+
+# Prompt token budget per chat model; history beyond it is left out (or summarized)
+MODEL_CONTEXT_BUDGETS = {
+    MODEL: 8000,
+}
+DEFAULT_CONTEXT_BUDGET = 4000
+REPLY_TOKEN_RESERVE = 1000  # room left in the budget for the model's reply
+MESSAGE_TOKEN_OVERHEAD = 4  # role/formatting tokens per message
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "0") == "1"  # summarize history that no longer fits
+SUMMARY_REFRESH_MESSAGES = 20  # re-summarize once this many more messages fall out of the window
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") == "1"  # replay replies to identical opening prompts
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(8 * 1024 * 1024)))
+RESPONSE_CACHE_MESSAGES = 1  # only prompts with at most this many conversation messages are cached
+RESPONSE_CACHE_SKIP = set(os.getenv("RESPONSE_CACHE_SKIP", "funny").split(","))  # personalities that always ask upstream
+SSE_COALESCE_SECONDS = 0.03  # reply deltas closer together than this share an SSE frame...
+SSE_COALESCE_BYTES = 256  # ...until the frame holds this many bytes of text
+GENERATION_BUFFER_FRAMES = 512  # newest frames kept per reply for clients resuming with Last-Event-ID
+GENERATION_TTL = 300  # seconds a finished reply stays resumable from memory (or the shared state)
+GENERATION_CANCEL_POLL = 0.25  # seconds between checks for stops requested through another node
+REPLY_TOKENS_ALPHA = 0.1  # weight of the newest reply in the mean reply length behind chat_tokens_saved_total
 
 PERSONALITIES = {
     "default": "You are a helpful AI assistant.",
@@ -75,17 +178,1149 @@ PERSONALITIES = {
 }
 
 
+class JSONFileStorage:
+    """Legacy backend: every user lives in one users.json document"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load_all(self):
+        try:
+            with open(self.path, "r") as f:
+                data = f.read()
+            telemetry.storage_bytes.inc(len(data), direction="read")
+            return json.loads(data)
+        except:
+            return {}
+
+    def save_all(self, users):
+        # Write to a temp file first so a crash never leaves half a users.json
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        data = json.dumps(users, indent=2)
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        telemetry.storage_bytes.inc(len(data), direction="write")
+
+    def get(self, gmail):
+        return self.load_all().get(gmail)
+
+    def put(self, gmail, user_data):
+        with self.lock:
+            users = self.load_all()
+            users[gmail] = user_data
+            self.save_all(users)
+
+    def update(self, gmail, mutate, default=None, atomic=False):
+        with self.lock:
+            users = self.load_all()
+            user_data = users.get(gmail, default)
+            if user_data is None:
+                return None
+            mutate(user_data)
+            users[gmail] = user_data
+            self.save_all(users)
+            return user_data
+
+    def count(self):
+        return len(self.load_all())
+
+    def append_message(self, gmail, session_id, entry):
+        result = {}
+
+        def append(user_data):
+            chat_session = user_data.setdefault("sessions", {}).setdefault(session_id, {})
+            chat_session["last_seq"] = chat_session.get("last_seq", 0) + 1
+            history = chat_session.setdefault("history", [])
+            history.append(dict(entry, seq=chat_session["last_seq"]))
+            chat_session["history"] = history[-HISTORY_LIMIT:]
+            result["seq"] = chat_session["last_seq"]
+
+        self.update(gmail, append, default={})
+        return result["seq"]
+
+    def get_messages(self, gmail, session_id, limit=HISTORY_LIMIT, before=None):
+        user_data = self.get(gmail) or {}
+        history = user_data.get("sessions", {}).get(session_id, {}).get("history", [])
+        # Entries written before the log existed have no seq; number them by position
+        history = [dict(entry, seq=entry.get("seq", i + 1)) for i, entry in enumerate(history)]
+        if before is not None:
+            history = [entry for entry in history if entry["seq"] < before]
+        return history[-limit:]
+
+    def get_messages_after(self, gmail, session_id, after, limit=SYNC_LIMIT):
+        history = self.get_messages(gmail, session_id)
+        return [entry for entry in history if entry["seq"] > after][:limit]
+
+    def count_messages(self, gmail):
+        user_data = self.get(gmail) or {}
+        return {session_id: len(chat_session.get("history", []))
+                for session_id, chat_session in user_data.get("sessions", {}).items()}
+
+    def session_versions(self, gmail):
+        user_data = self.get(gmail) or {}
+        return {session_id: chat_session.get("last_seq") or len(chat_session.get("history", []))
+                for session_id, chat_session in user_data.get("sessions", {}).items()}
+
+    def session_version(self, gmail, session_id):
+        chat_session = (self.get(gmail) or {}).get("sessions", {}).get(session_id, {})
+        return chat_session.get("last_seq") or len(chat_session.get("history", [])), chat_session.get("cleared_seq", 0)
+
+    def clear_messages(self, gmail, session_id):
+        def clear(user_data):
+            chat_session = user_data.get("sessions", {}).get(session_id)
+            if chat_session is not None:
+                chat_session["last_seq"] = (chat_session.get("last_seq") or len(chat_session.get("history", []))) + 1
+                chat_session["cleared_seq"] = chat_session["last_seq"]
+                chat_session["history"] = []
+
+        self.update(gmail, clear)
+
+    def compact(self, keep):
+        pass  # history is already trimmed on every append
+
+    def rewrite_messages(self, rewrite):
+        """Apply rewrite(entry) to every stored message, saving the ones it changed"""
+        with self.lock:
+            users = self.load_all()
+            changed = 0
+            for user_data in users.values():
+                for chat_session in user_data.get("sessions", {}).values():
+                    changed += sum(1 for entry in chat_session.get("history", []) if rewrite(entry))
+            if changed:
+                self.save_all(users)
+            return changed
+
+
+class SQLiteDatabase:
+    """Per-thread SQLite connections in WAL mode"""
+
+    SYNCHRONOUS = "NORMAL"
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        # One connection per thread, reopened after a fork so workers never share one
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS}")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so everything inside is
+        # atomic across threads and worker processes
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class UserCache:
+    """LRU of serialized user documents, bounded by entry count and total bytes"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # gmail -> [data, version, epoch it was last validated in]
+        self.bytes = 0
+
+    def get(self, gmail):
+        entry = self.entries.get(gmail)
+        if entry is not None:
+            self.entries.move_to_end(gmail)
+        return entry
+
+    def put(self, gmail, data, version, epoch):
+        self.discard(gmail)
+        self.entries[gmail] = [data, version, epoch]
+        self.bytes += len(data)
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, (old_data, _, _) = self.entries.popitem(last=False)
+            self.bytes -= len(old_data)
+
+    def discard(self, gmail):
+        entry = self.entries.pop(gmail, None)
+        if entry is not None:
+            self.bytes -= len(entry[0])
+
+
+class SQLiteStorage(SQLiteDatabase):
+    """One row per user in SQLite (WAL mode), so requests only touch their own user
+
+    With a cache, hot documents are served from memory. Each users row carries a
+    version, and PRAGMA data_version tells us when any other connection has
+    committed, so cached entries are only re-checked (by version alone) after
+    someone else wrote. update() writes are staged and committed in batches
+    every flush_interval seconds; if another worker changed a document in the
+    meantime, the staged mutations are replayed on top of its copy. put()
+    replaces the whole document and always writes through.
+    """
+
+    def __init__(self, path, cache_entries=0, cache_bytes=0, flush_interval=0):
+        super().__init__(path)
+        self.dirty_sessions = set()
+        self.dirty_lock = threading.Lock()
+        self.cache = UserCache(cache_entries, cache_bytes) if cache_entries > 0 else None
+        self.cache_lock = threading.RLock()
+        self.epoch = 0
+        self.pending = {}  # gmail -> staged write waiting for the next flush
+        self.flush_interval = flush_interval
+        self.flusher_pid = None
+        if self.cache is not None:
+            atexit.register(self.flush)
+        # Startup runs whatever `flask migrate` has not applied yet (normally nothing)
+        self.migrate_schema()
+
+    def schema_version(self):
+        return self.connect().execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate_schema(self):
+        """Apply pending SCHEMA_MIGRATIONS once, stamping PRAGMA user_version after each"""
+        applied = []
+        while self.schema_version() < len(SCHEMA_MIGRATIONS):
+            with self.transaction() as conn:
+                # Re-read under the write lock: another worker may have just done this step
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version < len(SCHEMA_MIGRATIONS):
+                    SCHEMA_MIGRATIONS[version](self, conn)
+                    conn.execute(f"PRAGMA user_version = {version + 1}")
+                    applied.append(SCHEMA_MIGRATIONS[version].__name__)
+        return applied
+
+    def load_all(self):
+        self.flush()
+        rows = self.connect().execute("SELECT gmail, data FROM users").fetchall()
+        telemetry.storage_bytes.inc(sum(len(data) for _, data in rows), direction="read")
+        return {gmail: json.loads(data) for gmail, data in rows}
+
+    def save_all(self, users):
+        self.flush()
+        with self.transaction() as conn:
+            for gmail, user_data in users.items():
+                self.write_user(conn, gmail, user_data)
+        self.forget(users)
+
+    def get(self, gmail):
+        if self.cache is None:
+            row = self.connect().execute("SELECT data FROM users WHERE gmail = ?", (gmail,)).fetchone()
+            data = row[0] if row else None
+        else:
+            data = self.cached_data(gmail)
+        if data is None:
+            return None
+        telemetry.storage_bytes.inc(len(data), direction="read")
+        return json.loads(data)
+
+    def cached_data(self, gmail):
+        """Serialized document for gmail, from memory whenever it is still current"""
+        epoch = self.current_epoch()
+        with self.cache_lock:
+            staged = self.pending.get(gmail)
+            if staged is not None:
+                return staged["data"]
+            entry = self.cache.get(gmail)
+            if entry is not None and entry[2] == epoch:
+                return entry[0]
+        conn = self.connect()
+        if entry is not None:
+            row = conn.execute("SELECT version FROM users WHERE gmail = ?", (gmail,)).fetchone()
+            if row and row[0] == entry[1]:
+                with self.cache_lock:
+                    entry[2] = epoch
+                return entry[0]
+        row = conn.execute("SELECT data, version FROM users WHERE gmail = ?", (gmail,)).fetchone()
+        if row is None:
+            return None
+        with self.cache_lock:
+            if gmail in self.pending:
+                return self.pending[gmail]["data"]
+            self.cache.put(gmail, row[0], row[1], epoch)
+        return row[0]
+
+    def current_epoch(self):
+        """Advance the epoch whenever another connection has committed since this thread last looked"""
+        conn = self.connect()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        with self.cache_lock:
+            if getattr(self.local, "data_version", None) != (conn, data_version):
+                self.local.data_version = (conn, data_version)
+                self.epoch += 1
+            return self.epoch
+
+    def put(self, gmail, user_data):
+        # A whole document cannot be replayed over another worker's write without
+        # undoing it, so put() always writes through; targeted changes use update()
+        self.flush()
+        with self.transaction() as conn:
+            self.write_user(conn, gmail, user_data)
+        self.forget([gmail])
+
+    def write_user(self, conn, gmail, user_data):
+        # Legacy documents still carry history inside each session; move it into the log
+        for session_id, chat_session in user_data.get("sessions", {}).items():
+            for entry in chat_session.pop("history", None) or []:
+                self.insert_message(conn, gmail, session_id, entry)
+        data = json.dumps(user_data)
+        conn.execute(
+            "INSERT INTO users (gmail, data, version) VALUES (?, ?, 1) "
+            "ON CONFLICT(gmail) DO UPDATE SET data = excluded.data, version = users.version + 1",
+            (gmail, data)
+        )
+        telemetry.storage_bytes.inc(len(data), direction="write")
+
+    def update(self, gmail, mutate, default=None, atomic=False):
+        """Apply mutate(user_data); atomic=True commits before returning, under the
+        database write lock, for check-and-set changes that must not be replayed"""
+        if self.cache is None or atomic:
+            # Anything this process staged for the user has to land first
+            self.flush()
+            epoch = self.current_epoch() if self.cache is not None else None
+            with self.transaction() as conn:
+                row = conn.execute("SELECT data, version FROM users WHERE gmail = ?", (gmail,)).fetchone()
+                user_data = json.loads(row[0]) if row else default
+                if user_data is None:
+                    return None
+                mutate(user_data)
+                self.write_user(conn, gmail, user_data)
+            if self.cache is not None:
+                with self.cache_lock:
+                    if gmail not in self.pending:
+                        self.cache.put(gmail, json.dumps(user_data), (row[1] if row else 0) + 1, epoch)
+            return user_data
+
+        # In-process updates are serialized here; other workers are reconciled at flush time
+        with self.cache_lock:
+            data = self.cached_data(gmail)
+            user_data = json.loads(data) if data is not None else default
+            if user_data is None:
+                return None
+            mutate(user_data)
+            self.stage(gmail, json.dumps(user_data), mutate)
+            return user_data
+
+    def stage(self, gmail, data, mutate):
+        """Queue a write for the next flush (caller holds cache_lock)"""
+        staged = self.pending.get(gmail)
+        if staged is None:
+            entry = self.cache.get(gmail)
+            staged = self.pending[gmail] = {"base": entry[1] if entry is not None else None, "mutations": []}
+        staged["data"] = data
+        staged["mutations"].append(mutate)
+        if self.flush_interval <= 0:
+            self.flush()
+        elif self.flusher_pid != os.getpid():
+            # One flusher thread per process (threads do not survive a fork)
+            self.flusher_pid = os.getpid()
+            threading.Thread(target=self.flush_forever, daemon=True).start()
+
+    def flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("user write-behind flush failed", extra={"error": str(e)})
+
+    def flush(self):
+        """Commit every staged write in one transaction"""
+        with self.cache_lock:
+            batch, self.pending = self.pending, {}
+            epoch = self.epoch
+        if not batch:
+            return
+        written = {}
+        try:
+            with telemetry.storage_seconds.time(op="flush"), self.transaction() as conn:
+                for gmail, staged in batch.items():
+                    row = conn.execute("SELECT data, version FROM users WHERE gmail = ?", (gmail,)).fetchone()
+                    version = row[1] if row else 0
+                    data = staged["data"]
+                    if row is not None and staged["base"] != version:
+                        # Another worker wrote this user since we read it: replay our changes on its copy
+                        user_data = json.loads(row[0])
+                        for mutate in staged["mutations"]:
+                            mutate(user_data)
+                        data = json.dumps(user_data)
+                    conn.execute(
+                        "INSERT INTO users (gmail, data, version) VALUES (?, ?, ?) "
+                        "ON CONFLICT(gmail) DO UPDATE SET data = excluded.data, version = excluded.version",
+                        (gmail, data, version + 1)
+                    )
+                    written[gmail] = (data, version + 1)
+                    telemetry.storage_bytes.inc(len(data), direction="write")
+        except:
+            with self.cache_lock:
+                # Put the batch back in front of anything staged since
+                for gmail, staged in batch.items():
+                    newer = self.pending.get(gmail)
+                    if newer is not None:
+                        staged["data"] = newer["data"]
+                        staged["mutations"] += newer["mutations"]
+                    self.pending[gmail] = staged
+            raise
+        with self.cache_lock:
+            for gmail, (data, version) in written.items():
+                if gmail in self.pending:
+                    self.pending[gmail]["base"] = version
+                else:
+                    self.cache.put(gmail, data, version, epoch)
+
+    def forget(self, gmails):
+        if self.cache is not None:
+            with self.cache_lock:
+                for gmail in gmails:
+                    self.cache.discard(gmail)
+
+    def count(self):
+        return self.connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def insert_message(self, conn, gmail, session_id, entry):
+        conn.execute(
+            "INSERT INTO message_seqs (gmail, session_id, last_seq) VALUES (?, ?, 1) "
+            "ON CONFLICT(gmail, session_id) DO UPDATE SET last_seq = last_seq + 1",
+            (gmail, session_id)
+        )
+        seq = conn.execute(
+            "SELECT last_seq FROM message_seqs WHERE gmail = ? AND session_id = ?", (gmail, session_id)
+        ).fetchone()[0]
+        data = json.dumps(entry)
+        conn.execute(
+            "INSERT INTO messages (gmail, session_id, seq, data) VALUES (?, ?, ?, ?)",
+            (gmail, session_id, seq, data)
+        )
+        telemetry.storage_bytes.inc(len(data), direction="write")
+        with self.dirty_lock:
+            self.dirty_sessions.add((gmail, session_id))
+        return seq
+
+    def append_message(self, gmail, session_id, entry):
+        """Append one message in O(1) writes, independent of how long the session is"""
+        with self.transaction() as conn:
+            return self.insert_message(conn, gmail, session_id, entry)
+
+    def get_messages(self, gmail, session_id, limit=HISTORY_LIMIT, before=None):
+        # The seq floor enforces retention even before compaction has run
+        rows = self.connect().execute(
+            "SELECT seq, data FROM messages WHERE gmail = ? AND session_id = ? AND seq < ? AND seq > "
+            "COALESCE((SELECT last_seq FROM message_seqs WHERE gmail = ? AND session_id = ?), 0) - ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (gmail, session_id, before or 2 ** 62, gmail, session_id, HISTORY_LIMIT, limit)
+        ).fetchall()
+        telemetry.storage_bytes.inc(sum(len(data) for _, data in rows), direction="read")
+        return [dict(json.loads(data), seq=seq) for seq, data in reversed(rows)]
+
+    def get_messages_after(self, gmail, session_id, after, limit=SYNC_LIMIT):
+        """Oldest-first messages with seq > after, within the retention window"""
+        rows = self.connect().execute(
+            "SELECT seq, data FROM messages WHERE gmail = ? AND session_id = ? AND seq > ? AND seq > "
+            "COALESCE((SELECT last_seq FROM message_seqs WHERE gmail = ? AND session_id = ?), 0) - ? "
+            "ORDER BY seq LIMIT ?",
+            (gmail, session_id, after, gmail, session_id, HISTORY_LIMIT, limit)
+        ).fetchall()
+        telemetry.storage_bytes.inc(sum(len(data) for _, data in rows), direction="read")
+        return [dict(json.loads(data), seq=seq) for seq, data in rows]
+
+    def count_messages(self, gmail):
+        rows = self.connect().execute(
+            "SELECT session_id, COUNT(*) FROM messages WHERE gmail = ? GROUP BY session_id", (gmail,)
+        ).fetchall()
+        return {session_id: min(count, HISTORY_LIMIT) for session_id, count in rows}
+
+    def session_versions(self, gmail):
+        """last_seq of every session: it grows with each message and each clear"""
+        rows = self.connect().execute(
+            "SELECT session_id, last_seq FROM message_seqs WHERE gmail = ?", (gmail,)
+        ).fetchall()
+        return dict(rows)
+
+    def session_version(self, gmail, session_id):
+        """(last_seq, cleared_seq): messages up to cleared_seq were wiped by a clear"""
+        row = self.connect().execute(
+            "SELECT last_seq, cleared_seq FROM message_seqs WHERE gmail = ? AND session_id = ?", (gmail, session_id)
+        ).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def clear_messages(self, gmail, session_id):
+        # The clear takes a seq of its own, so the session's version still moves forward
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE gmail = ? AND session_id = ?", (gmail, session_id))
+            conn.execute(
+                "INSERT INTO message_seqs (gmail, session_id, last_seq, cleared_seq) VALUES (?, ?, 1, 1) "
+                "ON CONFLICT(gmail, session_id) DO UPDATE SET last_seq = last_seq + 1, cleared_seq = last_seq + 1",
+                (gmail, session_id)
+            )
+
+    def rewrite_messages(self, rewrite):
+        """Apply rewrite(entry) to every stored message, saving the ones it changed"""
+        rows = self.connect().execute("SELECT gmail, session_id, seq, data FROM messages").fetchall()
+        changed = 0
+        for gmail, session_id, seq, data in rows:
+            entry = json.loads(data)
+            if rewrite(entry):
+                self.connect().execute(
+                    "UPDATE messages SET data = ? WHERE gmail = ? AND session_id = ? AND seq = ?",
+                    (json.dumps(entry), gmail, session_id, seq)
+                )
+                changed += 1
+        return changed
+
+    def compact(self, keep):
+        """Drop messages that fell out of the retention window of recently written sessions"""
+        with self.dirty_lock:
+            dirty, self.dirty_sessions = self.dirty_sessions, set()
+        conn = self.connect()
+        for gmail, session_id in dirty:
+            conn.execute(
+                "DELETE FROM messages WHERE gmail = ? AND session_id = ? AND seq <= "
+                "(SELECT last_seq FROM message_seqs WHERE gmail = ? AND session_id = ?) - ?",
+                (gmail, session_id, gmail, session_id, keep)
+            )
+
+
+def create_tables(storage, conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS users (gmail TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    # Chat history is an append-only log keyed by (user, session, seq); last_seq
+    # keeps seq monotonic even after a session is cleared
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "gmail TEXT NOT NULL, session_id TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL, "
+        "PRIMARY KEY (gmail, session_id, seq)) WITHOUT ROWID"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS message_seqs ("
+        "gmail TEXT NOT NULL, session_id TEXT NOT NULL, last_seq INTEGER NOT NULL, "
+        "PRIMARY KEY (gmail, session_id))"
+    )
+
+
+def add_user_versions(storage, conn):
+    # Databases created before schema versioning may already have the column
+    if "version" not in [row[1] for row in conn.execute("PRAGMA table_info(users)")]:
+        conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+
+def add_session_clears(storage, conn):
+    if "cleared_seq" not in [row[1] for row in conn.execute("PRAGMA table_info(message_seqs)")]:
+        conn.execute("ALTER TABLE message_seqs ADD COLUMN cleared_seq INTEGER NOT NULL DEFAULT 0")
+
+
+def upgrade_user_documents(storage, conn):
+    upgraded = 0
+    for gmail, data in conn.execute("SELECT gmail, data FROM users").fetchall():
+        user_data = json.loads(data)
+        if upgrade_user_data(user_data):
+            storage.write_user(conn, gmail, user_data)
+            upgraded += 1
+    return upgraded
+
+
+# Applied in order by SQLiteStorage.migrate_schema(); PRAGMA user_version counts those done.
+# Only ever append to this list.
+SCHEMA_MIGRATIONS = [create_tables, add_user_versions, upgrade_user_documents, add_session_clears]
+
+
+class SharedDocuments:
+    """User documents and their message log on the shared state, so every node
+    sees the same tier, quota, sessions and history
+
+    Documents and message logs the shared state does not have yet are
+    copied in from the wrapped storage on first use, so turning
+    SHARED_STATE_URL on needs no migration step. Every update is a
+    compare-and-set on the shared state, so it is atomic across nodes
+    whether or not atomic=True is passed.
+
+    A session's log is msgseqs:<gmail> ({session_id: [last_seq,
+    cleared_seq]} for all of the user's sessions) plus segments of
+    MESSAGE_SEGMENT [seq, entry] pairs under messages:<gmail>:<session>:<n>.
+    An append updates the index and one segment together, and drops the
+    segment that just fell out of the HISTORY_LIMIT window.
+    """
+
+    def __init__(self, storage, state):
+        self.storage = storage
+        self.state = state
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    @staticmethod
+    def key(gmail):
+        return f"user:{gmail}"
+
+    def get(self, gmail):
+        user_data = self.state.get(self.key(gmail))
+        if user_data is None:
+            user_data = self.adopt(gmail)
+        return user_data
+
+    def adopt(self, gmail):
+        """Copy a document this node's storage has into the shared state, unless another node did first"""
+        local = self.storage.get(gmail)
+        if local is None:
+            return None
+        key = self.key(gmail)
+
+        def adopt(values):
+            if values[key] is None:
+                values[key] = local
+            return values[key]
+        return self.state.update([key], adopt)
+
+    def put(self, gmail, user_data):
+        # Legacy documents still carry history inside each session; move it into the message log
+        for session_id, chat_session in user_data.get("sessions", {}).items():
+            for entry in chat_session.pop("history", None) or []:
+                self.append_message(gmail, session_id, entry)
+        key = self.key(gmail)
+        self.state.update([key], lambda values: values.update({key: user_data}))
+
+    def update(self, gmail, mutate, default=None, atomic=False):
+        key = self.key(gmail)
+        default = json.dumps(default) if default is not None else None
+
+        def apply(values):
+            # Starts from a fresh copy on every attempt: the shared state retries on conflicts
+            user_data = values[key]
+            if user_data is None:
+                user_data = self.storage.get(gmail) or (json.loads(default) if default else None)
+            if user_data is not None:
+                mutate(user_data)
+                values[key] = user_data
+            return user_data
+        return self.state.update([key], apply)
+
+    def load_all(self):
+        users = self.storage.load_all()
+        users.update({key[len("user:"):]: user_data for key, user_data in self.state.scan("user:").items()})
+        return users
+
+    def save_all(self, users):
+        for gmail, user_data in users.items():
+            self.put(gmail, user_data)
+
+    def upgrade_documents(self):
+        """upgrade_user_data() on every shared document; returns how many changed"""
+        upgraded = 0
+        for key in self.state.scan("user:"):
+            def upgrade(values, key=key):
+                return values[key] is not None and upgrade_user_data(values[key])
+            upgraded += self.state.update([key], upgrade)
+        return upgraded
+
+    @staticmethod
+    def versions_key(gmail):
+        return f"msgseqs:{gmail}"
+
+    @staticmethod
+    def segment_key(gmail, session_id, seq):
+        return f"messages:{gmail}:{session_id}:{(seq - 1) // MESSAGE_SEGMENT}"
+
+    def segment_keys(self, gmail, session_id, low, high):
+        """Keys of the segments holding seqs low+1 .. high"""
+        if high <= low:
+            return []
+        seqs = [*range(low + 1, high + 1, MESSAGE_SEGMENT), high]
+        return sorted({self.segment_key(gmail, session_id, seq) for seq in seqs})
+
+    def versions(self, gmail):
+        """{session_id: [last_seq, cleared_seq]} for every session of the user"""
+        versions = self.state.get(self.versions_key(gmail))
+        if versions is None:
+            versions = self.adopt_messages(gmail)
+        return versions
+
+    def adopt_messages(self, gmail):
+        """Copy the message log this node's storage has for gmail into the shared state, unless another node did first"""
+        index = self.versions_key(gmail)
+        versions = {}
+        segments = {}
+        for session_id in self.storage.session_versions(gmail):
+            versions[session_id] = list(self.storage.session_version(gmail, session_id))
+            for message in self.storage.get_messages(gmail, session_id, HISTORY_LIMIT):
+                seq = message.pop("seq")
+                segments.setdefault(self.segment_key(gmail, session_id, seq), []).append([seq, message])
+
+        def adopt(values):
+            if values[index] is None:
+                values.update(segments)
+                values[index] = versions
+            return values[index]
+        return self.state.update([index, *segments], adopt)
+
+    def append_message(self, gmail, session_id, entry):
+        index = self.versions_key(gmail)
+        while True:
+            seq = self.versions(gmail).get(session_id, [0, 0])[0] + 1
+            segment = self.segment_key(gmail, session_id, seq)
+            keys = [index, segment]
+            stale = seq - HISTORY_LIMIT - MESSAGE_SEGMENT
+            if stale >= 1:
+                keys.append(self.segment_key(gmail, session_id, stale))
+
+            def append(values):
+                versions = values[index] or {}
+                last, cleared = versions.get(session_id, [0, 0])
+                if self.segment_key(gmail, session_id, last + 1) != segment:
+                    return None  # other appends moved on to the next segment; look again
+                versions[session_id] = [last + 1, cleared]
+                values[index] = versions
+                values[segment] = (values[segment] or []) + [[last + 1, entry]]
+                for key in keys[2:]:
+                    values[key] = None
+                return last + 1
+            appended = self.state.update(keys, append)
+            if appended is not None:
+                return appended
+
+    def read_messages(self, gmail, session_id, low, high):
+        """Messages with low < seq <= high, oldest first"""
+        segments = self.state.get_many(self.segment_keys(gmail, session_id, low, high))
+        messages = sorted(
+            (pair for segment in segments.values() for pair in segment or [] if low < pair[0] <= high),
+            key=lambda pair: pair[0]
+        )
+        return [dict(entry, seq=seq) for seq, entry in messages]
+
+    def get_messages(self, gmail, session_id, limit=HISTORY_LIMIT, before=None):
+        last, cleared = self.session_version(gmail, session_id)
+        high = min(last, before - 1) if before else last
+        # Seqs after the last clear are all messages, so the newest limit of them are a seq range
+        return self.read_messages(gmail, session_id, max(cleared, last - HISTORY_LIMIT, high - limit), high)
+
+    def get_messages_after(self, gmail, session_id, after, limit=SYNC_LIMIT):
+        last, cleared = self.session_version(gmail, session_id)
+        low = max(after, cleared, last - HISTORY_LIMIT)
+        return self.read_messages(gmail, session_id, low, min(last, low + limit))
+
+    def count_messages(self, gmail):
+        return {session_id: min(last - cleared, HISTORY_LIMIT)
+                for session_id, (last, cleared) in self.versions(gmail).items() if last > cleared}
+
+    def session_versions(self, gmail):
+        return {session_id: last for session_id, (last, _) in self.versions(gmail).items()}
+
+    def session_version(self, gmail, session_id):
+        return tuple(self.versions(gmail).get(session_id, (0, 0)))
+
+    def clear_messages(self, gmail, session_id):
+        index = self.versions_key(gmail)
+        while True:
+            last = self.versions(gmail).get(session_id, [0, 0])[0]
+            # What is retained, plus the segment that fell out of the window most recently
+            segments = self.segment_keys(gmail, session_id, max(0, last - HISTORY_LIMIT - MESSAGE_SEGMENT), last)
+
+            def clear(values):
+                versions = values[index] or {}
+                if versions.get(session_id, [0, 0])[0] != last:
+                    return False  # a message arrived in between; look again
+                # The clear takes a seq of its own, so the session's version still moves forward
+                versions[session_id] = [last + 1, last + 1]
+                values[index] = versions
+                for key in segments:
+                    values[key] = None
+                return True
+            if self.state.update([index, *segments], clear):
+                return
+
+    def rewrite_messages(self, rewrite):
+        """rewrite_messages() on this node's storage and on every shared segment"""
+        changed = self.storage.rewrite_messages(rewrite)
+        for key in self.state.scan("messages:"):
+            def apply(values, key=key):
+                return sum(bool(rewrite(entry)) for _, entry in values[key] or [])
+            changed += self.state.update([key], apply)
+        return changed
+
+
+shared_state = None
+shared_state_lock = threading.Lock()
+
+
+def get_shared_state():
+    """The SHARED_STATE_URL backend, opened on first use; None when state stays on this node"""
+    global shared_state
+    if shared_state is None and SHARED_STATE_URL:
+        with shared_state_lock:
+            if shared_state is None:
+                shared_state = open_state(SHARED_STATE_URL)
+    return shared_state
+
+
+storage = None
+storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Return the configured storage backend, creating it on first use"""
+    global storage
+    if storage is None:
+        state = get_shared_state()
+        with storage_lock:
+            if storage is None:
+                if STORAGE_BACKEND == "json":
+                    if state is not None:
+                        # users.json documents carry their own history, which cannot be split off; running
+                        # anyway would quietly give each node its own copy of every user
+                        raise RuntimeError("SHARED_STATE_URL needs the sqlite storage backend")
+                    storage = JSONFileStorage(USERS_FILE)
+                else:
+                    local = SQLiteStorage(DATABASE_FILE, USER_CACHE_ENTRIES, USER_CACHE_BYTES, USER_FLUSH_INTERVAL)
+                    # First start on SQLite: pull in whatever users.json already holds
+                    if local.count() == 0:
+                        migrate_users_json(local)
+                    storage = SharedDocuments(local, state) if state is not None else local
+                    threading.Thread(target=compact_messages_forever, daemon=True).start()
+    return storage
+
+
+def compact_messages_forever():
+    """Background retention: keep only the newest HISTORY_LIMIT messages per session"""
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        try:
+            storage.compact(HISTORY_LIMIT)
+        except Exception as e:
+            log.error("message log compaction failed", extra={"error": str(e)})
+
+
+def load_user(gmail):
+    with telemetry.storage_seconds.time(op="load_user"):
+        return get_storage().get(gmail)
+
+
+def save_user(gmail, user_data):
+    with telemetry.storage_seconds.time(op="save_user"):
+        get_storage().put(gmail, user_data)
+
+
+def update_user(gmail, mutate, default=None, atomic=False):
+    """Atomically apply mutate(user_data) to one stored user and return the result
+
+    Pass atomic=True when mutate makes a decision (such as a quota check) that
+    must be committed across workers before the caller acts on it.
+    """
+    with telemetry.storage_seconds.time(op="update_user_atomic" if atomic else "update_user"):
+        return get_storage().update(gmail, mutate, default, atomic)
+
+
+class CredentialStore(SQLiteDatabase):
+    """Password hashes indexed by normalized email"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.connect().execute(
+            "CREATE TABLE IF NOT EXISTS credentials (email TEXT PRIMARY KEY, password_hash TEXT NOT NULL)"
+        )
+        # Temporary passwords from /forgot, accepted next to the real one until first used
+        self.connect().execute(
+            "CREATE TABLE IF NOT EXISTS password_resets (email TEXT PRIMARY KEY, password_hash TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def get_hash(self, email):
+        row = self.connect().execute(
+            "SELECT password_hash FROM credentials WHERE email = ?", (normalize_email(email),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, email, password_hash):
+        """Register an account; returns False if the email is already taken"""
+        cursor = self.connect().execute(
+            "INSERT OR IGNORE INTO credentials (email, password_hash) VALUES (?, ?)",
+            (normalize_email(email), password_hash)
+        )
+        return cursor.rowcount == 1
+
+    def set_hash(self, email, password_hash):
+        self.connect().execute(
+            "UPDATE credentials SET password_hash = ? WHERE email = ?", (password_hash, normalize_email(email))
+        )
+
+    def add_reset(self, email, password_hash):
+        """Accept password_hash for the account, next to its password, for RESET_PASSWORD_TTL seconds"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM password_resets WHERE expires <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO password_resets (email, password_hash, expires) VALUES (?, ?, ?)",
+                (normalize_email(email), password_hash, now + RESET_PASSWORD_TTL)
+            )
+
+    def use_reset(self, email, password):
+        """If password is the account's pending temporary one, make it the password; returns whether it was"""
+        email = normalize_email(email)
+        row = self.connect().execute(
+            "SELECT password_hash FROM password_resets WHERE email = ? AND expires > ?", (email, time.time())
+        ).fetchone()
+        if row is None or not check_password_hash(row[0], password):
+            return False
+        with self.transaction() as conn:
+            # Single use: only the request that removes the reset switches the password over
+            used = conn.execute(
+                "DELETE FROM password_resets WHERE email = ? AND password_hash = ?", (email, row[0])
+            ).rowcount
+            if used:
+                conn.execute("UPDATE credentials SET password_hash = ? WHERE email = ?", (row[0], email))
+        return used == 1
+
+    def add_many(self, rows):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO credentials (email, password_hash) VALUES (?, ?)",
+                [(normalize_email(email), password_hash) for email, password_hash in rows]
+            )
+
+    def count(self):
+        return self.connect().execute("SELECT COUNT(*) FROM credentials").fetchone()[0]
+
+
+class SharedCredentials:
+    """Password hashes on the shared state, so an account made on one node can sign in on any
+
+    Hashes only this node's store has are copied in on first lookup.
+    """
+
+    def __init__(self, store, state):
+        self.store = store
+        self.state = state
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @staticmethod
+    def key(email):
+        return f"credentials:{normalize_email(email)}"
+
+    @staticmethod
+    def reset_key(email):
+        return f"password_reset:{normalize_email(email)}"
+
+    def get_hash(self, email):
+        password_hash = self.state.get(self.key(email))
+        if password_hash is None:
+            local = self.store.get_hash(email)
+            if local is not None:
+                key = self.key(email)
+
+                def adopt(values):
+                    values[key] = values[key] or local
+                    return values[key]
+                password_hash = self.state.update([key], adopt)
+        return password_hash
+
+    def add(self, email, password_hash):
+        """Register an account; returns False if the email is already taken on any node"""
+        key = self.key(email)
+        local = self.store.get_hash(email)
+
+        def add(values):
+            if values[key] is not None or local is not None:
+                return False
+            values[key] = password_hash
+            return True
+        return self.state.update([key], add)
+
+    def set_hash(self, email, password_hash):
+        key = self.key(email)
+        self.state.update([key], lambda values: values.update({key: password_hash}))
+
+    def add_reset(self, email, password_hash):
+        key = self.reset_key(email)
+        self.state.update([key], lambda values: values.update({key: password_hash}), ttl=RESET_PASSWORD_TTL)
+
+    def use_reset(self, email, password):
+        key, reset_key = self.key(email), self.reset_key(email)
+        reset_hash = self.state.get(reset_key)
+        if reset_hash is None or not check_password_hash(reset_hash, password):
+            return False
+
+        def use(values):
+            if values[reset_key] != reset_hash:
+                return False
+            values[key] = reset_hash
+            values[reset_key] = None
+            return True
+        return self.state.update([key, reset_key], use)
+
+    def add_many(self, rows):
+        for email, password_hash in rows:
+            self.add(email, password_hash)
+
+
+credential_store = None
+
+
+def get_credential_store():
+    """Return the credential store, importing credentials.txt the first time"""
+    global credential_store
+    if credential_store is None:
+        state = get_shared_state()
+        with storage_lock:
+            if credential_store is None:
+                local = CredentialStore(DATABASE_FILE)
+                if local.count() == 0:
+                    import_credentials_txt(local)
+                credential_store = SharedCredentials(local, state) if state is not None else local
+    return credential_store
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+def parse_credentials_line(line):
+    """Split one credentials.txt line into (email, password) using any of the old separators"""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    for sep in [":", ",", " ", "\t"]:
+        if sep in line:
+            parts = [p.strip() for p in line.split(sep, 1)]
+            if len(parts) >= 2 and parts[0] and parts[1]:
+                return parts[0], parts[1]
+    return None
+
+
+def import_credentials_txt(store, path=CREDENTIALS_FILE):
+    """One-time import of plaintext credentials.txt into hashed credentials"""
+    if not os.path.exists(path):
+        return 0
+    rows = []
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            parsed = parse_credentials_line(line)
+            if parsed:
+                rows.append((parsed[0], generate_password_hash(parsed[1])))
+    store.add_many(rows)
+    os.replace(path, path + ".imported")
+    return len(rows)
+
+
+@bp.cli.command("import-credentials")
+@click.option("--path", default=CREDENTIALS_FILE, help="credentials.txt file to import")
+def import_credentials_command(path):
+    """Hash and import credentials.txt into the credential store"""
+    count = import_credentials_txt(get_credential_store(), path)
+    click.echo(f"Imported {count} accounts from {path}")
+
+
+def append_message(gmail, session_id, entry):
+    # Token count is cached on the entry so building a prompt never re-tokenizes history
+    entry.setdefault("tokens", count_tokens(entry.get("content", "")))
+    with telemetry.storage_seconds.time(op="append_message"):
+        return get_storage().append_message(gmail, session_id, entry)
+
+
+def get_session_history(gmail, session_id, limit=HISTORY_LIMIT, before=None):
+    with telemetry.storage_seconds.time(op="get_messages"):
+        return get_storage().get_messages(gmail, session_id, limit, before)
+
+
+def get_history_page(gmail, session_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """One newest-first page of a session; next_cursor pages further back"""
+    # Fetch one extra row to learn whether anything older is left
+    messages = get_session_history(gmail, session_id, limit + 1, before)
+    has_more = len(messages) > limit
+    messages = messages[-limit:]
+    return {
+        "messages": messages,
+        "next_cursor": messages[0]["seq"] if has_more else None
+    }
+
+
+def get_messages_after(gmail, session_id, after):
+    with telemetry.storage_seconds.time(op="get_messages_after"):
+        return get_storage().get_messages_after(gmail, session_id, after)
+
+
+def clear_session_history(gmail, session_id):
+    get_storage().clear_messages(gmail, session_id)
+
+
+def session_etag(session_id, last_seq):
+    """Validator for anything built from one session's messages; last_seq moves on every change"""
+    return f"{session_id}.{last_seq}"
+
+
+def not_modified(etag):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def with_etag(response, etag):
+    # no-cache: the browser keeps the body but asks with If-None-Match every time
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 def load_users():
-    try:
-        with open(USERS_FILE, "r") as f:
-            return json.load(f)
-    except:
-        return {}
+    """Load every user (full scan, only for migrations and admin tasks)"""
+    with telemetry.storage_seconds.time(op="load_users"):
+        return get_storage().load_all()
 
 
 def save_users(users):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users, f, indent=2)
+    with telemetry.storage_seconds.time(op="save_users"):
+        get_storage().save_all(users)
+
+
+def migrate_users_json(target, path=USERS_FILE):
+    """One-shot copy of users.json into the given storage backend"""
+    users = JSONFileStorage(path).load_all()
+    if not users:
+        return 0
+    for user_data in users.values():
+        upgrade_user_data(user_data)
+    target.save_all(users)
+    os.replace(path, path + ".migrated")
+    return len(users)
+
+
+@bp.cli.command("migrate-users")
+@click.option("--path", default=USERS_FILE, help="users.json file to import")
+def migrate_users_command(path):
+    """Import users.json into the configured storage backend"""
+    if STORAGE_BACKEND == "json":
+        click.echo("Storage backend is already users.json, nothing to migrate")
+        return
+    count = migrate_users_json(get_storage(), path)
+    click.echo(f"Migrated {count} users from {path}")
+
+
+@bp.cli.command("migrate")
+def migrate_command():
+    """Bring the database and every user document up to the current schema"""
+    target = get_storage()
+    if STORAGE_BACKEND == "json":
+        users = target.load_all()
+        changed = [gmail for gmail, user_data in users.items() if upgrade_user_data(user_data)]
+        if changed:
+            target.save_all(users)
+        click.echo(f"Upgraded {len(changed)} user documents to schema version {USER_SCHEMA_VERSION}")
+        return
+    applied = target.migrate_schema()
+    # Also sweep documents written since the stamp, e.g. by workers still on older code
+    target.flush()
+    with target.transaction() as conn:
+        upgraded = upgrade_user_documents(target, conn)
+    if isinstance(target, SharedDocuments):
+        upgraded += target.upgrade_documents()
+    click.echo(f"Applied {len(applied)} migrations ({', '.join(applied) or 'none pending'}); "
+               f"schema version {target.schema_version()}, {upgraded} user documents upgraded")
 
 
 def migrate_user_to_sessions(user_data):
@@ -142,29 +1377,8 @@ def migrate_to_tier_system(user_data):
     return user_data
 
 
-def get_user_data_with_sessions(gmail):
-    """Get user data and ensure it has sessions structure"""
-    users = load_users()
-    user_data = users.get(gmail, {
-        "sessions": {},
-        "active_session": None,
-        "theme": "dark",
-        "personality": "default",
-        "tier": "free",  # Default tier
-        "image_usage": {
-            "last_reset": datetime.now().isoformat(),
-            "count": 0
-        },
-        "upgrade_history": []
-    })
-
-    # Migrate sessions if needed
-    user_data = migrate_user_to_sessions(user_data)
-    
-    # Migrate to tier system if needed
-    user_data = migrate_to_tier_system(user_data)
-
-    # Ensure active_session exists and is valid
+def ensure_active_session(user_data):
+    """Point active_session at an existing session, creating one if there are none"""
     if not user_data.get("active_session") or user_data["active_session"] not in user_data.get("sessions", {}):
         # Create default session if none exists
         if not user_data.get("sessions"):
@@ -172,7 +1386,6 @@ def get_user_data_with_sessions(gmail):
             user_data["sessions"] = {
                 session_id: {
                     "name": "Chat 1",
-                    "history": [],
                     "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 }
             }
@@ -180,21 +1393,84 @@ def get_user_data_with_sessions(gmail):
         else:
             # Use first available session
             user_data["active_session"] = list(user_data["sessions"].keys())[0]
+    return user_data
+
+
+# User document migrations, in order; a document's schema_version is how many it has had.
+# Only ever append to this list.
+USER_MIGRATIONS = [migrate_user_to_sessions, migrate_to_tier_system, ensure_active_session]
+USER_SCHEMA_VERSION = len(USER_MIGRATIONS)
+
+
+def upgrade_user_data(user_data):
+    """Apply the migrations this document has not had yet; True if it changed"""
+    version = user_data.get("schema_version", 0)
+    if version >= USER_SCHEMA_VERSION:
+        return False
+    for migrate in USER_MIGRATIONS[version:]:
+        migrate(user_data)
+    user_data["schema_version"] = USER_SCHEMA_VERSION
+    return True
+
+
+def new_user_data():
+    """Fresh user record with one empty chat session"""
+    session_id = str(uuid.uuid4())
+    return {
+        "sessions": {
+            session_id: {
+                "name": "Chat 1",
+                "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            }
+        },
+        "active_session": session_id,
+        "theme": "dark",
+        "personality": "default",
+        "tier": "free",
+        "image_usage": {
+            "last_reset": datetime.now().isoformat(),
+            "count": 0
+        },
+        "upgrade_history": [],
+        "schema_version": USER_SCHEMA_VERSION
+    }
 
-    users[gmail] = user_data
-    save_users(users)
 
+def get_user_data_with_sessions(gmail):
+    """Get user data with its sessions structure; a pure read, nothing is saved"""
+    user_data = load_user(gmail)
+    if user_data is None:
+        return new_user_data()
+    # Documents `flask migrate` has not reached yet are upgraded in memory only
+    upgrade_user_data(user_data)
+    ensure_active_session(user_data)
     return user_data
 
 
-def get_active_session_history(user_data):
-    """Get history from active session"""
+def update_sessions(gmail, mutate):
+    """Apply mutate(user_data) to a user's sessions and commit it before returning,
+    so whichever worker serves the next request sees it; mutate may run more than once"""
+    def apply(user_data):
+        upgrade_user_data(user_data)
+        ensure_active_session(user_data)
+        mutate(user_data)
+    return update_user(gmail, apply, default=new_user_data(), atomic=True)
+
+
+def get_session_metadata(user_data):
+    """Session names and creation times only, without any history"""
+    return {
+        session_id: {"name": chat_session.get("name"), "created": chat_session.get("created")}
+        for session_id, chat_session in user_data.get("sessions", {}).items()
+    }
+
+
+def get_active_session_history(gmail, user_data):
+    """Get the newest page of history from the active session"""
     active_id = user_data.get("active_session")
-    if not active_id:
-        return []
-    sessions = user_data.get("sessions", {})
-    active_session = sessions.get(active_id, {})
-    return active_session.get("history", [])
+    if not active_id or active_id not in user_data.get("sessions", {}):
+        return {"messages": [], "next_cursor": None}
+    return get_history_page(gmail, active_id)
 
 
 def can_generate_image(user_data):
@@ -205,6 +1481,9 @@ def can_generate_image(user_data):
     # Get user's limits
     limit = USER_TIERS.get(tier, USER_TIERS["free"])["images_per_8hrs"]
     
+    # Images still being generated count against the limit too
+    reserved = len(active_reservations(image_usage))
+    
     # Check reset time (8 hours)
     last_reset_str = image_usage.get("last_reset")
     if last_reset_str:
@@ -215,8 +1494,8 @@ def can_generate_image(user_data):
             # Reset if 8 hours have passed
             if time_since_reset.total_seconds() >= 8 * 3600:
                 return {
-                    "allowed": True,
-                    "remaining": limit,
+                    "allowed": reserved < limit,
+                    "remaining": max(0, limit - reserved),
                     "next_reset": datetime.now() + timedelta(hours=8),
                     "reset_seconds": 8 * 3600,
                     "tier": tier
@@ -226,7 +1505,7 @@ def can_generate_image(user_data):
             pass
     
     # Check current count
-    current_count = image_usage.get("count", 0)
+    current_count = image_usage.get("count", 0) + reserved
     remaining = max(0, limit - current_count)
     
     # Calculate next reset time
@@ -243,8 +1522,63 @@ def can_generate_image(user_data):
     }
 
 
-def increment_image_count(user_data):
-    """Increment user's image count and handle reset logic"""
+def active_reservations(image_usage):
+    """Reservations not yet committed or released; stale ones (crashed worker) lapse"""
+    cutoff = time.time() - IMAGE_RESERVATION_TTL
+    return {rid: at for rid, at in image_usage.get("reserved", {}).items() if at > cutoff}
+
+
+def reserve_image_quota(gmail):
+    """Atomically take one image from the user's quota
+
+    Returns (reservation_id, limit_info, user_data); reservation_id is None
+    when the limit is reached. Every reservation must end in
+    commit_image_quota() or release_image_quota().
+    """
+    outcome = {}
+
+    def reserve(user_data):
+        # Shared state re-runs this on a conflicting write; only the last run counts
+        outcome.clear()
+        migrate_to_tier_system(user_data)
+        image_usage = reset_image_window(user_data)
+        image_usage["reserved"] = active_reservations(image_usage)
+        outcome["limit_info"] = can_generate_image(user_data)
+        if outcome["limit_info"]["allowed"]:
+            outcome["id"] = uuid.uuid4().hex
+            image_usage["reserved"][outcome["id"]] = time.time()
+
+    user_data = update_user(gmail, reserve, default=new_user_data(), atomic=True)
+    return outcome.get("id"), outcome["limit_info"], user_data
+
+
+def commit_image_quota(gmail, reservation_id):
+    """Turn a reservation into a used image; returns (user_data, charged)
+
+    A reservation that is already gone (committed by another run of the same
+    job, or lapsed) is not charged again.
+    """
+    outcome = {}
+
+    def commit(user_data):
+        reserved = user_data.setdefault("image_usage", {}).get("reserved", {})
+        outcome["charged"] = reserved.pop(reservation_id, None) is not None
+        if outcome["charged"]:
+            increment_image_count(user_data)
+
+    user_data = update_user(gmail, commit, default=new_user_data(), atomic=True)
+    return user_data, outcome["charged"]
+
+
+def release_image_quota(gmail, reservation_id):
+    """Give a reservation back, e.g. after the upstream call failed"""
+    def release(user_data):
+        user_data.setdefault("image_usage", {}).get("reserved", {}).pop(reservation_id, None)
+    return update_user(gmail, release, atomic=True)
+
+
+def reset_image_window(user_data):
+    """Start a new 8 hour window if the current one has ended; returns image_usage"""
     image_usage = user_data.get("image_usage", {})
     
     # Check if we need to reset
@@ -267,74 +1601,274 @@ def increment_image_count(user_data):
         image_usage["last_reset"] = datetime.now().isoformat()
         image_usage["count"] = 0
     
+    user_data["image_usage"] = image_usage
+    return image_usage
+
+
+def increment_image_count(user_data):
+    """Increment user's image count and handle reset logic"""
+    image_usage = reset_image_window(user_data)
+    
     # Increment count
     image_usage["count"] = image_usage.get("count", 0) + 1
-    user_data["image_usage"] = image_usage
     
     return user_data
 
 
-def send_email(to_email, subject, body):
-    sender_email = os.getenv("SMTP_EMAIL")
-    sender_password = os.getenv("SMTP_PASSWORD")
-
+class Outbox(SQLiteDatabase):
+    """Outgoing email queued in SQLite, so requests never wait on SMTP"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id TEXT PRIMARY KEY,
+                to_email TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                temp_password TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self.connect().execute("CREATE INDEX IF NOT EXISTS email_outbox_due ON email_outbox (status, next_attempt)")
+
+    def enqueue(self, to_email, subject, body, temp_password=None):
+        """Queue a message; temp_password is accepted for the account once it is delivered"""
+        message_id = uuid.uuid4().hex
+        now = time.time()
+        self.connect().execute(
+            "INSERT INTO email_outbox (id, to_email, subject, body, temp_password, status, next_attempt, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (message_id, to_email, subject, body, temp_password, now, now, now)
+        )
+        return message_id
+
+    def claim(self, limit):
+        """Mark up to limit due messages as sending and return them"""
+        now = time.time()
+        with self.transaction() as conn:
+            # Messages left sending by a worker that died go back in the queue
+            conn.execute(
+                "UPDATE email_outbox SET status = 'queued' WHERE status = 'sending' AND updated < ?",
+                (now - OUTBOX_SEND_TIMEOUT,)
+            )
+            rows = conn.execute(
+                "SELECT id, to_email, subject, body, temp_password, attempts FROM email_outbox "
+                "WHERE status = 'queued' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            conn.executemany("UPDATE email_outbox SET status = 'sending', updated = ? WHERE id = ?",
+                             [(now, row[0]) for row in rows])
+        return [{"id": row[0], "to_email": row[1], "subject": row[2], "body": row[3],
+                 "temp_password": row[4], "attempts": row[5]} for row in rows]
+
+    def sent(self, message_id):
+        # Delivered mail is not kept; the body may hold a temporary password
+        self.connect().execute("DELETE FROM email_outbox WHERE id = ?", (message_id,))
+
+    def retry(self, message, error, permanent=False):
+        """Schedule another attempt with backoff; returns False once the message is given up on"""
+        attempts = message["attempts"] + 1
+        now = time.time()
+        if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+            self.connect().execute(
+                "UPDATE email_outbox SET status = 'failed', body = '', temp_password = NULL, attempts = ?, error = ?, "
+                "updated = ? WHERE id = ?",
+                (attempts, error, now, message["id"])
+            )
+            return False
+        delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+        self.connect().execute(
+            "UPDATE email_outbox SET status = 'queued', attempts = ?, next_attempt = ?, error = ?, updated = ? WHERE id = ?",
+            (attempts, now + delay, error, now, message["id"])
+        )
+        return True
+
+    def counts(self):
+        return dict(self.connect().execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall())
+
+    def purge(self, max_age):
+        """Forget undeliverable messages older than max_age seconds"""
+        self.connect().execute(
+            "DELETE FROM email_outbox WHERE status = 'failed' AND updated < ?", (time.time() - max_age,)
+        )
+
+
+class SMTPConnection:
+    """One authenticated SMTP session, reused across sends and reopened when it drops or idles out"""
+
+    def __init__(self, host, port, username=None, password=None, starttls=True, idle_timeout=SMTP_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self.last_used = 0
+        self.opened = 0  # connections made so far
+
+    def open(self):
+        import smtplib
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            server.starttls()
+        if self.username and self.password:
+            server.login(self.username, self.password)
+        self.server = server
+        self.opened += 1
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def close_if_idle(self):
+        if self.server is not None and time.monotonic() - self.last_used > self.idle_timeout:
+            self.close()
+
+    def send(self, msg):
+        import smtplib
+        self.close_if_idle()
+        for attempt in range(2):
+            if self.server is None:
+                self.open()
+            try:
+                self.server.send_message(msg)
+                break
+            except smtplib.SMTPServerDisconnected:
+                # The server may have hung up on the idle connection; reconnect once
+                self.server = None
+                if attempt:
+                    raise
+        self.last_used = time.monotonic()
+
+
+def build_email(to_email, subject, body):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
     msg = MIMEMultipart()
-    msg["From"] = sender_email
+    msg["From"] = os.getenv("SMTP_EMAIL")
     msg["To"] = to_email
     msg["Subject"] = subject
     msg.attach(MIMEText(body, "plain"))
+    return msg
 
-    try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.send_message(msg)
-        server.quit()
-        return True, "Email sent successfully."
-    except Exception as e:
-        return False, str(e)
 
-
-def find_credentials(email_to_find):
-    path = Path(BASE_DIR) / "credentials.txt"
-    path.touch(exist_ok=True)
-    text = path.read_text(encoding="utf-8", errors="ignore")
-    for line in text.splitlines():
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
-        for sep in [":", ",", " ", "\t"]:
-            if sep in line:
-                parts = [p.strip() for p in line.split(sep, 1)]
-                if len(parts) >= 2 and parts[0].lower() == email_to_find.lower():
-                    return parts[1]
+def smtp_rejected(error):
+    """None if error broke the connection, else whether the server refused the message for good"""
+    import smtplib
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return error.smtp_code >= 500
     return None
 
 
-def retry_request(func, retries=3, delay=1, fallback="Unavailable"):
-    last_error = None
-    for attempt in range(retries):
+outbox = None
+outbox_ready = threading.Event()
+
+
+def get_outbox():
+    """Return the email outbox, starting this process's sender threads on first use"""
+    global outbox
+    if outbox is None:
+        with storage_lock:
+            if outbox is None:
+                outbox = Outbox(DATABASE_FILE)
+                for _ in range(OUTBOX_WORKERS):
+                    threading.Thread(target=run_outbox_forever, daemon=True).start()
+    return outbox
+
+
+def queue_email(to_email, subject, body, temp_password=None):
+    message_id = get_outbox().enqueue(to_email, subject, body, temp_password)
+    outbox_ready.set()
+    return message_id
+
+
+def send_outbox_batch(smtp, batch):
+    """Send a claimed batch over smtp, requeueing what could not be delivered"""
+    for i, message in enumerate(batch):
         try:
-            return func()
+            smtp.send(build_email(message["to_email"], message["subject"], message["body"]))
         except Exception as e:
-            last_error = e
-            if attempt < retries - 1:
-                time.sleep(delay)
-            else:
-                # Log the error on the last attempt with full traceback
-                print(f"Error after {retries} attempts: {type(e).__name__}: {str(e)}")
-                print(f"Traceback: {traceback.format_exc()}")
-    return fallback
+            error = f"{type(e).__name__}: {str(e)}"
+            log.warning("email send failed", extra={"to": message["to_email"], "attempt": message["attempts"] + 1,
+                                                    "error": error})
+            rejected = smtp_rejected(e)
+            if rejected is not None:
+                outbox.retry(message, error, permanent=rejected)
+                continue
+            # The connection is gone; the rest of the batch waits for the next attempt too
+            smtp.close()
+            for unsent in batch[i:]:
+                outbox.retry(unsent, error)
+            return
+        outbox.sent(message["id"])
+        if message["temp_password"]:
+            get_credential_store().add_reset(message["to_email"], generate_password_hash(message["temp_password"]))
+
+
+def run_outbox_forever():
+    """Worker loop: send due mail in batches over one long-lived SMTP connection"""
+    smtp = SMTPConnection(SMTP_HOST, SMTP_PORT, os.getenv("SMTP_EMAIL"), os.getenv("SMTP_PASSWORD"), SMTP_STARTTLS)
+    while True:
+        try:
+            batch = outbox.claim(OUTBOX_BATCH)
+        except Exception as e:
+            log.error("outbox claim failed", extra={"error": str(e)})
+            batch = []
+        if not batch:
+            smtp.close_if_idle()
+            outbox_ready.wait(OUTBOX_POLL)
+            outbox_ready.clear()
+            if random.random() < 0.01:
+                outbox.purge(OUTBOX_RETENTION)
+            continue
+        send_outbox_batch(smtp, batch)
 
 
 def excontext():
     return f" your in an app called hurairahgpt. website is talktohurairah.com your developed by hurairah and hurairah is a solo develeper building and mantaining this project you can contect us at hurairahgpt.devteam@gmail.com. He is a male"
 
 
-@app.route("/")
+@bp.before_app_request
+def start_request_timer():
+    telemetry.registry.start()
+    g.request_started = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        telemetry.http_request_seconds.observe(time.perf_counter() - started, route=route,
+                                               method=request.method, status=response.status_code)
+    return response
+
+
+@bp.route("/metrics")
+def metrics():
+    """Prometheus scrape endpoint, merged across this server's worker processes"""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(telemetry.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/")
 def root():
     if "gmail" not in session:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     ua = request.headers.get("User-Agent", "")
     is_mobile = bool(MOBILE_UA_RE.search(ua))
@@ -345,8 +1879,8 @@ def root():
         is_mobile = False
 
     user_data = get_user_data_with_sessions(session["gmail"])
-    history = get_active_session_history(user_data)
-    sessions_list = user_data.get("sessions", {})
+    history_page = get_active_session_history(session["gmail"], user_data)
+    sessions_list = get_session_metadata(user_data)
     active_session_id = user_data.get("active_session")
     
     # Get image generation limits info
@@ -356,51 +1890,158 @@ def root():
     if is_mobile:
         return render_template("moindex.html",
                                gmail=session["gmail"],
-                               history=history,
+                               history=history_page["messages"],
+                               history_cursor=history_page["next_cursor"],
                                theme=user_data["theme"],
                                sessions=sessions_list,
                                active_session=active_session_id,
+                               pending_generation=generations.running(session["gmail"], active_session_id),
                                tier=user_data.get("tier", "free"),
                                tier_info=tier_info,
                                image_limits=image_limits)
     return render_template("index.html",
                            gmail=session["gmail"],
-                           history=history,
+                           history=history_page["messages"],
+                           history_cursor=history_page["next_cursor"],
                            theme=user_data["theme"],
                            sessions=sessions_list,
                            active_session=active_session_id,
+                           pending_generation=generations.running(session["gmail"], active_session_id),
                            tier=user_data.get("tier", "free"),
                            tier_info=tier_info,
                            image_limits=image_limits)
 
 
-@app.route("/robots.txt")
+@bp.route("/robots.txt")
 def robots():
     return send_from_directory(".", "robots.txt")
 
 
-@app.route("/images/<filename>")
+IMAGE_NAME_RE = re.compile(r"([0-9a-f]{32})\.(png|webp|avif)")
+
+
+def negotiate_image_format(img_id, requested, resized=False):
+    """Best format for this request: a PNG URL may be answered with AVIF/WebP if accepted"""
+    if requested != "png":
+        return requested
+    for fmt in ("avif", "webp"):
+        if request.accept_mimetypes.quality(f"image/{fmt}") <= 0:
+            continue
+        # Resized variants are encoded on demand; originals only if processing made one
+        if resized and fmt in IMAGE_VARIANTS and image_pipeline().supported_variants([fmt]):
+            return fmt
+        if not resized and os.path.exists(os.path.join(IMAGES_DIR, f"{img_id}.{fmt}")):
+            return fmt
+    return "png"
+
+
+def cached_image_width(requested):
+    """Round a ?w= request up to the nearest width we keep on disk"""
+    for width in IMAGE_WIDTHS:
+        if requested <= width:
+            return width
+    return IMAGE_WIDTHS[-1]
+
+
+def resized_image_path(img_id, width, fmt):
+    """Path of a resized variant, generating it on first request"""
+    path = os.path.join(IMAGE_CACHE_DIR, f"{img_id}-w{width}.{fmt}")
+    if os.path.exists(path):
+        # Record the hit in atime (mtime stays put so Last-Modified is stable)
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+        return path
+    source = os.path.join(IMAGES_DIR, f"{img_id}.png")
+    if not os.path.exists(source):
+        return None
+    with open(source, "rb") as f:
+        img_data = f.read()
+    with telemetry.image_stage_seconds.time(stage="resize"):
+        resized = run_in_image_pool(image_pipeline().resize_image, img_data, width, fmt)
+    ensure_image_dirs()
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(resized)
+    os.replace(tmp_path, path)
+    evict_image_cache()
+    return path
+
+
+def evict_image_cache(max_bytes=None):
+    """Delete least recently served resized variants until the cache fits in max_bytes"""
+    max_bytes = IMAGE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    total = 0
+    ensure_image_dirs()
+    for entry in os.scandir(IMAGE_CACHE_DIR):
+        if entry.name.endswith(".tmp"):
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_atime, stat.st_size, entry.path))
+        total += stat.st_size
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def send_immutable(directory, filename, **kwargs):
+    """Serve a file whose URL never changes content: cache it for a year"""
+    # The name identifies the bytes, so it doubles as the ETag
+    response = send_from_directory(directory, filename, max_age=31536000, etag=filename, **kwargs)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@bp.route("/images/<filename>")
 def serve_image(filename):
-    return send_from_directory(IMAGES_DIR, filename)
+    match = IMAGE_NAME_RE.fullmatch(filename)
+    if match is None:
+        return send_from_directory(IMAGES_DIR, filename)
+    img_id, requested = match.groups()
+    width = request.args.get("w", type=int)
+    fmt = negotiate_image_format(img_id, requested, resized=bool(width))
+
+    if width:
+        path = resized_image_path(img_id, cached_image_width(width), fmt)
+        if path is None:
+            return jsonify({"error": "Not found"}), 404
+        response = send_immutable(IMAGE_CACHE_DIR, os.path.basename(path))
+    else:
+        response = send_immutable(IMAGES_DIR, f"{img_id}.{fmt}")
+    if requested == "png":
+        response.vary.add("Accept")
+    return response
+
 
+@bp.route("/images/thumb/<thumb_id>")
+def serve_thumbnail(thumb_id):
+    if not re.fullmatch(r"[0-9a-f]{64}", thumb_id):
+        return jsonify({"error": "Not found"}), 404
+    # Thumbnails are content-addressed, so a given URL never changes
+    return send_immutable(THUMBS_DIR, f"{thumb_id}.jpg")
 
-@app.route("/deletedata")
+
+@bp.route("/deletedata")
 def deletedata():
     return render_template("deletedata.html")
 
 
-@app.route("/slipt")
+@bp.route("/slipt")
 def slipt():
     return render_template("slipt.html")
 
 
-@app.route("/main")
+@bp.route("/main")
 def main_index():
     if "gmail" not in session:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     user_data = get_user_data_with_sessions(session["gmail"])
-    history = get_active_session_history(user_data)
-    sessions_list = user_data.get("sessions", {})
+    history_page = get_active_session_history(session["gmail"], user_data)
+    sessions_list = get_session_metadata(user_data)
     active_session_id = user_data.get("active_session")
     
     # Get image generation limits info
@@ -409,16 +2050,18 @@ def main_index():
     
     return render_template("index.html",
                            gmail=session["gmail"],
-                           history=history,
+                           history=history_page["messages"],
+                           history_cursor=history_page["next_cursor"],
                            theme=user_data["theme"],
                            sessions=sessions_list,
                            active_session=active_session_id,
+                           pending_generation=generations.running(session["gmail"], active_session_id),
                            tier=user_data.get("tier", "free"),
                            tier_info=tier_info,
                            image_limits=image_limits)
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         gmail = request.form.get("gmail", "").strip()
@@ -430,68 +2073,30 @@ def login():
         # Handle guest account
         if gmail.lower() == "guest@gmail.com" and password == "guest":
             session["gmail"] = "guest@gmail.com"
-            users = load_users()
-            if "guest@gmail.com" not in users:
-                session_id = str(uuid.uuid4())
-                users["guest@gmail.com"] = {
-                    "sessions": {
-                        session_id: {
-                            "name": "Chat 1",
-                            "history": [],
-                            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                    },
-                    "active_session": session_id,
-                    "theme": "dark",
-                    "personality": "default",
-                    "tier": "free",
-                    "image_usage": {
-                        "last_reset": datetime.now().isoformat(),
-                        "count": 0
-                    },
-                    "upgrade_history": []
-                }
-                save_users(users)
-            return redirect(url_for("root"))
+            if load_user("guest@gmail.com") is None:
+                # Only creates the document; never overwrites one another request just made
+                update_user("guest@gmail.com", lambda user_data: None, default=new_user_data(), atomic=True)
+            return redirect(url_for("main.root"))
 
         # Regular account login
-        stored_pw = find_credentials(gmail)
-        if not stored_pw:
+        password_hash = get_credential_store().get_hash(gmail)
+        if not password_hash:
             return render_template("login.html", error="Account not found. Please sign up first.")
 
-        if stored_pw != password:
+        # A temporary password from /forgot works too, and replaces the old one when first used
+        if not check_password_hash(password_hash, password) and not get_credential_store().use_reset(gmail, password):
             return render_template("login.html", error="Incorrect password.")
 
         # success
         session["gmail"] = gmail
-        users = load_users()
-        if gmail not in users:
-            session_id = str(uuid.uuid4())
-            users[gmail] = {
-                "sessions": {
-                    session_id: {
-                        "name": "Chat 1",
-                        "history": [],
-                        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                },
-                "active_session": session_id,
-                "theme": "dark",
-                "personality": "default",
-                "tier": "free",
-                "image_usage": {
-                    "last_reset": datetime.now().isoformat(),
-                    "count": 0
-                },
-                "upgrade_history": []
-            }
-            save_users(users)
-        return redirect(url_for("root"))
+        if load_user(gmail) is None:
+            update_user(gmail, lambda user_data: None, default=new_user_data(), atomic=True)
+        return redirect(url_for("main.root"))
 
     return render_template("login.html")
 
 
-@app.route("/signup", methods=["GET", "POST"])
+@bp.route("/signup", methods=["GET", "POST"])
 def signup():
     if request.method == "POST":
         gmail = request.form.get("gmail", "").strip()
@@ -500,54 +2105,1011 @@ def signup():
         if not gmail or not password:
             return render_template("signup.html", error="Please fill out all fields.")
 
-        credentials_path = os.path.join(BASE_DIR, "credentials.txt")
-        os.makedirs(os.path.dirname(credentials_path), exist_ok=True)
-
-        # Check if the user already exists
-        existing_pw = find_credentials(gmail)
-        if existing_pw:
+        # Register the new account (fails if the user already exists)
+        if not get_credential_store().add(gmail, generate_password_hash(password)):
             return render_template("signup.html", error="Account already exists. Please log in.")
 
-        # Register the new account
-        with open(credentials_path, "a", encoding="utf-8") as f:
-            f.write(f"{gmail}:{password}\n")
-
         # Add new user record with sessions structure
-        users = load_users()
-        session_id = str(uuid.uuid4())
-        users[gmail] = {
-            "sessions": {
-                session_id: {
-                    "name": "Chat 1",
-                    "history": [],
-                    "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-            },
-            "active_session": session_id,
-            "theme": "dark",
-            "personality": "default",
-            "tier": "free",
-            "image_usage": {
-                "last_reset": datetime.now().isoformat(),
-                "count": 0
-            },
-            "upgrade_history": []
-        }
-        save_users(users)
+        save_user(gmail, new_user_data())
 
         session["gmail"] = gmail
-        return redirect(url_for("root"))
+        return redirect(url_for("main.root"))
 
     return render_template("signup.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.pop("gmail", None)
-    return redirect(url_for("login"))
+    return redirect(url_for("main.login"))
+
+
+tokenizer = None
+
+
+def count_tokens(text):
+    """Token count of text; exact with tiktoken installed, otherwise ~4 chars per token"""
+    global tokenizer
+    if tokenizer is None:
+        try:
+            import tiktoken
+            tokenizer = tiktoken.get_encoding("cl100k_base").encode
+        except ImportError:
+            tokenizer = False
+    if tokenizer:
+        return len(tokenizer(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def entry_tokens(entry):
+    tokens = entry.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(entry.get("content", ""))
+    return tokens + MESSAGE_TOKEN_OVERHEAD
+
+
+def select_context(gmail, session_id, budget):
+    """Newest history that fits in budget tokens.
+
+    Reads the log newest-first one page at a time and stops as soon as the
+    budget is spent, so the cost is bounded by the budget rather than by the
+    length of the session. Returns (entries oldest-first, seq of the newest
+    message left out or None)."""
+    selected = []
+    used = 0
+    before = None
+    while True:
+        page = get_session_history(gmail, session_id, HISTORY_PAGE_SIZE, before)
+        for entry in reversed(page):
+            used += entry_tokens(entry)
+            if used > budget:
+                return selected[::-1], entry["seq"]
+            selected.append(entry)
+        if len(page) < HISTORY_PAGE_SIZE:
+            return selected[::-1], None
+        before = page[0]["seq"]
+
+
+def build_chat_messages(user_data, history, user_message, summary=None):
+    """System prompt, stored history and the new message in OpenAI format"""
+    user_personality = user_data.get("personality", "default")
+    system_content = PERSONALITIES.get(user_personality, PERSONALITIES["default"]) + "\n\n" + "\n".join([
+        f"Today is {datetime.now().strftime('%A, %B %d, %Y')}.",
+        excontext()
+    ])
+
+    messages = [{"role": "system", "content": system_content}]
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+    for entry in history:
+        role = "user" if entry["sender"] == "user" else "assistant"
+        messages.append({"role": role, "content": entry["content"]})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def build_context(gmail, user_data, session_id, user_message):
+    """Prompt for a new message, trimmed to the model's token budget"""
+    chat_session = user_data.get("sessions", {}).get(session_id, {})
+    summary = chat_session.get("summary") if CONTEXT_SUMMARY else None
+
+    messages = build_chat_messages(user_data, [], user_message, summary)
+    budget = MODEL_CONTEXT_BUDGETS.get(MODEL, DEFAULT_CONTEXT_BUDGET) - REPLY_TOKEN_RESERVE
+    budget -= sum(count_tokens(m["content"]) + MESSAGE_TOKEN_OVERHEAD for m in messages)
+
+    history, dropped_seq = select_context(gmail, session_id, budget)
+    if dropped_seq is None:
+        summary = None  # everything fits, the summary would only repeat it
+    elif CONTEXT_SUMMARY and dropped_seq - chat_session.get("summary_seq", 0) >= SUMMARY_REFRESH_MESSAGES:
+        schedule_summary(gmail, session_id, dropped_seq)
+    return build_chat_messages(user_data, history, user_message, summary)
+
+
+summaries_running = set()
+summaries_lock = threading.Lock()
 
 
-@app.route("/chat", methods=["POST"])
+def schedule_summary(gmail, session_id, upto_seq):
+    """Refresh a session's rolling summary in the background"""
+    with summaries_lock:
+        if (gmail, session_id) in summaries_running:
+            return
+        summaries_running.add((gmail, session_id))
+    threading.Thread(target=refresh_summary, args=(gmail, session_id, upto_seq), daemon=True).start()
+
+
+def refresh_summary(gmail, session_id, upto_seq):
+    """Fold the messages up to upto_seq into the session's cached summary"""
+    try:
+        user_data = load_user(gmail) or {}
+        chat_session = user_data.get("sessions", {}).get(session_id)
+        if chat_session is None:
+            return
+        since_seq = chat_session.get("summary_seq", 0)
+        older = [e for e in get_session_history(gmail, session_id, HISTORY_LIMIT, upto_seq + 1) if e["seq"] > since_seq]
+
+        # Keep the summarizer's own prompt inside the budget too
+        budget = MODEL_CONTEXT_BUDGETS.get(MODEL, DEFAULT_CONTEXT_BUDGET) - REPLY_TOKEN_RESERVE
+        transcript = []
+        for entry in reversed(older):
+            budget -= entry_tokens(entry)
+            if budget < 0:
+                break
+            transcript.append(f"{entry['sender']}: {entry['content']}")
+        transcript.reverse()
+
+        previous = chat_session.get("summary")
+        prompt = (f"Previous summary: {previous}\n\n" if previous else "") + "\n".join(transcript)
+        response = chat_upstream.call(lambda model: get_client().chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "Summarize this conversation in a short paragraph. Keep names, facts and decisions."},
+                {"role": "user", "content": prompt}
+            ],
+            timeout=30
+        ))
+        summary = response.choices[0].message.content
+
+        def store_summary(user_data):
+            stored = user_data.get("sessions", {}).get(session_id)
+            if stored is not None and stored.get("summary_seq", 0) < upto_seq:
+                stored["summary"] = summary
+                stored["summary_seq"] = upto_seq
+
+        update_user(gmail, store_summary)
+    except Exception as e:
+        log.warning("summary refresh failed", extra={"gmail": gmail, "session_id": session_id,
+                                                      "error": f"{type(e).__name__}: {str(e)}"})
+    finally:
+        with summaries_lock:
+            summaries_running.discard((gmail, session_id))
+
+
+def prepare_chat_turn(gmail, user_data, session_id, user_message, timestamp):
+    """Build the upstream prompt for a new message and record the message in history"""
+    messages = build_context(gmail, user_data, session_id, user_message)
+
+    # Save user message immediately
+    append_message(gmail, session_id, {"content": user_message, "sender": "user", "time": timestamp})
+    return messages
+
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def sse_frame(event_id, payload):
+    return f"id: {event_id}\ndata: {json.dumps(payload)}\n\n"
+
+
+class ReplyEncoder:
+    """SSE frames for one streamed reply
+
+    A delta arriving at least window seconds after the previous frame goes
+    out at once; deltas that follow faster are held until max_bytes of text
+    are waiting or tick() finds the window has passed. Frames carry
+    sequential event ids. The reply ends with a done frame holding only
+    its UTF-8 length and CRC-32, which the browser checks against the text
+    it assembled.
+    """
+
+    def __init__(self, window=SSE_COALESCE_SECONDS, max_bytes=SSE_COALESCE_BYTES):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.parts = []  # the whole reply so far
+        self.pending = []  # deltas not sent yet
+        self.pending_bytes = 0
+        self.last_sent = float("-inf")
+        self.event_id = 0
+        self.text_id = 0  # id of the newest chunk frame
+
+    def frame(self, payload):
+        self.event_id += 1
+        return sse_frame(self.event_id, payload)
+
+    def feed(self, text, now=None):
+        """The frame to send after this delta, or "" while it is held"""
+        now = time.monotonic() if now is None else now
+        self.parts.append(text)
+        self.pending.append(text)
+        self.pending_bytes += len(text.encode())
+        if self.pending_bytes >= self.max_bytes or now - self.last_sent >= self.window:
+            return self.flush(now)
+        return ""
+
+    def tick(self, now=None):
+        """Frame of the held deltas once the window has passed, or "" if none is due"""
+        now = time.monotonic() if now is None else now
+        if self.pending and now - self.last_sent >= self.window:
+            return self.flush(now)
+        return ""
+
+    def flush(self, now=None):
+        if not self.pending:
+            return ""
+        text = "".join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_sent = time.monotonic() if now is None else now
+        frame = self.frame({"chunk": text})
+        self.text_id = self.event_id
+        return frame
+
+    def reply(self):
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def sent_text(self):
+        """Text of the chunk frames sent so far, up to event id text_id"""
+        reply = self.reply()
+        held = len("".join(self.pending))
+        return reply[:len(reply) - held]
+
+    def done(self, stopped=False):
+        data = self.reply().encode()
+        payload = {"done": True, "length": len(data), "crc32": zlib.crc32(data)}
+        if stopped:
+            payload["stopped"] = True
+        return self.flush() + self.frame(payload)
+
+    def error(self, message):
+        return self.frame({"done": True, "error": message})
+
+
+def tracked_stream(route, events):
+    """Pass events through, counted in the sse_streams_active gauge while open"""
+    with telemetry.sse_streams_active.track(route=route):
+        yield from events
+
+
+def delta_text(chunk):
+    """The text a streamed completion chunk adds, if any"""
+    if chunk.choices:
+        return getattr(chunk.choices[0].delta, "content", None)
+    return None
+
+
+class ResponseCache:
+    """Replies by prompt fingerprint, expiring after ttl and evicted LRU by total bytes"""
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires, reply)
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.discard(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, reply):
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (time.time() + self.ttl, reply)
+            self.bytes += len(reply)
+            while self.entries and self.bytes > self.max_bytes:
+                _, (_, old_reply) = self.entries.popitem(last=False)
+                self.bytes -= len(old_reply)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_BYTES)
+
+
+def normalize_prompt_text(role, text):
+    if role == "system":
+        # The date line is the only part of the system prompt that changes day to day
+        text = re.sub(r"Today is [^.]*\.", "", text)
+    return " ".join(text.split()).casefold()
+
+
+def response_cache_key(user_data, messages):
+    """Fingerprint of a prompt whose reply may be shared, or None if it should not be cached"""
+    if not RESPONSE_CACHE or user_data.get("personality", "default") in RESPONSE_CACHE_SKIP:
+        return None
+    system = [m for m in messages if m["role"] == "system"]
+    conversation = [m for m in messages if m["role"] != "system"]
+    # Longer conversations (or a summary of one) make the reply depend on more than the key
+    if len(system) > 1 or len(conversation) > RESPONSE_CACHE_MESSAGES:
+        return None
+    fingerprint = json.dumps([MODEL] + [[m["role"], normalize_prompt_text(m["role"], m["content"])] for m in messages])
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+class Generation:
+    """One streamed reply, produced on its own thread or task whether or not anyone is reading
+
+    The producer feeds deltas in; frames go into a ring buffer of the newest
+    GENERATION_BUFFER_FRAMES. Followers (the original request, or a client
+    reconnecting with Last-Event-ID) read from the buffer. A follower that
+    fell behind the buffer gets one reset frame with all the text so far.
+
+    cancel() asks the producer to stop; it checks at every chunk and
+    heartbeat, closes the upstream stream and stores what it has.
+
+    With shared state, frames and the outcome are also copied to it (see
+    GenerationMirror), so any node can serve a reconnecting client.
+    """
+
+    def __init__(self, gmail, session_id, buffer_frames=GENERATION_BUFFER_FRAMES):
+        self.id = uuid.uuid4().hex
+        self.gmail = gmail
+        self.session_id = session_id
+        self.encoder = ReplyEncoder()
+        self.frames = deque(maxlen=buffer_frames)  # (event id, frame)
+        self.status = "running"  # running, done, stopped or error
+        self.error = None
+        self.tokens = 0  # chunks received from upstream, about one token each
+        self.cancelled = False
+        self.settled = False  # the producer is storing a complete reply; too late to cancel
+        self.finished_at = None
+        self.task = None  # the producing thread or asyncio task
+        self.mirror = None  # GenerationMirror copying this reply to the shared state
+        self.cond = threading.Condition()
+        self.waiters = []  # (loop, future) of followers on an event loop
+
+    def publish(self, frame):
+        """Buffer a frame and wake the followers (caller holds cond)"""
+        if frame:
+            self.frames.append((self.encoder.event_id, frame))
+            if self.mirror is not None:
+                self.mirror.frame(self, self.encoder.event_id, frame)
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, []
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+    def feed(self, text):
+        with self.cond:
+            self.tokens += 1
+            self.publish(self.encoder.feed(text))
+
+    def tick(self):
+        with self.cond:
+            self.publish(self.encoder.tick())
+
+    def reply(self):
+        with self.cond:
+            return self.encoder.reply()
+
+    def finish(self):
+        with self.cond:
+            self.publish(self.encoder.flush())
+            self.status = "done"
+            self.finished_at = time.time()
+            self.publish(self.encoder.done())
+            self.ended()
+
+    def cancel(self):
+        """Ask the producer to stop; False if the reply is already complete"""
+        with self.cond:
+            if self.status != "running" or self.settled:
+                return False
+            self.cancelled = True
+            return True
+
+    def settle(self):
+        """Called by the producer before storing a complete reply; False if it was cancelled first"""
+        with self.cond:
+            if not self.cancelled:
+                self.settled = True
+            return self.settled
+
+    def stop(self):
+        """End a cancelled reply with what was received"""
+        with self.cond:
+            self.publish(self.encoder.flush())
+            self.status = "stopped"
+            self.finished_at = time.time()
+            self.publish(self.encoder.done(stopped=True))
+            self.ended()
+
+    def fail(self, message):
+        with self.cond:
+            self.status = "error"
+            self.error = message
+            self.finished_at = time.time()
+            self.publish(self.encoder.error(message))
+            self.ended()
+
+    def ended(self):
+        if self.mirror is not None:
+            self.mirror.ended(self)
+
+    def frames_after(self, last_id):
+        """Frames a follower that has seen last_id still needs, and whether that is all (caller holds cond)"""
+        frames = [frame for event_id, frame in self.frames if event_id > last_id]
+        oldest = self.frames[0][0] if self.frames else self.encoder.event_id + 1
+        if last_id < oldest - 1 and last_id < self.encoder.text_id:
+            text_id = self.encoder.text_id
+            reset = sse_frame(text_id, {"chunk": self.encoder.sent_text(), "reset": True})
+            frames = [reset] + [frame for event_id, frame in self.frames if event_id > text_id]
+        return frames, self.status != "running"
+
+    def follow(self, last_id=0):
+        """Frames after last_id as they are produced, until the reply is finished"""
+        while True:
+            with self.cond:
+                frames, finished = self.frames_after(last_id)
+                if not frames and not finished:
+                    self.cond.wait()
+                    continue
+                last_id = self.encoder.event_id
+            yield "".join(frames)
+            if finished:
+                return
+
+    async def afollow(self, last_id=0):
+        """follow() for the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.cond:
+                frames, finished = self.frames_after(last_id)
+                if not frames and not finished:
+                    future = loop.create_future()
+                    self.waiters.append((loop, future))
+                else:
+                    last_id = self.encoder.event_id
+            if not frames and not finished:
+                await future
+                continue
+            yield "".join(frames)
+            if finished:
+                return
+
+    def summary(self):
+        result = {"id": self.id, "status": self.status, "session_id": self.session_id}
+        if self.status in ("done", "stopped"):
+            result["reply"] = self.reply()
+        elif self.status == "error":
+            result["error"] = self.error
+        return result
+
+
+def generation_key(generation_id):
+    return f"generation:{generation_id}"
+
+
+def running_generation_key(gmail, session_id):
+    return f"generation:running:{gmail}:{session_id}"
+
+
+class RemoteGeneration:
+    """A reply another node is producing, followed through the shared state
+
+    Offers what the routes use of a Generation: follow(), afollow(),
+    summary(), cancel() and status. Followers poll every SHARED_STATE_POLL
+    seconds; the mirrored frames are never trimmed, so no reset is needed.
+    """
+
+    def __init__(self, state, meta):
+        self.state = state
+        self.meta = meta
+        self.id = meta["id"]
+        self.gmail = meta["gmail"]
+        self.session_id = meta["session_id"]
+        self.key = generation_key(self.id)
+        self.frames_key = f"{self.key}:frames"
+
+    @property
+    def status(self):
+        return self.meta["status"]
+
+    def poll(self, index, last_id):
+        """Mirrored frames from list index on that come after last_id: (frames, last_id, index, finished)"""
+        entries = self.state.items(self.frames_key, index)
+        finished = False
+        if not entries:
+            meta = self.state.get(self.key)
+            # Gone means expired, e.g. because the producing node died
+            finished = meta is None or meta["status"] != "running"
+            if meta is not None:
+                self.meta = meta
+            if finished:
+                # Frames are mirrored before the outcome, so anything still missing is there now
+                entries = self.state.items(self.frames_key, index)
+        frames = [frame for event_id, frame in entries if event_id > last_id]
+        last_id = max([last_id] + [event_id for event_id, _ in entries])
+        return frames, last_id, index + len(entries), finished
+
+    def follow(self, last_id=0):
+        index = 0
+        while True:
+            frames, last_id, index, finished = self.poll(index, last_id)
+            if frames or finished:
+                yield "".join(frames)
+            if finished:
+                return
+            if not frames:
+                time.sleep(SHARED_STATE_POLL)
+
+    async def afollow(self, last_id=0):
+        index = 0
+        while True:
+            frames, last_id, index, finished = await asyncio.to_thread(self.poll, index, last_id)
+            if frames or finished:
+                yield "".join(frames)
+            if finished:
+                return
+            if not frames:
+                await asyncio.sleep(SHARED_STATE_POLL)
+
+    def summary(self):
+        return {name: value for name, value in self.meta.items() if name not in ("gmail", "cancel")}
+
+    def cancel(self):
+        """Ask the producing node to stop; it checks every GENERATION_CANCEL_POLL seconds"""
+        def request_stop(values):
+            meta = values[self.key]
+            if meta is None or meta["status"] != "running":
+                return False
+            meta["cancel"] = True
+            self.meta = meta
+            return True
+        return self.state.update([self.key], request_stop, ttl=GENERATION_TTL)
+
+
+class GenerationMirror:
+    """Copies this process's generations to the shared state for the other nodes
+
+    Producers only queue; one thread per process writes, in order, with the
+    frames that piled up sent as one append, so a reply never waits on the
+    network. The same thread picks up stops requested through other nodes.
+    """
+
+    def __init__(self, state, ttl):
+        self.state = state
+        self.ttl = ttl
+        self.queue = queue.Queue()
+        self.running = {}  # generation id -> Generation, still producing here
+        self.polled = 0
+        self.writer_pid = None
+
+    def put(self, item):
+        if self.writer_pid != os.getpid():
+            # One writer thread per process (threads do not survive a fork)
+            self.writer_pid = os.getpid()
+            threading.Thread(target=self.write_forever, daemon=True).start()
+        self.queue.put(item)
+
+    def started(self, generation):
+        self.put(("start", generation, {"id": generation.id, "gmail": generation.gmail,
+                                        "session_id": generation.session_id, "status": "running"}))
+
+    def frame(self, generation, event_id, frame):
+        self.put(("frame", generation, [event_id, frame]))
+
+    def ended(self, generation):
+        self.put(("end", generation, dict(generation.summary(), gmail=generation.gmail)))
+
+    def write_forever(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=GENERATION_CANCEL_POLL)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+                self.poll_cancels()
+            except Exception as e:
+                log.error("mirroring replies to the shared state failed", extra={"error": str(e)})
+
+    def write(self, batch):
+        i = 0
+        while i < len(batch):
+            kind, generation, value = batch[i]
+            key = generation_key(generation.id)
+            if kind == "frame":
+                frames = [value]
+                while i + 1 < len(batch) and batch[i + 1][0] == "frame" and batch[i + 1][1] is generation:
+                    i += 1
+                    frames.append(batch[i][2])
+                self.state.append(f"{key}:frames", frames, ttl=self.ttl)
+            else:
+                running_key = running_generation_key(generation.gmail, generation.session_id)
+
+                def record(values, kind=kind, key=key, running_key=running_key, meta=value):
+                    values[key] = meta
+                    if kind == "start":
+                        values[running_key] = meta["id"]
+                    elif values[running_key] == meta["id"]:
+                        values[running_key] = None
+                self.state.update([key, running_key], record, ttl=self.ttl)
+                if kind == "start":
+                    self.running[generation.id] = generation
+                else:
+                    self.running.pop(generation.id, None)
+            i += 1
+
+    def poll_cancels(self):
+        """Cancel local generations stopped through another node"""
+        if not self.running or time.time() - self.polled < GENERATION_CANCEL_POLL:
+            return
+        self.polled = time.time()
+        metas = self.state.get_many([generation_key(generation_id) for generation_id in self.running])
+        for meta in metas.values():
+            if meta is not None and meta.get("cancel"):
+                generation = self.running.get(meta["id"])
+                if generation is not None:
+                    generation.cancel()
+
+
+class Generations:
+    """Generations of this process by id; finished ones are dropped after ttl
+
+    With shared state, those of other nodes are found there too.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.mean_tokens = None  # moving average length of complete replies, in tokens
+        self.mirror = None
+
+    def get_mirror(self):
+        state = get_shared_state()
+        if state is not None and self.mirror is None:
+            with self.lock:
+                if self.mirror is None:
+                    self.mirror = GenerationMirror(state, self.ttl)
+        return self.mirror
+
+    def start(self, gmail, session_id):
+        generation = Generation(gmail, session_id)
+        generation.mirror = self.get_mirror()
+        now = time.time()
+        with self.lock:
+            for generation_id, old in list(self.entries.items()):
+                if old.finished_at is not None and now - old.finished_at > self.ttl:
+                    del self.entries[generation_id]
+            self.entries[generation.id] = generation
+        if generation.mirror is not None:
+            generation.mirror.started(generation)
+        return generation
+
+    def get(self, gmail, generation_id):
+        generation = self.entries.get(generation_id)
+        if generation is None:
+            state = get_shared_state()
+            meta = state.get(generation_key(generation_id)) if state is not None else None
+            if meta is None or meta["gmail"] != gmail:
+                return None
+            return RemoteGeneration(state, meta)
+        if generation.gmail != gmail:
+            return None
+        if generation.finished_at is not None and time.time() - generation.finished_at > self.ttl:
+            return None
+        return generation
+
+    def completed(self, generation):
+        with self.lock:
+            previous = self.mean_tokens
+            self.mean_tokens = (generation.tokens if previous is None
+                                else previous + REPLY_TOKENS_ALPHA * (generation.tokens - previous))
+
+    def stopped(self, generation):
+        """Count a cancelled reply and the tokens it probably saved"""
+        telemetry.chat_cancellations.inc()
+        if self.mean_tokens is not None:
+            telemetry.chat_tokens_saved.inc(max(0, round(self.mean_tokens) - generation.tokens))
+
+    def running(self, gmail, session_id):
+        """Id of a reply still being produced for this session, if any"""
+        with self.lock:
+            for generation in self.entries.values():
+                if generation.gmail == gmail and generation.session_id == session_id and generation.status == "running":
+                    return generation.id
+        state = get_shared_state()
+        return state.get(running_generation_key(gmail, session_id)) if state is not None else None
+
+
+generations = Generations(GENERATION_TTL)
+
+
+def store_stopped_reply(generation, timestamp):
+    """Store what a cancelled reply got to and end its stream"""
+    append_message(generation.gmail, generation.session_id,
+                   {"content": generation.reply(), "sender": "bot", "time": timestamp, "stopped": True})
+    generations.stopped(generation)
+    generation.stop()
+
+
+def run_generation(generation, messages, cache_key, timestamp):
+    """Produce a streamed reply into generation and store it, on a thread of its own"""
+    try:
+        stream_response = chat_upstream.stream(lambda model: get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            timeout=60
+        ), delta_text, heartbeat=SSE_COALESCE_SECONDS)
+        try:
+            for content in stream_response:
+                if generation.cancelled:
+                    break
+                # None is the heartbeat: time to send whatever is being held
+                if content is None:
+                    generation.tick()
+                else:
+                    generation.feed(content)
+        finally:
+            # Closes the upstream response, so a cancelled reply stops costing tokens now
+            stream_response.close()
+        finish_generation(generation, cache_key, timestamp)
+    except Exception as e:
+        fail_generation(generation, timestamp, e)
+
+
+def finish_generation(generation, cache_key, timestamp):
+    """Store a reply whose upstream stream has ended (or a stopped one) and end the generation
+
+    Shared by run_generation and the ASGI server's produce().
+    """
+    if not generation.settle():
+        store_stopped_reply(generation, timestamp)
+        return
+    generations.completed(generation)
+    full_response = generation.reply()
+    if cache_key and full_response:
+        response_cache.put(cache_key, full_response)
+    # Saved before the done frame, so a client whose checksum fails finds it in /history
+    append_message(generation.gmail, generation.session_id,
+                   {"content": full_response, "sender": "bot", "time": timestamp})
+    generation.finish()
+
+
+def fail_generation(generation, timestamp, e):
+    """Store the unavailable reply for a stream that failed and end the generation with it"""
+    error_msg = "AI service unavailable, please try again later."
+    log.error("streaming chat failed", extra={"gmail": generation.gmail, "error": f"{type(e).__name__}: {str(e)}"})
+    try:
+        append_message(generation.gmail, generation.session_id,
+                       {"content": error_msg, "sender": "bot", "time": timestamp})
+    finally:
+        generation.fail(error_msg)
+
+
+def last_event_id():
+    """Last-Event-ID of a resuming client, from the header or ?last_event_id="""
+    value = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or "0"
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return 0
+
+
+def replay_reply(reply):
+    """SSE frames for a cached reply, framed like a live stream that arrived all at once"""
+    encoder = ReplyEncoder()
+    for chunk in re.findall(r"\s*\S+(?:\s+$)?", reply) or [reply]:
+        frame = encoder.feed(chunk, now=0)
+        if frame:
+            yield frame
+    yield encoder.done()
+
+
+class RateLimiter(SQLiteDatabase):
+    """Token buckets and sliding-window counters shared by every worker
+
+    A rule may set rate/burst (token bucket: burst tokens, refilled at rate
+    per second) and limit/window (at most limit requests in any window
+    seconds, estimated from the current and previous fixed windows). Each
+    check is one single-row read and write per key.
+    """
+
+    SYNCHRONOUS = "OFF"  # losing limiter state in a crash only resets the counters
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.connect().execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            "key TEXT PRIMARY KEY, tokens REAL, updated REAL, window INTEGER, count INTEGER, previous INTEGER)"
+        )
+
+    def hit(self, checks, now=None):
+        """Consume one request from every (key, rule) in checks, or from none of them
+
+        Returns the most restrictive result: allowed, limit, remaining, reset
+        and retry_after (seconds).
+        """
+        now = time.time() if now is None else now
+        with self.transaction() as conn:
+            rows = [conn.execute(
+                "SELECT tokens, updated, window, count, previous FROM rate_limits WHERE key = ?", (key,)
+            ).fetchone() for key, _ in checks]
+            result, states = self.consume(checks, rows, now)
+            for (key, _), state in zip(checks, states):
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_limits (key, tokens, updated, window, count, previous) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, state["tokens"], now, state["window"], state["count"], state["previous"])
+                )
+        return result
+
+    @classmethod
+    def consume(cls, checks, rows, now):
+        """The result of hit() and the new state of every key, given their stored rows"""
+        results = []
+        states = []
+        for (key, rule), row in zip(checks, rows):
+            state = cls.advance(rule, row, now)
+            states.append(state)
+            results.append(cls.evaluate(rule, state, now))
+        allowed = all(result["allowed"] for result in results)
+        if allowed:
+            for state, result in zip(states, results):
+                state["tokens"] -= 1
+                state["count"] += 1
+                result["remaining"] = max(0, result["remaining"] - 1)
+        result = min(results, key=lambda r: (r["allowed"], r["remaining"]))
+        result["allowed"] = allowed
+        return result, states
+
+    @staticmethod
+    def advance(rule, row, now):
+        """Refill the bucket and roll the window forward to now"""
+        burst = rule.get("burst", 0)
+        window_size = rule.get("window", 1)
+        current_window = int(now // window_size)
+        if row is None:
+            return {"tokens": burst, "window": current_window, "count": 0, "previous": 0}
+        tokens, updated, window, count, previous = row
+        tokens = min(burst, tokens + (now - updated) * rule.get("rate", 0))
+        if current_window == window + 1:
+            previous, count = count, 0
+        elif current_window != window:
+            previous, count = 0, 0
+        return {"tokens": tokens, "window": current_window, "count": count, "previous": previous}
+
+    @staticmethod
+    def evaluate(rule, state, now):
+        limits = []
+        if "burst" in rule:
+            refill = (1 - state["tokens"]) / rule["rate"] if rule.get("rate") else math.inf
+            limits.append({
+                "allowed": state["tokens"] >= 1,
+                "limit": rule["burst"],
+                "remaining": int(state["tokens"]),
+                "reset": math.ceil((rule["burst"] - state["tokens"]) / rule["rate"]) if rule.get("rate") else 0,
+                "retry_after": math.ceil(max(0, refill)),
+            })
+        if "limit" in rule:
+            window_size = rule["window"]
+            elapsed = now - state["window"] * window_size
+            # Sliding estimate: what is left of the previous window, weighted, plus this one
+            used = state["previous"] * (1 - elapsed / window_size) + state["count"]
+            limits.append({
+                "allowed": used + 1 <= rule["limit"],
+                "limit": rule["limit"],
+                "remaining": max(0, int(rule["limit"] - used)),
+                "reset": math.ceil(window_size - elapsed),
+                "retry_after": math.ceil(window_size - elapsed) if used + 1 > rule["limit"] else 0,
+            })
+        return min(limits, key=lambda r: (r["allowed"], r["remaining"]))
+
+
+class SharedRateLimiter:
+    """RateLimiter on the shared state, so a limit holds across every node
+
+    Each hit is one transaction over all of its keys.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def hit(self, checks, now=None):
+        now = time.time() if now is None else now
+        keys = [f"ratelimit:{key}" for key, _ in checks]
+        # Idle keys expire once their bucket would have refilled and their windows rolled over
+        ttl = max(2 * rule.get("window", 1) + (rule["burst"] / rule["rate"] if rule.get("rate") else 0)
+                  for _, rule in checks)
+
+        def consume(values):
+            rows = [None if values[key] is None else (values[key]["tokens"], values[key]["updated"],
+                                                      values[key]["window"], values[key]["count"],
+                                                      values[key]["previous"]) for key in keys]
+            result, states = RateLimiter.consume(checks, rows, now)
+            for key, state in zip(keys, states):
+                values[key] = dict(state, updated=now)
+            return result
+        return self.state.update(keys, consume, ttl=ttl)
+
+
+rate_limiter = None
+rate_limit_rules = None
+
+
+def get_rate_limiter():
+    global rate_limiter, rate_limit_rules
+    if rate_limiter is None:
+        with storage_lock:
+            if rate_limiter is None:
+                try:
+                    with open(RATE_LIMITS_FILE) as f:
+                        rate_limit_rules = json.load(f)
+                except (OSError, ValueError) as e:
+                    log.error("rate limits unreadable, rate limiting disabled",
+                              extra={"path": RATE_LIMITS_FILE, "error": str(e)})
+                    rate_limit_rules = {}
+                state = get_shared_state()
+                rate_limiter = SharedRateLimiter(state) if state is not None else RateLimiter(RATE_LIMIT_DATABASE)
+    return rate_limiter
+
+
+def check_rate_limit(route, gmail):
+    """Count one request by gmail to route; None when the route has no rules"""
+    limiter = get_rate_limiter()
+    rules = rate_limit_rules.get(route, {})
+    tier = (load_user(gmail) or {}).get("tier", "free")
+    checks = []
+    if tier in rules:
+        checks.append((f"{route}:user:{gmail}", rules[tier]))
+    if "global" in rules:
+        # Shared by all users: keeps bursts from reaching the upstream API
+        checks.append((f"{route}:global", rules["global"]))
+    if not checks:
+        return None
+    return limiter.hit(checks)
+
+
+def rate_limit_headers(result):
+    headers = {
+        "RateLimit-Limit": str(result["limit"]),
+        "RateLimit-Remaining": str(result["remaining"]),
+        "RateLimit-Reset": str(result["reset"]),
+    }
+    if not result["allowed"]:
+        headers["Retry-After"] = str(result["retry_after"])
+    return headers
+
+
+def rate_limit_response(result):
+    response = jsonify({"error": "Too many requests, please slow down.", "retry_after": result["retry_after"]})
+    response.status_code = 429
+    response.headers.update(rate_limit_headers(result))
+    return response
+
+
+def rate_limited(route):
+    """Throttle a view per user (by tier) and across all users, per rate_limits.json"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if "gmail" not in session:
+                return view(*args, **kwargs)
+            result = check_rate_limit(route, session["gmail"])
+            if result is None:
+                return view(*args, **kwargs)
+            if not result["allowed"]:
+                return rate_limit_response(result)
+            response = current_app.make_response(view(*args, **kwargs))
+            response.headers.update(rate_limit_headers(result))
+            return response
+        return wrapper
+    return decorator
+
+
+@bp.route("/chat", methods=["POST"])
+@rate_limited("chat")
 def chat():
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
@@ -556,91 +3118,51 @@ def chat():
     if not user_message:
         return jsonify({"error": "No message provided"}), 400
 
-    users = load_users()
-    user_data = get_user_data_with_sessions(session["gmail"])
+    gmail = session["gmail"]
+    user_data = get_user_data_with_sessions(gmail)
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     active_session_id = user_data.get("active_session")
     if not active_session_id or active_session_id not in user_data.get("sessions", {}):
         return jsonify({"error": "No active session"}), 400
 
-    active_session = user_data["sessions"][active_session_id]
-    history = active_session.get("history", [])
-
     if user_message == "__CLEAR__":
-        active_session["history"] = []
-        users[session["gmail"]] = user_data
-        save_users(users)
+        clear_session_history(gmail, active_session_id)
+
+        def forget_summary(user_data):
+            user_data.get("sessions", {}).get(active_session_id, {}).pop("summary", None)
+
+        update_user(gmail, forget_summary)
         return jsonify({"response": "Chat history cleared."})
 
     # Check if streaming is requested
     stream = request.json.get("stream", False)
 
-    user_personality = user_data.get("personality", "default")
-    system_content = PERSONALITIES.get(user_personality, PERSONALITIES["default"]) + "\n\n" + "\n".join([
-        f"Today is {datetime.now().strftime('%A, %B %d, %Y')}.",
-        excontext()
-    ])
-
-    messages = [{"role": "system", "content": system_content}]
-    for entry in history:
-        role = "user" if entry["sender"] == "user" else "assistant"
-        messages.append({"role": role, "content": entry["content"]})
-    messages.append({"role": "user", "content": user_message})
+    messages = prepare_chat_turn(gmail, user_data, active_session_id, user_message, timestamp)
 
-    # Save user message immediately
-    history.append({"content": user_message, "sender": "user", "time": timestamp})
+    cache_key = response_cache_key(user_data, messages)
+    cached_reply = response_cache.get(cache_key) if cache_key else None
+    if cached_reply is not None:
+        append_message(gmail, active_session_id, {"content": cached_reply, "sender": "bot", "time": timestamp})
+        if stream:
+            return Response(replay_reply(cached_reply), mimetype='text/event-stream')
+        return jsonify({"response": cached_reply})
 
     if stream:
-        # Streaming response
-        def generate():
-            full_response = ""
-            try:
-                stream_response = client.chat.completions.create(
-                    model=MODEL,
-                    messages=messages,
-                    stream=True,
-                    timeout=60
-                )
-
-                for chunk in stream_response:
-                    if chunk.choices and len(chunk.choices) > 0:
-                        delta = chunk.choices[0].delta
-                        if hasattr(delta, 'content') and delta.content:
-                            content = delta.content
-                            full_response += content
-                            # Send each chunk as SSE
-                            yield f"data: {json.dumps({'chunk': content, 'done': False})}\n\n"
-
-                # Send completion signal
-                yield f"data: {json.dumps({'chunk': '', 'done': True, 'full_response': full_response})}\n\n"
-
-                # Save the full response to history
-                history.append({"content": full_response, "sender": "bot", "time": timestamp})
-                if len(history) > 400:
-                    active_session["history"] = history[-400:]
-                else:
-                    active_session["history"] = history
-
-                users[session["gmail"]] = user_data
-                save_users(users)
-
-            except Exception as e:
-                error_msg = "AI service unavailable, please try again later."
-                print(f"Streaming API Error: {type(e).__name__}: {str(e)}")
-                yield f"data: {json.dumps({'chunk': '', 'done': True, 'error': error_msg})}\n\n"
-                # Save error message
-                history.append({"content": error_msg, "sender": "bot", "time": timestamp})
-                active_session["history"] = history
-                users[session["gmail"]] = user_data
-                save_users(users)
-        return Response(stream_with_context(generate()), mimetype='text/event-stream')
+        # The reply is produced on its own thread, so it is finished and stored even if
+        # this client goes away; a reconnecting client resumes from /chat/generations/<id>/events
+        generation = generations.start(gmail, active_session_id)
+        generation.task = threading.Thread(target=run_generation, args=(generation, messages, cache_key, timestamp),
+                                           daemon=True)
+        generation.task.start()
+        return Response(stream_with_context(tracked_stream("/chat", generation.follow())), mimetype='text/event-stream',
+                        headers={"X-Generation-Id": generation.id})
     else:
         # Non-streaming response (backward compatibility)
-        def call_ai():
+        def call_ai(model):
             try:
-                response = client.chat.completions.create(
-                    model=MODEL,
+                response = get_client().chat.completions.create(
+                    model=model,
                     messages=messages,
                     timeout=30
                 )
@@ -648,106 +3170,383 @@ def chat():
                     raise Exception("No response choices returned from API")
                 return response.choices[0].message.content
             except Exception as e:
-                error_msg = f"API Error: {type(e).__name__}: {str(e)}"
-                print(error_msg)
-                print(f"Model: {MODEL}, Base URL: {client.base_url}")
+                log.warning("chat completion failed", extra={"model": model, "base_url": OPENROUTER_BASE_URL,
+                                                              "error": f"{type(e).__name__}: {str(e)}"})
                 raise
 
-        ai_reply = retry_request(call_ai, retries=2, delay=2, fallback="AI service unavailable, please try again later.")
+        try:
+            ai_reply = chat_upstream.call(call_ai)
+        except Exception as e:
+            # Usual causes: a bad API key, wrong model names, no route to base_url, or an OpenRouter outage
+            log.error("no chat model answered", extra={"error": f"{type(e).__name__}: {str(e)}",
+                                                      "base_url": OPENROUTER_BASE_URL, "upstream": chat_upstream.status()})
+            ai_reply = "AI service unavailable, please try again later."
 
-        if ai_reply == "AI service unavailable, please try again later.":
-            print("Failed to get AI response after retries.")
-            print("Please check:")
-            print(f"  1. API key is valid: {client.api_key[:20]}...")
-            print(f"  2. Model name is correct: {MODEL}")
-            print(f"  3. Network connection to {client.base_url}")
-            print("  4. OpenRouter API status")
+        if cache_key and ai_reply and ai_reply != "AI service unavailable, please try again later.":
+            response_cache.put(cache_key, ai_reply)
 
-        history.append({"content": ai_reply, "sender": "bot", "time": timestamp})
-        if len(history) > 400:
-            active_session["history"] = history[-400:]
-        else:
-            active_session["history"] = history
 
-        users[session["gmail"]] = user_data
-        save_users(users)
+        append_message(gmail, active_session_id, {"content": ai_reply, "sender": "bot", "time": timestamp})
 
         return jsonify({"response": ai_reply})
 
 
-def create_thumbnail(img_data, max_size=(150, 150)):
-    """Create a small thumbnail from image data"""
-    try:
-        # Open image from bytes
-        img = Image.open(io.BytesIO(img_data))
-        
-        # Convert to RGB if necessary
-        if img.mode in ('RGBA', 'LA', 'P'):
-            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-            rgb_img.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            img = rgb_img
-        
-        # Create thumbnail
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Convert to JPEG for smaller size
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG", quality=85, optimize=True)
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        return img_str
-    except Exception as e:
-        print(f"Thumbnail creation failed: {e}")
-        return None
+image_pool = None
+
+
+def image_pipeline():
+    """The image_pipeline module, imported (with Pillow) the first time an image is handled"""
+    import image_pipeline
+    return image_pipeline
+
+
+def ensure_image_dirs():
+    """Create IMAGES_DIR and its subdirectories before the first write"""
+    os.makedirs(THUMBS_DIR, exist_ok=True)
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+
+
+def get_image_pool():
+    """Process pool for image post-processing, or None to run it inline"""
+    global image_pool
+    if image_pool is None and IMAGE_PROCESS_WORKERS > 0:
+        with storage_lock:
+            if image_pool is None:
+                # spawn: the workers only import image_pipeline, never this app
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                image_pool = ProcessPoolExecutor(
+                    max_workers=IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+    return image_pool
+
+
+def run_in_image_pool(fn, *args):
+    """Run an image_pipeline function in the pool, falling back to this process"""
+    global image_pool
+    from concurrent.futures.process import BrokenProcessPool
+    pool = get_image_pool()
+    if pool is not None:
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool as e:
+            log.warning("image process pool failed, processing inline", extra={"error": str(e)})
+            image_pool = None
+    return fn(*args)
+
+
+def save_thumbnail(jpeg_data):
+    """Store thumbnail bytes under their content hash and return the id"""
+    thumb_id = hashlib.sha256(jpeg_data).hexdigest()
+    path = os.path.join(THUMBS_DIR, f"{thumb_id}.jpg")
+    if not os.path.exists(path):
+        ensure_image_dirs()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(jpeg_data)
+        os.replace(tmp_path, path)
+    return thumb_id
+
+
+def externalize_thumbnail(entry):
+    """Move an embedded base64 thumbnail out of a history entry; True if changed"""
+    image_info = entry.get("image_info") or {}
+    if not image_info.get("thumbnail"):
+        return False
+    image_info["thumbnail_id"] = save_thumbnail(base64.b64decode(image_info.pop("thumbnail")))
+    return True
+
+
+@bp.cli.command("strip-thumbnails")
+def strip_thumbnails_command():
+    """Move base64 thumbnails embedded in chat history into THUMBS_DIR"""
+    count = get_storage().rewrite_messages(externalize_thumbnail)
+    click.echo(f"Moved {count} thumbnails to {THUMBS_DIR}")
+
+
+@bp.route("/chat/generations/<generation_id>")
+def generation_status(generation_id):
+    """A streamed reply's status, with the whole reply once it is done"""
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    generation = generations.get(session["gmail"], generation_id)
+    if generation is None:
+        return jsonify({"error": "Generation not found"}), 404
+    return jsonify(generation.summary())
 
 
-@app.route("/image/check-limit")
+@bp.route("/chat/generations/<generation_id>/events")
+def generation_events(generation_id):
+    """Resume a streamed reply after Last-Event-ID"""
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    generation = generations.get(session["gmail"], generation_id)
+    if generation is None:
+        # Finished long ago or produced by another worker; the stored reply is in /history
+        return jsonify({"error": "Generation not found"}), 404
+    return Response(
+        stream_with_context(tracked_stream("/chat/generations/<generation_id>/events", generation.follow(last_event_id()))),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Generation-Id": generation.id}
+    )
+
+
+@bp.route("/chat/generations/<generation_id>/cancel", methods=["POST"])
+def cancel_generation(generation_id):
+    """Stop a streamed reply; what it got to is stored and ends its stream"""
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    generation = generations.get(session["gmail"], generation_id)
+    if generation is None:
+        return jsonify({"error": "Generation not found"}), 404
+    return jsonify({"success": generation.cancel(), "status": generation.status})
+
+
+@bp.route("/image/check-limit")
 def check_image_limit():
     """Check user's current image generation limit"""
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
     
-    users = load_users()
-    user_data = users.get(session["gmail"], {})
-    
-    # Ensure user has tier data
-    user_data = migrate_to_tier_system(user_data)
+    user_data = get_user_data_with_sessions(session["gmail"])
     
     # Check limits
     limit_info = can_generate_image(user_data)
     
-    # Update user data if needed
-    users[session["gmail"]] = user_data
-    save_users(users)
-    
     return jsonify(limit_info)
 
 
-@app.route("/image", methods=["POST"])
-def image_gen():
-    if "gmail" not in session:
-        return jsonify({"error": "Unauthorized"}), 401
+class ImageJobError(Exception):
+    """An image job failed with a message meant for the user"""
+
+
+class ImageJobQueue(SQLiteDatabase):
+    """Image generation jobs queued in SQLite, so any worker process can run them"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.connect().execute("""
+            CREATE TABLE IF NOT EXISTS image_jobs (
+                id TEXT PRIMARY KEY,
+                gmail TEXT NOT NULL,
+                session_id TEXT,
+                prompt TEXT NOT NULL,
+                reservation TEXT,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self.connect().execute("CREATE INDEX IF NOT EXISTS image_jobs_status ON image_jobs (status, created)")
+        columns = [row[1] for row in self.connect().execute("PRAGMA table_info(image_jobs)")]
+        # claim identifies one run of a job, so a worker that lost it cannot settle it
+        for column in ("reservation", "claim"):
+            if column not in columns:
+                self.connect().execute(f"ALTER TABLE image_jobs ADD COLUMN {column} TEXT")
+
+    def enqueue(self, gmail, session_id, prompt, reservation=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self.connect().execute(
+            "INSERT INTO image_jobs (id, gmail, session_id, prompt, reservation, status, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, gmail, session_id, prompt, reservation, now, now)
+        )
+        return job_id
+
+    def claim(self):
+        """Mark the oldest queued job as running and return it, or None"""
+        with self.transaction() as conn:
+            # Running workers heartbeat their jobs; one that went quiet died, so its job goes back in the queue
+            conn.execute(
+                "UPDATE image_jobs SET status = 'queued', claim = NULL WHERE status = 'running' AND updated < ?",
+                (time.time() - IMAGE_JOB_TIMEOUT,)
+            )
+            row = conn.execute(
+                "SELECT id, gmail, session_id, prompt, reservation FROM image_jobs "
+                "WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            claim = uuid.uuid4().hex
+            conn.execute("UPDATE image_jobs SET status = 'running', claim = ?, updated = ? WHERE id = ?",
+                         (claim, time.time(), row[0]))
+        return {"id": row[0], "gmail": row[1], "session_id": row[2], "prompt": row[3], "reservation": row[4],
+                "claim": claim}
+
+    def settle(self, job, assignments, values):
+        """Update a job only while this claim still runs it; returns whether it did"""
+        cursor = self.connect().execute(
+            f"UPDATE image_jobs SET {assignments}, updated = ? WHERE id = ? AND claim = ? AND status = 'running'",
+            (*values, time.time(), job["id"], job["claim"])
+        )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job):
+        return self.settle(job, "status = 'running'", ())
+
+    def finish(self, job, result):
+        return self.settle(job, "status = 'done', result = ?", (json.dumps(result),))
+
+    def fail(self, job, error):
+        return self.settle(job, "status = 'error', error = ?", (error,))
+
+    def get(self, job_id):
+        row = self.connect().execute(
+            "SELECT id, gmail, status, result, error FROM image_jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "gmail": row[1],
+            "status": row[2],
+            "result": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+        }
 
-    prompt = request.json.get("prompt", "").strip()
-    if not prompt:
-        return jsonify({"error": "No prompt"}), 400
+    def purge(self, max_age):
+        """Forget finished jobs older than max_age seconds"""
+        self.connect().execute(
+            "DELETE FROM image_jobs WHERE status IN ('done', 'error') AND updated < ?", (time.time() - max_age,)
+        )
 
-    # Check image generation limits
-    users = load_users()
-    user_data = get_user_data_with_sessions(session["gmail"])
-    
-    # Check if user can generate image
-    limit_check = can_generate_image(user_data)
-    if not limit_check["allowed"]:
-        return jsonify({
-            "error": "Image limit reached\n to upgrade your account visit www.talktohurairah.com/upgrade\n if you do not want to upgrade your account your limit will be reset in 8 hours",
-            "message": f"You have reached your {user_data['tier']} tier limit of {USER_TIERS[user_data['tier']]['images_per_8hrs']} images per 8 hours.",
-            "next_reset": limit_check["next_reset"].isoformat(),
-            "remaining_seconds": limit_check["reset_seconds"],
-            "upgrade_url": "/upgrade"
-        }), 429  # Changed from 400 to 429 (Too Many Requests)
 
-    url = "https://openrouter.ai/api/v1/chat/completions"
+class SharedImageJobs:
+    """Image job status on the shared state, so a job can be polled from any node
+
+    Jobs are still queued in and run by the node that took the request;
+    every change of status is published under image_job:<id>, and expires
+    IMAGE_JOB_RETENTION after it.
+    """
+
+    RANK = {"queued": 0, "running": 1, "done": 2, "error": 2}
+
+    def __init__(self, jobs, state):
+        self.jobs = jobs
+        self.state = state
+
+    def __getattr__(self, name):
+        return getattr(self.jobs, name)
+
+    @staticmethod
+    def key(job_id):
+        return f"image_job:{job_id}"
+
+    def publish(self, job_id, gmail, status, result=None, error=None):
+        key = self.key(job_id)
+
+        def publish(values):
+            # A requeued job runs again, but what is shown never goes back from running to queued
+            if values[key] is None or self.RANK[values[key]["status"]] <= self.RANK[status]:
+                values[key] = {"id": job_id, "gmail": gmail, "status": status, "result": result, "error": error}
+        self.state.update([key], publish, ttl=IMAGE_JOB_RETENTION)
+
+    def enqueue(self, gmail, session_id, prompt, reservation=None):
+        job_id = self.jobs.enqueue(gmail, session_id, prompt, reservation)
+        self.publish(job_id, gmail, "queued")
+        return job_id
+
+    def claim(self):
+        job = self.jobs.claim()
+        if job is not None:
+            self.publish(job["id"], job["gmail"], "running")
+        return job
+
+    def finish(self, job, result):
+        finished = self.jobs.finish(job, result)
+        if finished:
+            self.publish(job["id"], job["gmail"], "done", result=result)
+        return finished
+
+    def fail(self, job, error):
+        failed = self.jobs.fail(job, error)
+        if failed:
+            self.publish(job["id"], job["gmail"], "error", error=error)
+        return failed
+
+    def get(self, job_id):
+        return self.state.get(self.key(job_id)) or self.jobs.get(job_id)
+
+
+image_queue = None
+image_jobs_ready = threading.Event()
+
+
+def get_image_queue():
+    """Return the image job queue, starting this process's worker threads on first use"""
+    global image_queue
+    if image_queue is None:
+        with storage_lock:
+            if image_queue is None:
+                state = get_shared_state()
+                jobs = ImageJobQueue(DATABASE_FILE)
+                image_queue = SharedImageJobs(jobs, state) if state is not None else jobs
+                for _ in range(IMAGE_WORKERS):
+                    threading.Thread(target=run_image_jobs_forever, daemon=True).start()
+    return image_queue
+
+
+def run_image_jobs_forever():
+    """Worker loop: claim queued jobs and run them until the process exits"""
+    import requests
+    while True:
+        try:
+            job = image_queue.claim()
+        except Exception as e:
+            log.error("image queue claim failed", extra={"error": str(e)})
+            job = None
+        if job is None:
+            # Woken straight away for jobs queued by this process; jobs queued by
+            # other workers are picked up on the next poll
+            image_jobs_ready.wait(IMAGE_QUEUE_POLL)
+            image_jobs_ready.clear()
+            if random.random() < 0.01:
+                image_queue.purge(IMAGE_JOB_RETENTION)
+            continue
+        done = threading.Event()
+        threading.Thread(target=heartbeat_image_job, args=(job, done), daemon=True).start()
+        try:
+            with telemetry.image_stage_seconds.time(stage="job"):
+                result = generate_image(job["gmail"], job["session_id"], job["prompt"], job["reservation"])
+            if not image_queue.finish(job, result):
+                log.warning("image job was taken over by another worker", extra={"job_id": job["id"]})
+            continue
+        except ImageJobError as e:
+            error = str(e)
+        except UpstreamUnavailable as e:
+            # Every image model failed; report the last model's error
+            log.error("no image model answered", extra={"job_id": job["id"], "error": str(e.__cause__ or e)})
+            error = f"API request failed: {str(e.__cause__ or e)}"
+        except requests.exceptions.RequestException as e:
+            log.error("image request failed", extra={"job_id": job["id"], "error": f"{type(e).__name__}: {str(e)}"})
+            error = f"API request failed: {str(e)}"
+        except Exception as e:
+            log.exception("image generation failed", extra={"job_id": job["id"]})
+            error = f"Image processing failed: {str(e)}"
+        finally:
+            done.set()
+        # No image was produced, so the user gets the quota back; a worker that took
+        # the job over owns the reservation now
+        if image_queue.fail(job, error) and job["reservation"]:
+            release_image_quota(job["gmail"], job["reservation"])
+
+
+def heartbeat_image_job(job, done):
+    """Refresh a running job every IMAGE_JOB_HEARTBEAT seconds until done is set, so it is not requeued"""
+    while not done.wait(IMAGE_JOB_HEARTBEAT):
+        try:
+            if not image_queue.heartbeat(job):
+                return
+        except Exception as e:
+            log.warning("image job heartbeat failed", extra={"job_id": job["id"], "error": str(e)})
+
+
+def generate_image(gmail, session_id, prompt, reservation=None):
+    """Call the image model, store the result and return the client payload"""
+    url = f"{OPENROUTER_BASE_URL}/chat/completions"
     headers = {
         "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
         "Content-Type": "application/json"
@@ -772,150 +3571,217 @@ def image_gen():
 }
 
 
-    try:
-        print(f"Sending image generation request for prompt: {prompt}")
-        r = requests.post(url, headers=headers, json=payload, timeout=120)
+    def request_image(model):
+        import requests
+        r = requests.post(url, headers=headers, json=dict(payload, model=model), timeout=120)
         r.raise_for_status()
         data = r.json()
-        
-        print(f"Response received, checking structure...")
-        
+    
         if "choices" not in data or len(data["choices"]) == 0:
-            return jsonify({"error": "No choices in response"}), 500
-            
-        message = data["choices"][0]["message"]
+            raise ImageJobError("No choices in response")
         
+        message = data["choices"][0]["message"]
+    
         # Check if images array exists
         if "images" not in message or len(message["images"]) == 0:
-            print("No images array in response")
-            return jsonify({"error": "No images in response"}), 500
-        
+            log.warning("image response without images", extra={"model": model})
+            raise ImageJobError("No images in response")
+    
         # Get the first image object
         first_image = message["images"][0]
-        print(f"First image object: {first_image}")
-        
+    
         # Check the structure - it should have "image_url" with "url" inside
         if "image_url" not in first_image or "url" not in first_image["image_url"]:
-            print(f"Unexpected image structure: {first_image}")
-            return jsonify({"error": "Unexpected image format"}), 500
-        
-        # Get the data URL
-        data_url = first_image["image_url"]["url"]
-        print(f"Got data URL (first 100 chars): {data_url[:100]}...")
-        
-        # Extract base64 from data URL
-        if not data_url.startswith("data:image/"):
-            print(f"Not a data URL: {data_url[:100]}...")
-            return jsonify({"error": "Not a data URL"}), 500
-        
-        # Split the data URL to get the base64 part
-        try:
+            log.warning("unexpected image structure", extra={"model": model, "image": str(first_image)[:200]})
+            raise ImageJobError("Unexpected image format")
+    
+        return first_image
+
+    log.info("image generation requested", extra={"gmail": gmail, "prompt_chars": len(prompt)})
+    with telemetry.image_stage_seconds.time(stage="upstream"):
+        first_image = image_upstream.call(request_image)
+
+    # Get the data URL
+    data_url = first_image["image_url"]["url"]
+    
+    # Extract base64 from data URL
+    if not data_url.startswith("data:image/"):
+        log.warning("image is not a data URL", extra={"url": data_url[:100]})
+        raise ImageJobError("Not a data URL")
+    
+    # Split the data URL to get the base64 part
+    try:
+        with telemetry.image_stage_seconds.time(stage="decode"):
             header, base64_data = data_url.split(",", 1)
-            print(f"Header: {header}")
-            print(f"Base64 data length: {len(base64_data)} chars")
-            
-            # Decode base64
             img_data = base64.b64decode(base64_data)
-            print(f"Decoded image data: {len(img_data)} bytes")
-            
-        except Exception as e:
-            print(f"Failed to decode base64: {e}")
-            return jsonify({"error": f"Failed to decode image: {str(e)}"}), 500
-        
-        # Save image to disk
-        img_id = str(uuid.uuid4().hex)
-        filename = f"{img_id}.png"
-        filepath = os.path.join(IMAGES_DIR, filename)
-        
-        with open(filepath, "wb") as f:
-            f.write(img_data)
-        print(f"Image saved to {filepath}")
-        
-        # Get image dimensions
-        try:
-            img = Image.open(io.BytesIO(img_data))
-            width, height = img.size
-            print(f"Image dimensions: {width}x{height}")
-        except Exception as img_err:
-            print(f"Could not read image dimensions: {img_err}")
-            width, height = 1024, 1024
-        
-        # Create thumbnail
-        thumbnail_base64 = None
-        try:
-            thumbnail_base64 = create_thumbnail(img_data)
-            print(f"Created thumbnail ({len(thumbnail_base64) if thumbnail_base64 else 0} chars)")
-        except Exception as thumb_err:
-            print(f"Thumbnail creation failed: {thumb_err}")
-        
-        # Increment image count for user
-        user_data = increment_image_count(user_data)
-        users[session["gmail"]] = user_data
-        save_users(users)
-        
-        # Save to user history
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        active_session_id = user_data.get("active_session")
-        
-        if active_session_id:
-            active_session = user_data["sessions"][active_session_id]
-            
-            image_entry = {
-                "sender": "bot",
-                "type": "image",
-                "content": f"[IMAGE:{img_id}]",
-                "image_id": img_id,
-                "filename": filename,
-                "prompt": prompt,
-                "time": timestamp,
-                "image_info": {
-                    "width": width,
-                    "height": height,
-                    "size_kb": round(len(img_data) / 1024, 2),
-                    "thumbnail": thumbnail_base64
-                }
+    except Exception as e:
+        log.warning("image base64 decode failed", extra={"error": str(e)})
+        raise ImageJobError(f"Failed to decode image: {str(e)}")
+    
+    # Save image to disk
+    img_id = str(uuid.uuid4().hex)
+    filename = f"{img_id}.png"
+    filepath = os.path.join(IMAGES_DIR, filename)
+    ensure_image_dirs()
+
+    with telemetry.image_stage_seconds.time(stage="save"), open(filepath, "wb") as f:
+        f.write(img_data)
+    telemetry.image_bytes.observe(len(img_data), format="png")
+    
+    # Dimensions, thumbnail and compressed variants from a single decode
+    width, height = 1024, 1024
+    thumbnail_id = None
+    variants = {}
+    try:
+        with telemetry.image_stage_seconds.time(stage="process"):
+            processed = run_in_image_pool(image_pipeline().process_image, img_data, IMAGE_VARIANTS)
+        width, height = processed["width"], processed["height"]
+        with telemetry.image_stage_seconds.time(stage="save_variants"):
+            thumbnail_id = save_thumbnail(processed["thumbnail"])
+            for fmt, variant_data in processed["variants"].items():
+                with open(os.path.join(IMAGES_DIR, f"{img_id}.{fmt}"), "wb") as f:
+                    f.write(variant_data)
+                variants[fmt] = round(len(variant_data) / 1024, 2)
+                telemetry.image_bytes.observe(len(variant_data), format=fmt)
+    except Exception as img_err:
+        log.warning("image post-processing failed", extra={"image_id": img_id, "error": str(img_err)})
+    log.info("image stored", extra={"image_id": img_id, "width": width, "height": height,
+                                    "png_kb": round(len(img_data) / 1024, 2), "variants_kb": variants})
+    
+    # Count the image against the user's quota
+    if reservation:
+        user_data, charged = commit_image_quota(gmail, reservation)
+        if not charged:
+            log.warning("image reservation was already settled", extra={"gmail": gmail, "reservation": reservation})
+    else:
+        user_data = update_user(gmail, increment_image_count, default=new_user_data(), atomic=True)
+    
+    # Save to user history
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    if session_id:
+        image_entry = {
+            "sender": "bot",
+            "type": "image",
+            "content": f"[IMAGE:{img_id}]",
+            "image_id": img_id,
+            "filename": filename,
+            "prompt": prompt,
+            "time": timestamp,
+            "image_info": {
+                "width": width,
+                "height": height,
+                "size_kb": round(len(img_data) / 1024, 2),
+                "thumbnail_id": thumbnail_id,
+                "variants_kb": variants
             }
-            
-            active_session["history"].append(image_entry)
-            users[session["gmail"]] = user_data
-            save_users(users)
-        
-        # Get updated limit info
-        limit_info = can_generate_image(user_data)
+        }
         
+        append_message(gmail, session_id, image_entry)
+    
+    # Get updated limit info
+    limit_info = can_generate_image(user_data)
+    
+    return {
+        "success": True,
+        "url": f"/images/{filename}",
+        "id": img_id,
+        "dimensions": f"{width}x{height}",
+        "size_kb": round(len(img_data) / 1024, 2),
+        "thumbnail_url": f"/images/thumb/{thumbnail_id}" if thumbnail_id else None,
+        "limits": {
+            "remaining": limit_info["remaining"],
+            "next_reset": limit_info["next_reset"].isoformat(),
+            "tier": user_data.get("tier", "free")
+        }
+    }
+
+
+def image_job_status(job):
+    """Client view of a job: status plus the result or error once it has one"""
+    status = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == "done":
+        status.update(job["result"])
+    elif job["status"] == "error":
+        status["error"] = job["error"]
+    return status
+
+
+@bp.route("/image", methods=["POST"])
+@rate_limited("image")
+def image_gen():
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    prompt = request.json.get("prompt", "").strip()
+    if not prompt:
+        return jsonify({"error": "No prompt"}), 400
+
+    # Take one image from the quota up front, atomically across workers
+    gmail = session["gmail"]
+    reservation, limit_check, user_data = reserve_image_quota(gmail)
+    if reservation is None:
         return jsonify({
-            "success": True,
-            "url": f"/images/{filename}",
-            "id": img_id,
-            "dimensions": f"{width}x{height}",
-            "size_kb": round(len(img_data) / 1024, 2),
-            "thumbnail": thumbnail_base64,
-            "limits": {
-                "remaining": limit_info["remaining"],
-                "next_reset": limit_info["next_reset"].isoformat(),
-                "tier": user_data["tier"]
-            }
-        })
+            "error": "Image limit reached\n to upgrade your account visit www.talktohurairah.com/upgrade\n if you do not want to upgrade your account your limit will be reset in 8 hours",
+            "message": f"You have reached your {user_data['tier']} tier limit of {USER_TIERS[user_data['tier']]['images_per_8hrs']} images per 8 hours.",
+            "next_reset": limit_check["next_reset"].isoformat(),
+            "remaining_seconds": limit_check["reset_seconds"],
+            "upgrade_url": "/upgrade"
+        }), 429  # Changed from 400 to 429 (Too Many Requests)
+
+    # The upstream call and post-processing run on the job workers
+    try:
+        job_id = get_image_queue().enqueue(gmail, user_data.get("active_session"), prompt, reservation)
+    except:
+        release_image_quota(gmail, reservation)
+        raise
+    image_jobs_ready.set()
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/image/jobs/{job_id}",
+        "events_url": f"/image/jobs/{job_id}/events"
+    }), 202
 
-    except requests.exceptions.RequestException as e:
-        print(f"OpenRouter API request failed: {type(e).__name__}: {str(e)}")
-        return jsonify({"error": f"API request failed: {str(e)}"}), 500
-    except Exception as e:
-        print(f"Image generation error: {type(e).__name__}: {str(e)}")
-        traceback.print_exc()
-        return jsonify({"error": f"Image processing failed: {str(e)}"}), 500
 
+@bp.route("/image/jobs/<job_id>")
+def image_job(job_id):
+    """Poll an image job"""
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = get_image_queue().get(job_id)
+    if job is None or job["gmail"] != session["gmail"]:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(image_job_status(job))
+
+
+@bp.route("/image/jobs/<job_id>/events")
+def image_job_events(job_id):
+    """An image job's current status as one SSE event, with a retry hint
+
+    A web worker thread is never held while an image is made: the client's
+    EventSource reconnects every IMAGE_QUEUE_POLL seconds until the job is
+    done or failed. The ASGI server keeps one stream open instead
+    (asgi.stream_image_job), since waiting costs it nothing.
+    """
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = get_image_queue().get(job_id)
+    if job is None or job["gmail"] != session["gmail"]:
+        return jsonify({"error": "Job not found"}), 404
+
+    body = f"retry: {int(IMAGE_QUEUE_POLL * 1000)}\n" + sse_event(image_job_status(job))
+    return Response(body, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-@app.route("/upgrade")
+
+@bp.route("/upgrade")
 def upgrade_page():
     """Upgrade page to show tier options"""
     if "gmail" not in session:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     
-    users = load_users()
-    user_data = users.get(session["gmail"], {})
-    user_data = migrate_to_tier_system(user_data)
+    user_data = get_user_data_with_sessions(session["gmail"])
     
     current_tier = user_data.get("tier", "free")
     limit_info = can_generate_image(user_data)
@@ -927,7 +3793,7 @@ def upgrade_page():
                           limit_info=limit_info)
 
 
-@app.route("/upgrade/process", methods=["POST"])
+@bp.route("/upgrade/process", methods=["POST"])
 def process_upgrade():
     """Process tier upgrade (simulated - no real payment)"""
     if "gmail" not in session:
@@ -937,9 +3803,7 @@ def process_upgrade():
     if new_tier not in USER_TIERS:
         return jsonify({"error": "Invalid tier"}), 400
     
-    users = load_users()
-    user_data = users.get(session["gmail"], {})
-    user_data = migrate_to_tier_system(user_data)
+    user_data = get_user_data_with_sessions(session["gmail"])
     
     current_tier = user_data.get("tier", "free")
     
@@ -950,27 +3814,28 @@ def process_upgrade():
     # In a real app, you would process payment here
     # For now, just update the tier
     
-    # Record upgrade history
-    upgrade_history = user_data.get("upgrade_history", [])
-    upgrade_history.append({
-        "from_tier": current_tier,
-        "to_tier": new_tier,
-        "timestamp": datetime.now().isoformat(),
-        "price": USER_TIERS[new_tier]["price"]
-    })
-    
-    # Update user tier
-    user_data["tier"] = new_tier
-    
-    # Reset image count when upgrading
-    user_data["image_usage"] = {
-        "last_reset": datetime.now().isoformat(),
-        "count": 0
-    }
+    def apply_upgrade(user_data):
+        upgrade_user_data(user_data)
+
+        # Record upgrade history
+        user_data.setdefault("upgrade_history", []).append({
+            "from_tier": user_data.get("tier", "free"),
+            "to_tier": new_tier,
+            "timestamp": datetime.now().isoformat(),
+            "price": USER_TIERS[new_tier]["price"]
+        })
+        
+        # Update user tier
+        user_data["tier"] = new_tier
+        
+        # Reset image count when upgrading; images still being made keep their reservations
+        image_usage = user_data.setdefault("image_usage", {})
+        image_usage["reserved"] = active_reservations(image_usage)
+        image_usage["last_reset"] = datetime.now().isoformat()
+        image_usage["count"] = 0
     
-    # Save changes
-    users[session["gmail"]] = user_data
-    save_users(users)
+    # Committed before answering, like the other quota changes
+    update_user(session["gmail"], apply_upgrade, default=new_user_data(), atomic=True)
     
     return jsonify({
         "success": True,
@@ -980,15 +3845,13 @@ def process_upgrade():
     })
 
 
-@app.route("/user/profile")
+@bp.route("/user/profile")
 def user_profile():
     """User profile page showing tier and usage"""
     if "gmail" not in session:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     
-    users = load_users()
-    user_data = users.get(session["gmail"], {})
-    user_data = migrate_to_tier_system(user_data)
+    user_data = get_user_data_with_sessions(session["gmail"])
     
     limit_info = can_generate_image(user_data)
     current_tier = user_data.get("tier", "free")
@@ -1012,37 +3875,31 @@ def user_profile():
     })
 
 
-@app.route("/theme", methods=["POST"])
+@bp.route("/theme", methods=["POST"])
 def update_theme():
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
     theme = request.json.get("theme")
-    users = load_users()
-    if session["gmail"] in users:
-        users[session["gmail"]]["theme"] = theme
-        save_users(users)
+    update_user(session["gmail"], lambda user_data: user_data.update(theme=theme))
     return jsonify({"success": True})
 
 
-@app.route("/personality", methods=["POST"])
+@bp.route("/personality", methods=["POST"])
 def update_personality():
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
     personality = request.json.get("personality", "default")
-    users = load_users()
-    if session["gmail"] in users:
-        users[session["gmail"]]["personality"] = personality
-        save_users(users)
+    update_user(session["gmail"], lambda user_data: user_data.update(personality=personality))
     return jsonify({"success": True})
 
 
-@app.route("/moindex")
+@bp.route("/moindex")
 def moindex():
     if "gmail" not in session:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     user_data = get_user_data_with_sessions(session["gmail"])
-    history = get_active_session_history(user_data)
-    sessions_list = user_data.get("sessions", {})
+    history_page = get_active_session_history(session["gmail"], user_data)
+    sessions_list = get_session_metadata(user_data)
     active_session_id = user_data.get("active_session")
     
     # Get image generation limits info
@@ -1051,74 +3908,109 @@ def moindex():
     
     return render_template("moindex.html",
                            gmail=session["gmail"],
-                           history=history,
+                           history=history_page["messages"],
+                           history_cursor=history_page["next_cursor"],
                            theme=user_data["theme"],
                            sessions=sessions_list,
                            active_session=active_session_id,
+                           pending_generation=generations.running(session["gmail"], active_session_id),
                            tier=user_data.get("tier", "free"),
                            tier_info=tier_info,
                            image_limits=image_limits)
 
 
-@app.route("/forgot", methods=["GET"])
+@bp.route("/forgot", methods=["GET"])
 def forgot_get():
     return render_template("reset.html")
 
 
-@app.route("/forgot", methods=["POST"])
+@bp.route("/forgot", methods=["POST"])
 def forgot_post():
     email = request.form.get("email", "").strip()
     if not email:
         return render_template("reset.html", error="Please enter your email.")
 
-    users = load_users()
-    password_found = None
-    if email in users and users[email].get("password"):
-        password_found = users[email]["password"]
-    else:
-        pw = find_credentials(email)
-        if pw:
-            password_found = pw
-
-    if not password_found:
+    store = get_credential_store()
+    if not store.get_hash(email):
         return render_template("reset.html", sent=True)
 
+    # Passwords are stored hashed, so send a fresh temporary password instead
+    temp_password = secrets.token_urlsafe(9)
+
     subject = "HurairahGPT — Your account credentials"
-    body = f"Hello,\n\nYou requested your account credentials for HurairahGPT.\n\nEmail: {email}\nPassword: {password_found}\n\nIf you did not request this, ignore this email.\n\n— HurairahGPT Team"
+    body = f"Hello,\n\nYou requested your account credentials for HurairahGPT.\n\nEmail: {email}\nTemporary password: {temp_password}\n\nIt works for {RESET_PASSWORD_TTL // 3600} hours and replaces your password the first time you sign in with it. Until then your current password keeps working.\n\nIf you did not request this, ignore this email.\n\n— HurairahGPT Team"
 
-    ok, msg = send_email(email, subject, body)
-    if ok:
-        return render_template("reset.html", sent=True)
-    else:
-        return render_template("reset.html", error="Failed to send email. " + msg)
+    # The outbox sends it in the background and only then accepts it; the current password keeps working
+    queue_email(email, subject, body, temp_password)
+    return render_template("reset.html", sent=True)
 
 
-@app.route("/sessions/create", methods=["POST"])
-def create_session():
+@bp.route("/history")
+def history_api():
+    """Cursor-paginated history of one session, newest page first"""
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
-    users = load_users()
-    user_data = get_user_data_with_sessions(session["gmail"])
+    user_data = load_user(session["gmail"]) or {}
+    session_id = request.args.get("session_id") or user_data.get("active_session")
+    if session_id not in user_data.get("sessions", {}):
+        return jsonify({"error": "Session not found"}), 404
+
+    last_seq, _ = get_storage().session_version(session["gmail"], session_id)
+    etag = session_etag(session_id, last_seq)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    before = request.args.get("before", type=int)
+    limit = max(1, min(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 100))
+    return with_etag(jsonify(get_history_page(session["gmail"], session_id, before, limit)), etag)
+
+
+@bp.route("/sessions")
+def list_sessions():
+    """Lightweight session list: names and message counts, no history"""
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    user_data = load_user(session["gmail"]) or {}
+    counts = get_storage().count_messages(session["gmail"])
+    versions = get_storage().session_versions(session["gmail"])
+    return jsonify({
+        "sessions": [
+            {
+                "id": session_id,
+                "name": chat_session.get("name"),
+                "created": chat_session.get("created"),
+                "count": counts.get(session_id, 0),
+                "last_seq": versions.get(session_id, 0)
+            }
+            for session_id, chat_session in user_data.get("sessions", {}).items()
+        ],
+        "active_session": user_data.get("active_session")
+    })
+
+
+@bp.route("/sessions/create", methods=["POST"])
+def create_session():
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
 
     session_id = str(uuid.uuid4())
-    session_name = request.json.get("name", "").strip() or f"Chat {len(user_data.get('sessions', {})) + 1}"
+    requested_name = request.json.get("name", "").strip()
 
-    user_data.setdefault("sessions", {})
-    user_data["sessions"][session_id] = {
-        "name": session_name,
-        "history": [],
-        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-    user_data["active_session"] = session_id
+    def create(user_data):
+        user_data["sessions"][session_id] = {
+            "name": requested_name or f"Chat {len(user_data['sessions']) + 1}",
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        user_data["active_session"] = session_id
 
-    users[session["gmail"]] = user_data
-    save_users(users)
+    user_data = update_sessions(session["gmail"], create)
 
-    return jsonify({"success": True, "session_id": session_id, "sessions": user_data["sessions"]})
+    return jsonify({"success": True, "session_id": session_id, "sessions": get_session_metadata(user_data)})
 
 
-@app.route("/sessions/switch", methods=["POST"])
+@bp.route("/sessions/switch", methods=["POST"])
 def switch_session():
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
@@ -1127,25 +4019,28 @@ def switch_session():
     if not session_id:
         return jsonify({"error": "No session_id provided"}), 400
 
-    users = load_users()
-    user_data = get_user_data_with_sessions(session["gmail"])
+    outcome = {}
 
-    if session_id not in user_data.get("sessions", {}):
-        return jsonify({"error": "Session not found"}), 404
+    def switch(user_data):
+        outcome["found"] = session_id in user_data["sessions"]
+        if outcome["found"]:
+            user_data["active_session"] = session_id
 
-    user_data["active_session"] = session_id
-    users[session["gmail"]] = user_data
-    save_users(users)
+    user_data = update_sessions(session["gmail"], switch)
+    if not outcome["found"]:
+        return jsonify({"error": "Session not found"}), 404
 
-    active_session = user_data["sessions"][session_id]
+    # Metadata only; the client fetches messages through /sessions/<id>/sync
+    last_seq, _ = get_storage().session_version(session["gmail"], session_id)
     return jsonify({
         "success": True,
-        "history": active_session.get("history", []),
-        "sessions": user_data["sessions"]
+        "session_id": session_id,
+        "last_seq": last_seq,
+        "sessions": get_session_metadata(user_data)
     })
 
 
-@app.route("/sessions/delete", methods=["POST"])
+@bp.route("/sessions/delete", methods=["POST"])
 def delete_session():
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
@@ -1154,36 +4049,64 @@ def delete_session():
     if not session_id:
         return jsonify({"error": "No session_id provided"}), 400
 
-    users = load_users()
-    user_data = get_user_data_with_sessions(session["gmail"])
+    outcome = {}
 
-    if session_id not in user_data.get("sessions", {}):
-        return jsonify({"error": "Session not found"}), 404
+    def delete(user_data):
+        sessions = user_data["sessions"]
+        if session_id not in sessions:
+            outcome["error"] = ("Session not found", 404)
+        elif len(sessions) <= 1:
+            outcome["error"] = ("Cannot delete the last session", 400)
+        else:
+            outcome["error"] = None
+            del sessions[session_id]
+            # If it was the active session, switch to another one
+            if user_data.get("active_session") == session_id:
+                user_data["active_session"] = list(sessions.keys())[0]
+
+    user_data = update_sessions(session["gmail"], delete)
+    if outcome["error"]:
+        message, status = outcome["error"]
+        return jsonify({"error": message}), status
+    clear_session_history(session["gmail"], session_id)
+
+    last_seq, _ = get_storage().session_version(session["gmail"], user_data["active_session"])
+    return jsonify({
+        "success": True,
+        "sessions": get_session_metadata(user_data),
+        "active_session": user_data["active_session"],
+        "last_seq": last_seq
+    })
 
-    sessions = user_data.get("sessions", {})
-    if len(sessions) <= 1:
-        return jsonify({"error": "Cannot delete the last session"}), 400
 
-    # Delete the session
-    del sessions[session_id]
+@bp.route("/sessions/<session_id>/sync")
+def sync_session(session_id):
+    """Messages newer than ?after=<seq>, or the newest page when the client's copy is stale (reset)"""
+    if "gmail" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
 
-    # If it was the active session, switch to another one
-    if user_data.get("active_session") == session_id:
-        user_data["active_session"] = list(sessions.keys())[0]
+    gmail = session["gmail"]
+    user_data = load_user(gmail) or {}
+    if session_id not in user_data.get("sessions", {}):
+        return jsonify({"error": "Session not found"}), 404
 
-    users[session["gmail"]] = user_data
-    save_users(users)
+    last_seq, cleared_seq = get_storage().session_version(gmail, session_id)
+    etag = session_etag(session_id, last_seq)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
 
-    active_session = user_data["sessions"][user_data["active_session"]]
-    return jsonify({
-        "success": True,
-        "history": active_session.get("history", []),
-        "sessions": user_data["sessions"],
-        "active_session": user_data["active_session"]
-    })
+    after = request.args.get("after", 0, type=int)
+    if after < cleared_seq or after > last_seq or last_seq - after > SYNC_LIMIT:
+        # What the client has was cleared, is from another database, or is too far behind
+        page = get_history_page(gmail, session_id)
+        payload = {"reset": True, "messages": page["messages"], "next_cursor": page["next_cursor"]}
+    else:
+        payload = {"reset": False, "messages": get_messages_after(gmail, session_id, after)}
+    payload["last_seq"] = max([last_seq] + [entry["seq"] for entry in payload["messages"]])
+    return with_etag(jsonify(payload), etag)
 
 
-@app.route("/sessions/rename", methods=["POST"])
+@bp.route("/sessions/rename", methods=["POST"])
 def rename_session():
     if "gmail" not in session:
         return jsonify({"error": "Unauthorized"}), 401
@@ -1194,17 +4117,45 @@ def rename_session():
     if not session_id or not new_name:
         return jsonify({"error": "Missing session_id or name"}), 400
 
-    users = load_users()
-    user_data = get_user_data_with_sessions(session["gmail"])
+    outcome = {}
 
-    if session_id not in user_data.get("sessions", {}):
-        return jsonify({"error": "Session not found"}), 404
+    def rename(user_data):
+        outcome["found"] = session_id in user_data["sessions"]
+        if outcome["found"]:
+            user_data["sessions"][session_id]["name"] = new_name
 
-    user_data["sessions"][session_id]["name"] = new_name
-    users[session["gmail"]] = user_data
-    save_users(users)
+    user_data = update_sessions(session["gmail"], rename)
+    if not outcome["found"]:
+        return jsonify({"error": "Session not found"}), 404
 
-    return jsonify({"success": True, "sessions": user_data["sessions"]})
+    return jsonify({"success": True, "sessions": get_session_metadata(user_data)})
+
+
+def create_app(config=None):
+    """Build the Flask app; config is applied to app.config last
+
+    Only Flask's own keys and SECRET_KEY / JINJA_CACHE_DIR are read from
+    app.config. Everything else (storage paths, limits, upstream) is a
+    module constant read from the environment at import. Clients, storage
+    and worker threads are created on first use, not here, so a pre-fork
+    server can boot workers cheaply.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(
+        SECRET_KEY=os.getenv("FLASK_SECRET_KEY"),
+        JINJA_CACHE_DIR=JINJA_CACHE_DIR,
+    )
+    if config:
+        app.config.from_mapping(config)
+    # Templates are compiled once per machine rather than once per worker
+    if app.config["JINJA_CACHE_DIR"]:
+        os.makedirs(app.config["JINJA_CACHE_DIR"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["JINJA_CACHE_DIR"])
+    app.register_blueprint(bp)
+    return app
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+# Copyright (c) 2025 Hurairah
+# All Rights Reserved. Proprietary Software.
+# Legal matters handled by parent/guardian until age 18.
+# Governed by Pakistan law (Rawalpindi jurisdiction).
+"""Post-processing for generated images.
+
+Kept apart from flask_app so process pool workers only import PIL.
+process_image() decodes the upstream bytes once and derives everything
+the app stores from that single decode.
+"""
+import io
+
+from PIL import Image, features
+
+THUMBNAIL_SIZE = (150, 150)
+VARIANT_QUALITY = {"webp": 80, "avif": 60}
+
+
+def supported_variants(formats):
+    """The subset of formats this Pillow build can encode"""
+    return [fmt for fmt in formats if features.check(fmt)]
+
+
+def flatten(img):
+    """RGB copy of img with any transparency composited onto white"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.split()[-1])
+        return rgb_img
+    return img.convert('RGB')
+
+
+def encode(img, fmt, **options):
+    buffered = io.BytesIO()
+    img.save(buffered, format=fmt, **options)
+    return buffered.getvalue()
+
+
+def process_image(img_data, variants=("webp",)):
+    """Decode img_data once; return its size, a JPEG thumbnail and compressed variants"""
+    img = Image.open(io.BytesIO(img_data))
+    img.load()
+    width, height = img.size
+
+    thumb = flatten(img)
+    thumb.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+
+    # WebP and AVIF both keep alpha, so variants are encoded from the decoded image as is
+    source = img if img.mode in ('RGB', 'RGBA') else img.convert('RGBA')
+    return {
+        "width": width,
+        "height": height,
+        "thumbnail": encode(thumb, "JPEG", quality=85, optimize=True),
+        "variants": {
+            fmt: encode(source, fmt.upper(), quality=VARIANT_QUALITY.get(fmt, 80))
+            for fmt in supported_variants(variants)
+        },
+    }
+
+
+def resize_image(img_data, width, fmt):
+    """img_data scaled down to at most width pixels wide, encoded as fmt"""
+    img = Image.open(io.BytesIO(img_data))
+    if img.width > width:
+        img = img.resize((width, max(1, round(img.height * width / img.width))), Image.Resampling.LANCZOS)
+    if fmt == "png":
+        return encode(img, "PNG", optimize=True)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA')
+    return encode(img, fmt.upper(), quality=VARIANT_QUALITY.get(fmt, 80))
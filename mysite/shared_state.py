@@ -0,0 +1,342 @@
+# Copyright (c) 2025 Hurairah
+# All Rights Reserved. Proprietary Software.
+# Legal matters handled by parent/guardian until age 18.
+# Governed by Pakistan law (Rawalpindi jurisdiction).
+"""State shared by every node serving the app.
+
+SHARED_STATE_URL picks the backend:
+
+  file:///path/state.sqlite3   LocalState, a SQLite file: the workers of one machine
+  redis://[:password@]host:port/db   RedisState, any server speaking the Redis
+                                     protocol: every node behind the load balancer
+
+Values are JSON. Every backend offers the same operations:
+
+  get(key) / get_many(keys)
+  update(keys, mutate, ttl)   atomic read-modify-write of several keys: mutate
+                              gets {key: value or None}, changes it in place
+                              (None deletes) and its return value is passed on.
+                              It may run more than once, so it must not have
+                              side effects outside that dict.
+  append(key, values, ttl)    add to the end of a list
+  items(key, start)           list entries from index start on
+  scan(prefix)                {key: value} of every key starting with prefix
+
+ttl is in seconds; None keeps the key until it is deleted.
+"""
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+UPDATE_ATTEMPTS = 100  # optimistic transactions retried this often before giving up
+UPDATE_BACKOFF = 0.002  # seconds; retries wait up to this times the attempt number, jittered
+EXPIRE_INTERVAL = 60  # seconds between sweeps of expired LocalState keys
+SOCKET_TIMEOUT = 5
+
+
+class SharedStateError(Exception):
+    pass
+
+
+class SharedState:
+    """Interface every backend implements"""
+
+    def get(self, key):
+        return self.get_many([key])[key]
+
+    def get_many(self, keys):
+        raise NotImplementedError
+
+    def update(self, keys, mutate, ttl=None):
+        raise NotImplementedError
+
+    def append(self, key, values, ttl=None):
+        raise NotImplementedError
+
+    def items(self, key, start=0):
+        raise NotImplementedError
+
+    def scan(self, prefix):
+        raise NotImplementedError
+
+
+class LocalState(SharedState):
+    """Shared state in a SQLite file; every update is one BEGIN IMMEDIATE transaction"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.swept = 0
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS shared_values (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_lists ("
+            "key TEXT NOT NULL, idx INTEGER NOT NULL, value TEXT NOT NULL, expires REAL, "
+            "PRIMARY KEY (key, idx)) WITHOUT ROWID"
+        )
+
+    def connect(self):
+        # One connection per thread, reopened after a fork so workers never share one
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get_many(self, keys):
+        now = time.time()
+        values = dict.fromkeys(keys)
+        for key in keys:
+            row = self.connect().execute(
+                "SELECT value FROM shared_values WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, now)
+            ).fetchone()
+            if row:
+                values[key] = json.loads(row[0])
+        return values
+
+    def update(self, keys, mutate, ttl=None):
+        conn = self.connect()
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.sweep(conn, now)
+            before = {}
+            for key in keys:
+                row = conn.execute(
+                    "SELECT value FROM shared_values WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, now)
+                ).fetchone()
+                before[key] = row[0] if row else None
+            values = {key: json.loads(data) if data is not None else None for key, data in before.items()}
+            result = mutate(values)
+            for key, value in values.items():
+                data = json.dumps(value) if value is not None else None
+                if data == before.get(key) and ttl is None:
+                    continue
+                if data is None:
+                    conn.execute("DELETE FROM shared_values WHERE key = ?", (key,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO shared_values (key, value, expires) VALUES (?, ?, ?)",
+                                 (key, data, expires))
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def append(self, key, values, ttl=None):
+        conn = self.connect()
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.sweep(conn, now)
+            last = conn.execute("SELECT MAX(idx) FROM shared_lists WHERE key = ?", (key,)).fetchone()[0]
+            start = last + 1 if last is not None else 0
+            conn.executemany("INSERT INTO shared_lists (key, idx, value, expires) VALUES (?, ?, ?, ?)",
+                             [(key, start + i, json.dumps(value), expires) for i, value in enumerate(values)])
+            # Like PEXPIRE, the ttl applies to the whole list
+            conn.execute("UPDATE shared_lists SET expires = ? WHERE key = ?", (expires, key))
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return start + len(values)
+
+    def items(self, key, start=0):
+        rows = self.connect().execute(
+            "SELECT value FROM shared_lists WHERE key = ? AND idx >= ? AND (expires IS NULL OR expires > ?) ORDER BY idx",
+            (key, start, time.time())
+        ).fetchall()
+        return [json.loads(value) for value, in rows]
+
+    def scan(self, prefix):
+        rows = self.connect().execute(
+            "SELECT key, value FROM shared_values WHERE key >= ? AND key < ? AND (expires IS NULL OR expires > ?)",
+            (prefix, prefix + "\uffff", time.time())
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def sweep(self, conn, now):
+        """Drop expired keys, at most every EXPIRE_INTERVAL seconds (inside a transaction)"""
+        if now - self.swept < EXPIRE_INTERVAL:
+            return
+        self.swept = now
+        conn.execute("DELETE FROM shared_values WHERE expires <= ?", (now,))
+        conn.execute("DELETE FROM shared_lists WHERE expires <= ?", (now,))
+
+
+class RedisConnection:
+    """One socket speaking RESP2"""
+
+    def __init__(self, host, port, password, db):
+        self.sock = socket.create_connection((host, port), timeout=SOCKET_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.execute([("AUTH", password)])
+        if db:
+            self.execute([("SELECT", db)])
+
+    def execute(self, commands):
+        """Send every command in one write, then read one reply per command"""
+        out = []
+        for command in commands:
+            out.append(b"*%d\r\n" % len(command))
+            for arg in command:
+                arg = arg if isinstance(arg, bytes) else str(arg).encode()
+                out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(out))
+        replies = [self.read() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, SharedStateError):
+                raise reply
+        return replies
+
+    def read(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("shared state server closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return SharedStateError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            # Errors inside an EXEC reply stay values, so the caller sees which command failed
+            return [self.read() for _ in range(length)]
+        raise ConnectionError(f"unexpected reply from shared state server: {line!r}")
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisState(SharedState):
+    """Shared state on a Redis-protocol server
+
+    update() is an optimistic transaction: WATCH the keys, read them, then
+    write in MULTI/EXEC, starting over if another client changed a watched
+    key in between. Nothing needs Lua, so any server with WATCH will do.
+    """
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.strip("/") or 0)
+        self.local = threading.local()
+
+    def connection(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = RedisConnection(self.host, self.port, self.password, self.db)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def execute(self, commands):
+        try:
+            return self.connection().execute(commands)
+        except (OSError, ConnectionError, ValueError) as e:
+            # The connection may be half way through a reply; never reuse it
+            self.reset()
+            raise SharedStateError(f"shared state server unavailable: {e}") from e
+
+    def reset(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def get_many(self, keys):
+        data = self.execute([["MGET", *keys]])[0]
+        return {key: json.loads(value) if value is not None else None for key, value in zip(keys, data)}
+
+    def update(self, keys, mutate, ttl=None):
+        for attempt in range(UPDATE_ATTEMPTS):
+            watched = self.execute([["WATCH", *keys], ["MGET", *keys]])[1]
+            before = dict(zip(keys, watched))
+            values = {key: json.loads(data) if data is not None else None for key, data in before.items()}
+            try:
+                result = mutate(values)
+            except:
+                self.execute([["UNWATCH"]])
+                raise
+            writes = []
+            for key, value in values.items():
+                data = json.dumps(value).encode() if value is not None else None
+                if data == before.get(key) and ttl is None:
+                    continue
+                if data is None:
+                    writes.append(["DEL", key])
+                elif ttl is not None:
+                    writes.append(["SET", key, data, "PX", int(ttl * 1000)])
+                else:
+                    writes.append(["SET", key, data])
+            if not writes:
+                self.execute([["UNWATCH"]])
+                return result
+            # EXEC answers nil when a watched key changed since WATCH
+            if self.execute([["MULTI"], *writes, ["EXEC"]])[-1] is not None:
+                return result
+            time.sleep(random.uniform(0, UPDATE_BACKOFF * (attempt + 1)))
+        raise SharedStateError(f"gave up updating {keys} after {UPDATE_ATTEMPTS} conflicting attempts")
+
+    def append(self, key, values, ttl=None):
+        commands = [["RPUSH", key, *(json.dumps(value) for value in values)]]
+        if ttl is not None:
+            commands.append(["PEXPIRE", key, int(ttl * 1000)])
+        return self.execute(commands)[0]
+
+    def items(self, key, start=0):
+        return [json.loads(value) for value in self.execute([["LRANGE", key, start, -1]])[0]]
+
+    def scan(self, prefix):
+        pattern = "".join("\\" + c if c in "*?[]\\" else c for c in prefix) + "*"
+        keys = []
+        cursor = b"0"
+        while True:
+            cursor, batch = self.execute([["SCAN", cursor, "MATCH", pattern, "COUNT", 1000]])[0]
+            keys.extend(key.decode() for key in batch)
+            if cursor == b"0":
+                break
+        values = {}
+        for i in range(0, len(keys), 500):
+            values.update(self.get_many(keys[i:i + 500]))
+        return {key: value for key, value in values.items() if value is not None}
+
+
+def open_state(url):
+    """The backend for a SHARED_STATE_URL, or None when it is empty"""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return LocalState(unquote(parsed.path))
+    if parsed.scheme in ("redis", "tcp"):
+        return RedisState(url)
+    raise ValueError(f"unsupported SHARED_STATE_URL scheme: {parsed.scheme!r}")
@@ -0,0 +1,304 @@
+# Copyright (c) 2025 Hurairah
+# All Rights Reserved. Proprietary Software.
+# Legal matters handled by parent/guardian until age 18.
+# Governed by Pakistan law (Rawalpindi jurisdiction).
+"""Prometheus metrics and structured logs.
+
+Metrics live in memory in each worker process. Every few seconds a
+process writes a snapshot to METRICS_DIR/<parent pid>/<pid>.json, and
+render() merges the snapshots of every worker under the same parent
+(the gunicorn or uvicorn master). Counters and histograms of exited
+workers are kept so totals never go backwards; their gauges are
+dropped.
+
+Logs go to stderr as one JSON object per line (LOG_FORMAT=json, the
+default) or as plain text. Keyword fields passed as extra= become
+top-level keys.
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "hurairahgpt-metrics"))
+METRICS_FLUSH_INTERVAL = 5  # seconds between snapshots of this process's metrics
+METRICS_DIR_RETENTION = 24 * 3600  # snapshot directories of earlier server runs are removed after this
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500)
+
+log = logging.getLogger("hurairahgpt.telemetry")
+
+# LogRecord attributes that are not extra= fields
+RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class Metric:
+    def __init__(self, registry, kind, name, documentation, labelnames=(), buckets=None):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if buckets else None
+        self.values = {}  # label values -> number, or [per-bucket counts..., sum, count]
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.registry.lock:
+            self.values[self.key(labels)] = value
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Gauge of how many callers are inside the block"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Registry:
+    def __init__(self, directory=METRICS_DIR):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.flusher_pid = None
+
+    def add(self, kind, name, documentation, labelnames=(), buckets=None):
+        metric = self.metrics[name] = Metric(self, kind, name, documentation, labelnames, buckets)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.add("counter", name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.add("gauge", name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add("histogram", name, documentation, labelnames, buckets)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: [[list(key), value if metric.kind != "histogram" else list(value)]
+                           for key, value in metric.values.items()]
+                    for name, metric in self.metrics.items()}
+
+    def run_directory(self):
+        return os.path.join(self.directory, str(os.getppid()))
+
+    def write_snapshot(self):
+        run_dir = self.run_directory()
+        os.makedirs(run_dir, exist_ok=True)
+        path = os.path.join(run_dir, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start(self):
+        """Snapshot this process's metrics every METRICS_FLUSH_INTERVAL seconds"""
+        if self.flusher_pid == os.getpid():
+            return
+        # One flusher thread per process (threads do not survive a fork)
+        self.flusher_pid = os.getpid()
+        threading.Thread(target=self.write_forever, daemon=True).start()
+
+    def write_forever(self):
+        self.remove_old_runs()
+        while True:
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                log.warning("metrics snapshot failed", extra={"error": str(e)})
+            time.sleep(METRICS_FLUSH_INTERVAL)
+
+    def remove_old_runs(self):
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name != str(os.getppid()) and time.time() - os.path.getmtime(path) > METRICS_DIR_RETENTION:
+                    shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+    def collect(self):
+        """Merged values of every worker of this server: name -> {label values: value}"""
+        snapshots = {}
+        run_dir = self.run_directory()
+        try:
+            names = os.listdir(run_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(run_dir, name)) as f:
+                    snapshots[int(name[:-5])] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        snapshots[os.getpid()] = self.snapshot()  # our own, fresher than the file
+
+        merged = {name: {} for name in self.metrics}
+        for pid, snapshot in snapshots.items():
+            alive = pid == os.getpid() or pid_alive(pid)
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    if metric.kind == "histogram":
+                        total = merged[name].setdefault(key, [0] * len(value))
+                        merged[name][key] = [a + b for a, b in zip(total, value)]
+                    else:
+                        merged[name][key] = merged[name].get(key, 0) + value
+        return merged
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(values.items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {format_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + [('le', format_number(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_number(value[-2])}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRS and not name.startswith("_"):
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = {name: value for name, value in vars(record).items()
+                  if name not in RECORD_ATTRS and not name.startswith("_")}
+        if fields:
+            line += " " + " ".join(f"{name}={value}" for name, value in fields.items())
+        return line
+
+
+def configure_logging(level=None, fmt=None):
+    level = level or os.getenv("LOG_LEVEL", "INFO")
+    fmt = fmt or os.getenv("LOG_FORMAT", "json")
+    handler = logging.StreamHandler(sys.stderr)
+    if fmt == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger("hurairahgpt")
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    root.propagate = False
+    return root
+
+
+registry = Registry()
+
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Time until the response headers are ready, by route",
+    ["route", "method", "status"])
+sse_streams_active = registry.gauge("sse_streams_active", "Server-sent event streams currently open", ["route"])
+storage_seconds = registry.histogram("storage_operation_duration_seconds", "User storage calls", ["op"])
+storage_bytes = registry.counter("storage_bytes_total", "Serialized bytes read from and written to storage",
+                                 ["direction"])
+upstream_requests = registry.counter(
+    "upstream_requests_total", "Requests to upstream models by outcome (ok, error, hedge_lost)", ["model", "outcome"])
+upstream_ttft = registry.histogram("upstream_ttft_seconds", "Time to the first streamed token", ["model"])
+upstream_tokens_per_second = registry.histogram(
+    "upstream_tokens_per_second", "Streamed chunks per second after the first", ["model"], RATE_BUCKETS)
+upstream_circuit_open = registry.gauge("upstream_circuit_open", "Workers with the model's circuit open", ["model"])
+chat_cancellations = registry.counter("chat_cancellations_total", "Streamed replies stopped by the user")
+chat_tokens_saved = registry.counter(
+    "chat_tokens_saved_total",
+    "Estimated upstream tokens not generated because a reply was stopped (mean reply length minus tokens received)")
+image_stage_seconds = registry.histogram(
+    "image_stage_duration_seconds", "Image generation and serving stages", ["stage"])
+image_bytes = registry.histogram("image_bytes", "Sizes of stored images by format", ["format"], BYTES_BUCKETS)
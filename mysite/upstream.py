@@ -0,0 +1,431 @@
+# Copyright (c) 2025 Hurairah
+# All Rights Reserved. Proprietary Software.
+# Legal matters handled by parent/guardian until age 18.
+# Governed by Pakistan law (Rawalpindi jurisdiction).
+"""Resilient calls to the OpenRouter models.
+
+An Upstream wraps an ordered list of models, primary first. Each model
+has its own circuit breaker. A failed call moves on to the next model,
+and goes back to a model that already failed only after a jittered
+exponential backoff. A streaming call whose first token has not arrived
+within hedge_after seconds is raced against a second request, and the
+slower one is closed.
+
+The primary is tried first while it is responsive. The fallbacks, and a
+primary that has become slow, are ordered by measured latency. All of
+this state is per process. Outcomes, time to first token and stream
+rates are exported through telemetry.
+"""
+import asyncio
+import logging
+import queue
+import random
+import threading
+import time
+
+import telemetry
+
+LATENCY_ALPHA = 0.3  # weight of the newest sample in the latency moving average
+
+log = logging.getLogger("hurairahgpt.upstream")
+
+
+class UpstreamUnavailable(Exception):
+    """Every model failed or has its circuit open"""
+
+
+def retryable(error):
+    """False for client errors that every model would reject the same way"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is None or status >= 500 or status in (404, 408, 409, 429)
+
+
+def wait_time(timeout, heartbeat):
+    """The sooner of a deadline and a heartbeat, either of which may be None"""
+    if timeout is None:
+        return heartbeat
+    return timeout if heartbeat is None else min(timeout, heartbeat)
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold failures in a row; after reset_timeout one probe may close it again"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """The request ended without telling us anything about the model"""
+        with self.lock:
+            self.probing = False
+
+
+class Racer:
+    """One in-flight streaming request"""
+
+    def __init__(self, model):
+        self.model = model
+        self.started = time.monotonic()
+        self.response = None
+        self.task = None
+        self.cancelled = False
+        self.settled = False  # its done or error has been handled
+        self.first_token = None
+        self.chunks = 0  # text chunks after the first
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()  # the task closes its own response
+            return
+        response = self.response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+
+class Upstream:
+    def __init__(self, models, attempts=3, backoff_base=0.5, backoff_max=8.0, hedge_after=0,
+                 failure_threshold=5, reset_timeout=30):
+        self.models = list(models)
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breakers = {model: CircuitBreaker(failure_threshold, reset_timeout) for model in self.models}
+        self.latency = {"call": {}, "stream": {}}  # seconds per reply / to first token, by model
+        self.lock = threading.Lock()
+
+    def backoff(self, attempt):
+        """Full jitter: uniform between 0 and the exponential delay for this attempt"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def observe(self, kind, model, seconds):
+        with self.lock:
+            previous = self.latency[kind].get(model)
+            self.latency[kind][model] = seconds if previous is None else previous + LATENCY_ALPHA * (seconds - previous)
+
+    def ranked(self, kind):
+        """Models in the order to try them"""
+        with self.lock:
+            latency = dict(self.latency[kind])
+
+        def key(item):
+            index, model = item
+            measured = latency.get(model)
+            slow = self.hedge_after and measured is not None and measured > self.hedge_after
+            if index == 0 and not slow:
+                return (0, 0, 0)
+            return (1, measured if measured is not None else float("inf"), index)
+        return [model for _, model in sorted(enumerate(self.models), key=key)]
+
+    def pick(self, kind, avoid, failed):
+        """Next model to send to, preferring ones not in avoid; and whether it already failed in this call"""
+        ranked = self.ranked(kind)
+        for model in [m for m in ranked if m not in avoid] + [m for m in ranked if m in avoid]:
+            if self.breakers[model].allow():
+                return model, model in failed
+        return None, False
+
+    def status(self):
+        return {model: {"state": breaker.state, "failures": breaker.failures,
+                        "ttft": self.latency["stream"].get(model), "latency": self.latency["call"].get(model)}
+                for model, breaker in self.breakers.items()}
+
+    def fail(self, model, error):
+        breaker = self.breakers[model]
+        breaker.record_failure()
+        telemetry.upstream_requests.inc(model=model, outcome="error")
+        telemetry.upstream_circuit_open.set(int(breaker.state != "closed"), model=model)
+        log.warning("upstream request failed", extra={"model": model, "circuit": breaker.state,
+                                                      "error": f"{type(error).__name__}: {str(error)}"})
+
+    def succeed(self, model, racer=None):
+        self.breakers[model].record_success()
+        telemetry.upstream_requests.inc(model=model, outcome="ok")
+        telemetry.upstream_circuit_open.set(0, model=model)
+        if racer is not None and racer.chunks:
+            elapsed = time.monotonic() - racer.first_token
+            if elapsed > 0:
+                telemetry.upstream_tokens_per_second.observe(racer.chunks / elapsed, model=model)
+
+    def call(self, request):
+        """request(model) with failover and backoff; returns its result"""
+        failed = []
+        last_error = None
+        for attempt in range(self.attempts):
+            model, retry = self.pick("call", failed, failed)
+            if model is None:
+                break
+            if retry:
+                time.sleep(self.backoff(attempt))
+            start = time.monotonic()
+            try:
+                result = request(model)
+            except Exception as e:
+                if not retryable(e):
+                    self.breakers[model].release()
+                    raise
+                self.fail(model, e)
+                failed.append(model)
+                last_error = e
+                continue
+            self.succeed(model)
+            self.observe("call", model, time.monotonic() - start)
+            return result
+        raise UpstreamUnavailable(f"No model answered ({len(failed)} failed attempts)") from last_error
+
+    def crown(self, winner, racing):
+        """winner produced the first token; close the others and note how slow they were"""
+        now = time.monotonic()
+        winner.first_token = now
+        self.observe("stream", winner.model, now - winner.started)
+        telemetry.upstream_ttft.observe(now - winner.started, model=winner.model)
+        for racer in racing:
+            if racer is not winner:
+                self.abandon(racer)
+                self.observe("stream", racer.model, now - racer.started)
+                telemetry.upstream_requests.inc(model=racer.model, outcome="hedge_lost")
+
+    def abandon(self, racer):
+        racer.cancel()
+        self.breakers[racer.model].release()
+
+    def settle(self, racer, error, failed):
+        """Record a racer's error, re-raising it when no other model would do better"""
+        racer.settled = True
+        if not retryable(error):
+            self.breakers[racer.model].release()
+            raise error
+        self.fail(racer.model, error)
+        failed.append(racer.model)
+
+    def stream(self, open_stream, text_of, heartbeat=None):
+        """Yield the reply text of open_stream(model), hedging a slow first token and failing over on errors
+
+        With heartbeat, None is yielded whenever that many seconds pass
+        without a chunk of the reply, so the caller can flush what it holds
+        or close the stream. Closing it closes every upstream response.
+        """
+        out = queue.Queue()
+        racing = []
+        failed = []
+        launched = 0
+        last_error = None
+
+        def pump(racer):
+            try:
+                racer.response = open_stream(racer.model)
+                if racer.cancelled:
+                    racer.response.close()
+                    return
+                for chunk in racer.response:
+                    if racer.cancelled:
+                        return
+                    text = text_of(chunk)
+                    if text:
+                        out.put((racer, "text", text))
+                out.put((racer, "done", None))
+            except Exception as e:
+                out.put((racer, "error", e))
+
+        def launch(hedge=False):
+            nonlocal launched
+            if launched >= self.attempts:
+                return None
+            model, retry = self.pick("stream", failed + [r.model for r in racing], failed)
+            if model is None:
+                return None
+            if retry and not hedge:
+                time.sleep(self.backoff(launched))
+            launched += 1
+            racer = Racer(model)
+            racing.append(racer)
+            threading.Thread(target=pump, args=(racer,), daemon=True).start()
+            return racer
+
+        try:
+            timed = launch()  # the racer whose first token the hedge deadline is waiting on
+            winner = None
+            while winner is None:
+                if timed is None and not racing:
+                    raise UpstreamUnavailable(f"No model answered ({len(failed)} failed attempts)") from last_error
+                timeout = None
+                if timed is not None and self.hedge_after:
+                    timeout = max(0, timed.started + self.hedge_after - time.monotonic())
+                try:
+                    racer, kind, value = out.get(timeout=wait_time(timeout, heartbeat))
+                except queue.Empty:
+                    if timeout is None or (heartbeat is not None and heartbeat < timeout):
+                        yield None
+                        continue
+                    timed = None
+                    launch(hedge=True)
+                    continue
+                if racer not in racing:
+                    continue
+                if kind == "error":
+                    racing.remove(racer)
+                    self.settle(racer, value, failed)
+                    last_error = value
+                    if not racing:
+                        timed = launch()
+                    continue
+                winner = racer
+                self.crown(winner, racing)
+                if kind == "text":
+                    yield value
+
+            while kind != "done":
+                try:
+                    racer, kind, value = out.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield None
+                    continue
+                if racer is not winner:
+                    continue
+                if kind == "text":
+                    winner.chunks += 1
+                    yield value
+                elif kind == "error":
+                    # Text already went to the client, so there is nothing to fail over to
+                    winner.settled = True
+                    self.fail(winner.model, value)
+                    raise value
+            winner.settled = True
+            self.succeed(winner.model, winner)
+        finally:
+            for racer in racing:
+                if not racer.settled and not racer.cancelled:
+                    self.abandon(racer)
+
+    async def astream(self, open_stream, text_of, heartbeat=None):
+        """stream() for the event loop; open_stream(model) is awaited and iterated with async for"""
+        out = asyncio.Queue()
+        racing = []
+        failed = []
+        launched = 0
+        last_error = None
+
+        async def pump(racer):
+            try:
+                racer.response = await open_stream(racer.model)
+                async for chunk in racer.response:
+                    text = text_of(chunk)
+                    if text:
+                        out.put_nowait((racer, "text", text))
+                out.put_nowait((racer, "done", None))
+            except asyncio.CancelledError:
+                if racer.response is not None:
+                    await racer.response.close()
+                raise
+            except Exception as e:
+                out.put_nowait((racer, "error", e))
+
+        async def launch(hedge=False):
+            nonlocal launched
+            if launched >= self.attempts:
+                return None
+            model, retry = self.pick("stream", failed + [r.model for r in racing], failed)
+            if model is None:
+                return None
+            if retry and not hedge:
+                await asyncio.sleep(self.backoff(launched))
+            launched += 1
+            racer = Racer(model)
+            racing.append(racer)
+            racer.task = asyncio.create_task(pump(racer))
+            return racer
+
+        try:
+            timed = await launch()
+            winner = None
+            while winner is None:
+                if timed is None and not racing:
+                    raise UpstreamUnavailable(f"No model answered ({len(failed)} failed attempts)") from last_error
+                timeout = None
+                if timed is not None and self.hedge_after:
+                    timeout = max(0, timed.started + self.hedge_after - time.monotonic())
+                try:
+                    racer, kind, value = await asyncio.wait_for(out.get(), wait_time(timeout, heartbeat))
+                except asyncio.TimeoutError:
+                    if timeout is None or (heartbeat is not None and heartbeat < timeout):
+                        yield None
+                        continue
+                    timed = None
+                    await launch(hedge=True)
+                    continue
+                if racer not in racing:
+                    continue
+                if kind == "error":
+                    racing.remove(racer)
+                    self.settle(racer, value, failed)
+                    last_error = value
+                    if not racing:
+                        timed = await launch()
+                    continue
+                winner = racer
+                self.crown(winner, racing)
+                if kind == "text":
+                    yield value
+
+            while kind != "done":
+                try:
+                    racer, kind, value = await asyncio.wait_for(out.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if racer is not winner:
+                    continue
+                if kind == "text":
+                    winner.chunks += 1
+                    yield value
+                elif kind == "error":
+                    winner.settled = True
+                    self.fail(winner.model, value)
+                    raise value
+            winner.settled = True
+            self.succeed(winner.model, winner)
+        finally:
+            for racer in racing:
+                if not racer.settled and not racer.cancelled:
+                    self.abandon(racer)